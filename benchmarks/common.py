@@ -0,0 +1,91 @@
+import json
+import os
+import platform
+import time
+
+import numpy as np
+import torch
+
+"""
+    Shared by the benchmark scripts: the environment of a run, the JSON results file and the
+    comparison with a stored baseline
+
+    A results file is {'environment': {...}, 'results': [{case keys..., metrics...}]}. Cases are
+    matched with the baseline on their keys; a metric more than tolerance (relative) above its
+    baseline is a regression. All metrics are lower-is-better (times, memory). A missing baseline
+    fails the comparison too (unless it is being written with --save_baseline), so that a
+    checkout without one cannot pass as a gate.
+"""
+
+
+def environment():
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'torch': torch.__version__, 'numpy': np.__version__, 'threads': torch.get_num_threads(),
+            'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None}
+
+
+def add_baseline_args(parser, default_baseline):
+    parser.add_argument('--out', help="Results file (.json)")
+    parser.add_argument('--baseline', default=default_baseline, help="Baseline results file (.json) to compare with")
+    parser.add_argument('--save_baseline', action='store_true', help="Write the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Relative slowdown over the baseline reported as a regression")
+
+
+def write_results(path, results):
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    print('Results written to {}'.format(path))
+
+
+def compare(results, baseline, keys, metrics, tolerance=0.1):
+    """
+        Text table of every metric of results against baseline (a results file), the number of
+        regressions and the number of metrics compared
+    """
+    base = {tuple(row[key] for key in keys): row for row in baseline['results']}
+    lines = ['{:<40} {:<20} {:>14} {:>14} {:>8}'.format('Case', 'Metric', 'Baseline', 'Now', 'Ratio')]
+    regressions, compared = 0, 0
+    for row in results:
+        case = tuple(row[key] for key in keys)
+        if case not in base:
+            continue
+        for metric in metrics:
+            before, now = base[case].get(metric), row.get(metric)
+            if not before or now is None:
+                continue
+            ratio = now / before
+            compared += 1
+            regressed = ratio > 1 + tolerance
+            regressions += regressed
+            lines.append('{:<40} {:<20} {:>14.6g} {:>14.6g} {:>7.2f}x{}'.format(
+                ' '.join(str(value) for value in case)[:40], metric, before, now, ratio, ' !' if regressed else ''))
+    return '\n'.join(lines), regressions, compared
+
+
+def report(results, args, keys, metrics):
+    """
+        Writes the results (--out, --save_baseline) and compares them with the baseline;
+        returns the exit code of the benchmark, 1 if there are regressions or no baseline
+    """
+    if args.out:
+        write_results(args.out, results)
+    if args.save_baseline:
+        write_results(args.baseline, results)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('[!] No baseline at {}; record one on this machine with --save_baseline'.format(args.baseline))
+        return 1
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    table, regressions, compared = compare(results, baseline, keys, metrics, args.tolerance)
+    print('\nAgainst the baseline {} ({})\n{}'.format(args.baseline, baseline['environment']['time'], table))
+    if not compared:
+        print('[!] None of the cases of this run are in the baseline; record it again with --save_baseline')
+        return 1
+    if regressions:
+        print('{} regression(s) over {:.0%}'.format(regressions, args.tolerance))
+    return 1 if regressions else 0
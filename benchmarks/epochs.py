@@ -0,0 +1,175 @@
+"""
+    End-to-end training benchmark: a few epochs of every model on a small fixed dataset
+
+    Loads the dataset (MUTAG with the committed data/TUs/MUTAG_*.index splits, or 'synthetic',
+    a seeded set of molecule-like graphs), computes its union weights (always, into a temporary
+    transform cache, so the on-disk cache of data/ does not hide the preprocessing cost), then
+    trains each model of configs/MUTAG/ for --epochs epochs on split 0 through
+    train_epoch_sparse / evaluate_network_sparse on the CPU. It records:
+
+        data_load_s     loading the dataset and its splits
+        preprocess_s    union weights of all graphs
+        first_epoch_s   the first training epoch (allocator and autograd warm-up included)
+        epoch_s         median of the other training epochs
+        eval_s          median of the validation passes
+        peak_rss_mb     peak resident memory of the process so far (it only grows, so the rows
+                        of later models include the earlier ones)
+
+    and compares them with the baseline, exiting with 1 on a regression over --tolerance, and
+    also when there is no baseline to compare with (so that a fresh checkout does not pass the
+    check silently). The baseline is recorded on the machine that checks it, as numbers from
+    another machine mean nothing; the first run of MUTAG also downloads it, so record the
+    baseline on a second run.
+    Run from the repository root (the configs and the split files are read from there):
+
+        python -m benchmarks.epochs --save_baseline
+        python -m benchmarks.epochs            # before a release
+"""
+import argparse
+import json
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import dgl
+import networkx as nx
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+from torch.utils.data import DataLoader
+
+from nets.load_net import gnn_model
+from data.data import LoadData
+from data.TUs import TUsDataset, DGLFormDataset
+from data.transforms import TransformChain, UnionWeights, FloatFeatures
+from train_TUs_graph_classification import train_epoch_sparse, evaluate_network_sparse
+from sweep import add_dataset_params
+from benchmarks.preprocessing import molecule
+from benchmarks.common import add_baseline_args, report
+
+MODELS = ['UnionSNN', 'GIN', 'GCN']
+KEYS = ['dataset', 'model']
+METRICS = ['data_load_s', 'preprocess_s', 'first_epoch_s', 'epoch_s', 'eval_s', 'peak_rss_mb']
+
+
+class SyntheticMolecules:
+    """
+        Seeded molecule-like graphs in the layout of TUsDataset: 7 one-hot atom types,
+        label 1 for graphs with more than one ring, one 80/10/10 split
+    """
+    collate = TUsDataset.collate
+
+    def __init__(self, num_graphs=188, seed=0):
+        rng = np.random.default_rng(seed)
+        graphs, labels = [], []
+        for _ in range(num_graphs):
+            nx_g = molecule(int(rng.integers(12, 29)), None, rng)
+            g = dgl.from_networkx(nx_g)
+            g.ndata['feat'] = F.one_hot(torch.from_numpy(rng.integers(7, size=g.num_nodes())), 7)
+            graphs.append(FloatFeatures()(g))
+            labels.append(int(len(nx.cycle_basis(nx_g)) > 1))
+        self.name = 'synthetic'
+        self.all = DGLFormDataset(graphs, np.array(labels))
+        self.max_node_num = max(g.num_nodes() for g in graphs)
+        idx = rng.permutation(num_graphs).tolist()
+        n_train, n_val = int(0.8 * num_graphs), int(0.1 * num_graphs)
+        self.all_idx = {'train': [idx[:n_train]], 'val': [idx[n_train:n_train + n_val]],
+                        'test': [idx[n_train + n_val:]]}
+        self._build_splits()
+
+    def _build_splits(self):
+        graphs, labels = self.all.graph_lists, self.all.graph_labels
+        split = lambda idx: DGLFormDataset([graphs[i] for i in idx], [labels[i] for i in idx])
+        self.train, self.val, self.test = [[split(idx) for idx in self.all_idx[section]]
+                                           for section in ['train', 'val', 'test']]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024   # KB on Linux
+
+
+def load_dataset(name, preprocess, seed):
+    # (dataset with union weights, load seconds, preprocessing seconds)
+    start = time.perf_counter()
+    dataset = SyntheticMolecules(seed=seed) if name == 'synthetic' else LoadData(name)
+    data_load = time.perf_counter() - start
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        chain = TransformChain([UnionWeights(preprocess)], cache_dir=cache_dir)
+        dataset.all.graph_lists = chain.apply(dataset.all.graph_lists, dataset.name)
+        dataset._build_splits()
+        preprocessing = time.perf_counter() - start
+    finally:
+        shutil.rmtree(cache_dir)
+    return dataset, data_load, preprocessing
+
+
+def train_model(model_name, dataset, preprocess, epochs):
+    with open('configs/MUTAG/TUs_graph_classification_{}_MUTAG_100k.json'.format(model_name)) as f:
+        config = json.load(f)
+    params, net_params = config['params'], config['net_params']
+    device = torch.device('cpu')
+    net_params['device'] = device
+    net_params['batch_size'] = params['batch_size']
+    net_params['preprocess'] = preprocess
+    add_dataset_params(net_params, dataset, 'TUs')
+
+    torch.manual_seed(params['seed'])
+    np.random.seed(params['seed'])
+    model = gnn_model(model_name, net_params).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=params['init_lr'], weight_decay=params['weight_decay'])
+    generator = torch.Generator().manual_seed(params['seed'])
+    train_loader = DataLoader(dataset.train[0], batch_size=params['batch_size'], shuffle=True,
+                              collate_fn=dataset.collate, generator=generator)
+    val_loader = DataLoader(dataset.val[0], batch_size=params['batch_size'], shuffle=False, collate_fn=dataset.collate)
+
+    epoch_times, eval_times = [], []
+    for epoch in range(epochs):
+        start = time.perf_counter()
+        train_loss, _, optimizer = train_epoch_sparse(model, optimizer, device, train_loader, epoch)
+        epoch_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        evaluate_network_sparse(model, device, val_loader, epoch)
+        eval_times.append(time.perf_counter() - start)
+    return {'first_epoch_s': epoch_times[0], 'epoch_s': statistics.median(epoch_times[1:] or epoch_times),
+            'eval_s': statistics.median(eval_times), 'peak_rss_mb': peak_rss_mb(), 'train_loss': train_loss}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='MUTAG', help="MUTAG or synthetic")
+    parser.add_argument('--models', default=','.join(MODELS), help="Models (comma separated)")
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--preprocess', default='shortest_path_graph')
+    parser.add_argument('--threads', type=int, default=1, help="torch intra-op threads")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic dataset")
+    add_baseline_args(parser, 'benchmarks/baselines/epochs_{}.json')
+    args = parser.parse_args()
+    args.baseline = args.baseline.format(args.dataset)
+    torch.set_num_threads(args.threads)
+
+    dataset, data_load, preprocessing = load_dataset(args.dataset, args.preprocess, args.seed)
+    results = [{'dataset': args.dataset, 'model': None, 'graphs': len(dataset.all.graph_lists),
+                'data_load_s': data_load, 'preprocess_s': preprocessing, 'peak_rss_mb': peak_rss_mb()}]
+    print('{}: {} graphs, loaded in {:.2f}s, union weights in {:.2f}s'.format(
+        args.dataset, len(dataset.all.graph_lists), data_load, preprocessing))
+
+    print('{:<10} {:>14} {:>10} {:>10} {:>12} {:>12}'.format(
+        'Model', 'First epoch s', 'Epoch s', 'Eval s', 'Peak RSS MB', 'Train loss'))
+    for model_name in args.models.split(','):
+        row = dict({'dataset': args.dataset, 'model': model_name},
+                   **train_model(model_name, dataset, args.preprocess, args.epochs))
+        results.append(row)
+        print('{:<10} {:>14.3f} {:>10.3f} {:>10.3f} {:>12.1f} {:>12.4f}'.format(
+            model_name, row['first_epoch_s'], row['epoch_s'], row['eval_s'], row['peak_rss_mb'], row['train_loss']))
+    return report(results, args, KEYS, METRICS)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
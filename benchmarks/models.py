@@ -0,0 +1,197 @@
+"""
+    Forward and backward micro-benchmark of the UnionSNN, GIN and GCN layers and nets on CPU
+
+    Every case runs one module on a fixed random batch (Erdos-Renyi graphs of a given size and
+    edge density, random union weights in edata['weight']), --warmup untimed then --iters timed
+    iterations, in two modes: 'forward' (eval, no_grad) and 'train' (train mode, forward, sum
+    of the output and backward). It reports the mean, p50, p90 and p99 latency and graphs/s,
+    over the product of the sizes below; UnionSNN against GIN on the same case shows the cost
+    of the edge weight MLP and softmax.
+
+    --exec_modes runs the cases sparse, dense (padded [B, Nmax, Nmax] blocks and bmm, see
+    layers/dense_ops.py) and/or auto, on the scatter backend of the layers and on both backends
+    of the nets, and puts dense / sparse next to the padded edges per row and Nmax of the batch:
+    the measurements behind the 'auto' thresholds (dense_max_nodes, dense_min_nodes,
+    dense_min_degree).
+
+        modules   UnionSNNLayer, GINLayer, GCNLayer (one layer, hidden_dim -> hidden_dim)
+                  UnionSNN, GIN, GCN (the nets of nets/load_net.py, L=4)
+
+    Run from the repository root:
+
+        python -m benchmarks.models --modules UnionSNNLayer,GINLayer --threads 1,4 --save_baseline
+        python -m benchmarks.models --modules UnionSNNLayer,GINLayer --threads 1,4
+        python -m benchmarks.models --modules GINLayer,GCNLayer --backends scatter --exec_modes sparse,dense \
+            --nodes 10,20,40,64,100 --densities 0.05,0.1,0.2,0.4 --threads 1 --out dense.json
+"""
+import argparse
+import itertools
+import sys
+import time
+
+import dgl
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from nets.load_net import gnn_model
+from layers.unionsnn_layer import UnionSNNLayer, ApplyNodeFunc, MLP
+from layers.gin_layer import GINLayer, ApplyNodeFunc as GINApplyNodeFunc, MLP as GINMLP
+from layers.gcn_layer import GCNLayer
+from layers.scatter_ops import graph_tensors
+from layers.dense_ops import DenseBatch, select_dense_batch
+from benchmarks.common import add_baseline_args, report
+
+LAYERS = ['UnionSNNLayer', 'GINLayer', 'GCNLayer']
+NETS = ['UnionSNN', 'GIN', 'GCN']
+MODES = ['forward', 'train']
+EXEC_MODES = ['sparse', 'dense', 'auto']
+KEYS = ['module', 'backend', 'exec_mode', 'mode', 'batch_size', 'hidden_dim', 'nodes', 'density', 'threads']
+METRICS = ['mean_ms', 'p50_ms', 'p90_ms', 'p99_ms']
+
+
+def random_batch(batch_size, nodes, density, in_dim, seed):
+    # batched DGLGraph of batch_size random symmetric graphs with union weights, and node features
+    rng = np.random.default_rng(seed)
+    graphs = []
+    for _ in range(batch_size):
+        upper = np.triu(rng.random((nodes, nodes)) < density, 1)
+        src, dst = np.nonzero(upper | upper.T)
+        g = dgl.graph((torch.from_numpy(src), torch.from_numpy(dst)), num_nodes=nodes)
+        g.edata['weight'] = torch.from_numpy(rng.random((len(src), 1)).astype(np.float32)) + 1
+        graphs.append(g)
+    g = dgl.batch(graphs)
+    return g, torch.from_numpy(rng.standard_normal((g.num_nodes(), in_dim)).astype(np.float32))
+
+
+def net_params(hidden_dim, in_dim, batch_size, backend, exec_mode):
+    return {'L': 4, 'hidden_dim': hidden_dim, 'out_dim': hidden_dim, 'residual': True, 'readout': 'sum',
+            'n_mlp_GIN': 2, 'learn_eps_GIN': True, 'neighbor_aggr_GIN': 'sum', 'in_feat_dropout': 0.0,
+            'dropout': 0.0, 'batch_norm': True, 'edge_feat': False, 'preprocess': 'shortest_path_graph',
+            'in_dim': in_dim, 'n_classes': 2, 'device': torch.device('cpu'), 'batch_size': batch_size,
+            'backend': backend, 'exec_mode': exec_mode}
+
+
+def build(module, hidden_dim, batch_size, backend, exec_mode):
+    """
+        (module, fn(module, g, h, tensors)), tensors being (edge_index, edge_weight, batch, num_graphs)
+        for the scatter backend; the layers select their DenseBatch per call, as the nets do
+    """
+    if module in NETS:
+        model = gnn_model(module, net_params(hidden_dim, hidden_dim, batch_size, backend, exec_mode))
+        return model, lambda model, g, h, tensors: model(g, h, None)
+    if module == 'UnionSNNLayer':
+        layer = UnionSNNLayer(ApplyNodeFunc(MLP(2, hidden_dim, hidden_dim, hidden_dim)), 'sum', 0.0, True, True, 0,
+                              True, True)
+    elif module == 'GINLayer':
+        layer = GINLayer(GINApplyNodeFunc(GINMLP(2, hidden_dim, hidden_dim, hidden_dim)), 'sum', 0.0, True, True, 0,
+                         True, True)
+    else:
+        layer = GCNLayer(hidden_dim, hidden_dim, F.relu, 0.0, True, True, e_feat=True)
+    if backend == 'scatter':
+        per_channel = module == 'UnionSNNLayer'   # its edge weights are [E, hidden_dim]
+
+        def run(layer, g, h, tensors):
+            edge_index, edge_weight, batch, num_graphs = tensors
+            dense = select_dense_batch(exec_mode, edge_index, batch, num_graphs, per_channel=per_channel)
+            return layer.forward_tensors(h, edge_index, edge_weight, dense)
+        return layer, run
+    return layer, lambda layer, g, h, tensors: layer(g.local_var(), h)
+
+
+def time_case(model, run, g, h, mode, warmup, iters):
+    edge_index, batch, num_graphs = graph_tensors(g)
+    tensors = (edge_index, g.edata['weight'], batch, num_graphs)
+    latencies = []
+    model.train(mode == 'train')
+    for i in range(warmup + iters):
+        start = time.perf_counter()
+        if mode == 'train':
+            model.zero_grad(set_to_none=True)
+            run(model, g, h, tensors).sum().backward()
+        else:
+            with torch.no_grad():
+                run(model, g, h, tensors)
+        if i >= warmup:
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', default=','.join(LAYERS + NETS), help="Layers and nets (comma separated)")
+    parser.add_argument('--backends', default='dgl', help="Backends: dgl and/or scatter (comma separated)")
+    parser.add_argument('--exec_modes', default='sparse',
+                        help="sparse, dense and/or auto (comma separated); the DGL layers only run sparse")
+    parser.add_argument('--modes', default=','.join(MODES), help="forward and/or train (comma separated)")
+    parser.add_argument('--batch_sizes', default='32,128', help="Graphs per batch (comma separated)")
+    parser.add_argument('--hidden_dims', default='64,128', help="Hidden dims (comma separated)")
+    parser.add_argument('--nodes', default='20,50', help="Nodes per graph (comma separated)")
+    parser.add_argument('--densities', default='0.1,0.3', help="Edge probabilities (comma separated)")
+    parser.add_argument('--threads', default='1,{}'.format(torch.get_num_threads()),
+                        help="torch intra-op thread counts (comma separated)")
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--iters', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    add_baseline_args(parser, 'benchmarks/baselines/models.json')
+    args = parser.parse_args()
+
+    ints = lambda text: [int(v) for v in text.split(',')]
+    cases = itertools.product(args.modules.split(','), args.backends.split(','), args.exec_modes.split(','),
+                              ints(args.batch_sizes), ints(args.hidden_dims), ints(args.nodes),
+                              [float(d) for d in args.densities.split(',')], ints(args.threads))
+    print('{:<14} {:<8} {:<7} {:<8} {:>6} {:>6} {:>6} {:>6} {:>4} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'Module', 'Backend', 'Exec', 'Mode', 'Batch', 'Hidden', 'Nodes', 'Dens.', 'Thr', 'mean ms', 'p50 ms', 'p90 ms',
+        'p99 ms', 'graphs/s'))
+    results = []
+    for module, backend, exec_mode, batch_size, hidden_dim, nodes, density, threads in cases:
+        if module in LAYERS and backend == 'dgl' and exec_mode != 'sparse':
+            continue
+        torch.set_num_threads(threads)
+        torch.manual_seed(args.seed)
+        g, h = random_batch(batch_size, nodes, density, hidden_dim, args.seed)
+        padded = DenseBatch(*graph_tensors(g))
+        model, run = build(module, hidden_dim, batch_size, backend, exec_mode)
+        for mode in args.modes.split(','):
+            latencies = time_case(model, run, g, h, mode, args.warmup, args.iters)
+            row = {'module': module, 'backend': backend, 'exec_mode': exec_mode, 'mode': mode, 'batch_size': batch_size,
+                   'hidden_dim': hidden_dim, 'nodes': nodes, 'density': density, 'threads': threads,
+                   'edges': g.num_edges(), 'n_max': padded.n_max, 'row_degree': padded.row_degree(),
+                   'mean_ms': float(latencies.mean()),
+                   'p50_ms': float(np.percentile(latencies, 50)), 'p90_ms': float(np.percentile(latencies, 90)),
+                   'p99_ms': float(np.percentile(latencies, 99)),
+                   'graphs_per_sec': batch_size / (latencies.mean() / 1e3)}
+            results.append(row)
+            print('{:<14} {:<8} {:<7} {:<8} {:>6} {:>6} {:>6} {:>6} {:>4} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.0f}'.format(
+                module, backend, exec_mode, mode, batch_size, hidden_dim, nodes, density, threads, row['mean_ms'],
+                row['p50_ms'], row['p90_ms'], row['p99_ms'], row['graphs_per_sec']))
+
+    # UnionSNN over GIN on the same cases: the cost of the edge weight MLP and softmax
+    case = lambda row, module: (module,) + tuple(row[key] for key in KEYS[1:])
+    gin = {case(row, row['module']): row for row in results if row['module'] in ['GINLayer', 'GIN']}
+    overheads = [(row, gin[case(row, row['module'].replace('UnionSNN', 'GIN'))]) for row in results
+                 if row['module'] in ['UnionSNNLayer', 'UnionSNN']
+                 and case(row, row['module'].replace('UnionSNN', 'GIN')) in gin]
+    if overheads:
+        print('\nUnionSNN / GIN mean latency')
+        for row, base in overheads:
+            print('{:<14} {}  {:.2f}x'.format(row['module'], ' '.join(str(row[key]) for key in KEYS[1:]),
+                                             row['mean_ms'] / base['mean_ms']))
+
+    # dense (or auto) over sparse on the same cases: where the padded bmm pays off
+    sparse_case = lambda row, exec_mode: tuple(row[key] if key != 'exec_mode' else exec_mode for key in KEYS)
+    sparse = {sparse_case(row, 'sparse'): row for row in results if row['exec_mode'] == 'sparse'}
+    ratios = [(row, sparse[sparse_case(row, 'sparse')]) for row in results
+              if row['exec_mode'] != 'sparse' and sparse_case(row, 'sparse') in sparse]
+    if ratios:
+        print('\n{} mean latency over sparse (Nmax, padded edges per row)'.format('/'.join(
+            mode for mode in EXEC_MODES[1:] if mode in args.exec_modes.split(','))))
+        for row, base in ratios:
+            print('{:<14} {}  Nmax {:>4} deg {:>5.2f}  {:.2f}x'.format(
+                row['module'], ' '.join(str(row[key]) for key in KEYS[1:]), row['n_max'], row['row_degree'],
+                row['mean_ms'] / base['mean_ms']))
+    return report(results, args, KEYS, METRICS)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
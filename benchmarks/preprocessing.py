@@ -0,0 +1,153 @@
+"""
+    Benchmark of the union subgraph preprocessing on synthetic graphs
+
+    Times compute_union_weights() (the edge weights of the UnionWeights transform) and
+    adj_from_union_weights() (its dense GraphSNN coefficients) per graph and per edge, and
+    measures the peak memory of compute_union_weights() with tracemalloc (in a separate pass, so
+    the tracing does not slow the timed one; it sees the Python and numpy allocations, not the
+    torch ones). Graph families, each with a controlled size and degree:
+
+        er        Erdos-Renyi, edge probability degree / (nodes - 1)
+        ba        Barabasi-Albert, degree / 2 edges per new node
+        molecule  5- and 6-rings joined by chains with side branches, at most 4 bonds per atom
+                  (the degree is that of the molecules, about 2)
+        grid      2D grid (degree 4 in the interior), edges dropped at random towards a degree
+                  below 4, cell diagonals added at random towards one above 4 (up to 8)
+
+    Run from the repository root; any change to preprocessing/ should come with the table
+    of this benchmark before and after it:
+
+        python -m benchmarks.preprocessing --save_baseline          # before
+        python -m benchmarks.preprocessing --out after.json         # after, compared with it
+"""
+import argparse
+import importlib.util
+import sys
+import time
+import tracemalloc
+
+import networkx as nx
+import numpy as np
+
+from preprocessing.preprocess import compute_union_weights, adj_from_union_weights
+from benchmarks.common import add_baseline_args, report
+
+FAMILIES = ['er', 'ba', 'molecule', 'grid']
+KEYS = ['family', 'nodes', 'degree']
+METRICS = ['union_weights_per_graph', 'union_weights_per_edge', 'dense_adj_per_graph', 'peak_memory_mb']
+
+
+def erdos_renyi(nodes, degree, rng):
+    return nx.gnp_random_graph(nodes, min(degree / max(nodes - 1, 1), 1.), seed=int(rng.integers(2**31)))
+
+
+def barabasi_albert(nodes, degree, rng):
+    return nx.barabasi_albert_graph(nodes, min(max(degree // 2, 1), nodes - 1), seed=int(rng.integers(2**31)))
+
+
+def molecule(nodes, degree, rng):
+    # rings (fused or hung on a chain) and chains grown on atoms with free valence
+    g = nx.cycle_graph(int(rng.choice([5, 6])))
+    while g.number_of_nodes() < nodes:
+        free = [n for n in g.nodes if g.degree(n) < (3 if rng.random() < 0.5 else 4)]
+        anchor = int(rng.choice(free)) if free else int(rng.integers(g.number_of_nodes()))
+        size = int(rng.choice([5, 6]))
+        if rng.random() < 0.25 and g.number_of_nodes() + size <= nodes:
+            ring = list(range(g.number_of_nodes(), g.number_of_nodes() + size))
+            nx.add_cycle(g, ring)
+            g.add_edge(anchor, ring[0])
+        else:
+            g.add_edge(anchor, g.number_of_nodes())
+    return g
+
+
+def grid(nodes, degree, rng):
+    side = max(int(round(np.sqrt(nodes))), 2)
+    g = nx.convert_node_labels_to_integers(nx.grid_2d_graph(side, side), ordering='sorted')
+    target = int(round(degree * g.number_of_nodes() / 2))   # number of edges of the average degree
+    if g.number_of_edges() > target:
+        edges = list(g.edges)
+        g.remove_edges_from(edges[i] for i in rng.permutation(len(edges))[:len(edges) - target])
+    else:
+        diagonals = [(i * side + j, (i + 1) * side + j + 1) for i in range(side - 1) for j in range(side - 1)] + \
+                    [(i * side + j + 1, (i + 1) * side + j) for i in range(side - 1) for j in range(side - 1)]
+        g.add_edges_from(diagonals[i] for i in rng.permutation(len(diagonals))[:target - g.number_of_edges()])
+    return g
+
+
+GENERATORS = {'er': erdos_renyi, 'ba': barabasi_albert, 'molecule': molecule, 'grid': grid}
+
+
+def generate(family, nodes, degree, num_graphs, seed):
+    rng = np.random.default_rng(seed)
+    return [nx.to_numpy_array(GENERATORS[family](nodes, degree, rng), dtype=np.float64) for _ in range(num_graphs)]
+
+
+def benchmark_case(graphs, preprocess, repeat):
+    """
+        Best-of-repeat times of the preprocessing of graphs (seconds per graph and per edge),
+        and the largest peak memory of one graph
+    """
+    edges = sum(int(A.sum()) for A in graphs)
+    union_times, dense_times = [], []
+    for _ in range(repeat):
+        union_time, dense_time = 0., 0.
+        for A in graphs:
+            start = time.perf_counter()
+            w = compute_union_weights(A, preprocess)
+            union_time += time.perf_counter() - start
+            start = time.perf_counter()
+            adj_from_union_weights(w)
+            dense_time += time.perf_counter() - start
+        union_times.append(union_time)
+        dense_times.append(dense_time)
+
+    peak = 0
+    for A in graphs:
+        tracemalloc.start()
+        compute_union_weights(A, preprocess)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {'graphs': len(graphs), 'edges': edges, 'avg_degree': edges / sum(len(A) for A in graphs),
+            'union_weights_per_graph': min(union_times) / len(graphs),
+            'union_weights_per_edge': min(union_times) / max(edges, 1),
+            'dense_adj_per_graph': min(dense_times) / len(graphs),
+            'peak_memory_mb': peak / 2**20}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--families', default=','.join(FAMILIES), help="Graph families (comma separated)")
+    parser.add_argument('--nodes', default='16,32,64', help="Graph sizes (comma separated)")
+    parser.add_argument('--degrees', default='3,6', help="Average degrees (comma separated)")
+    parser.add_argument('--graphs', type=int, default=10, help="Graphs per case")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed passes per case (the best one is kept)")
+    parser.add_argument('--preprocess', default='shortest_path_graph')
+    parser.add_argument('--seed', type=int, default=0)
+    add_baseline_args(parser, 'benchmarks/baselines/preprocessing.json')
+    args = parser.parse_args()
+
+    apsp = 'networkit' if importlib.util.find_spec('networkit') is not None else 'networkx'
+    print('All pairs shortest paths with {}'.format(apsp))
+    print('{:<10} {:>6} {:>6} {:>8} {:>16} {:>16} {:>16} {:>10}'.format(
+        'Family', 'Nodes', 'Degree', 'Edges', 'Union ms/graph', 'Union us/edge', 'Dense ms/graph', 'Peak MB'))
+    results = []
+    for family in args.families.split(','):
+        # the degree of molecules is not controlled
+        degrees = [None] if family == 'molecule' else [int(d) for d in args.degrees.split(',')]
+        for nodes in [int(n) for n in args.nodes.split(',')]:
+            for degree in degrees:
+                graphs = generate(family, nodes, degree, args.graphs, args.seed)
+                row = dict({'family': family, 'nodes': nodes, 'degree': degree, 'apsp': apsp},
+                           **benchmark_case(graphs, args.preprocess, args.repeat))
+                results.append(row)
+                print('{:<10} {:>6} {:>6} {:>8} {:>16.3f} {:>16.2f} {:>16.3f} {:>10.2f}'.format(
+                    family, nodes, '-' if degree is None else degree, row['edges'],
+                    row['union_weights_per_graph'] * 1e3, row['union_weights_per_edge'] * 1e6,
+                    row['dense_adj_per_graph'] * 1e3, row['peak_memory_mb']))
+    return report(results, args, KEYS, METRICS)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
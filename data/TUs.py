@@ -6,11 +6,10 @@ import os
 import numpy as np
 import csv
 import dgl
-import networkx as nx
 from dgl.data import TUDataset
 from dgl.data import LegacyTUDataset
-from tqdm import tqdm
-from preprocessing.preprocess import compute_shortest_path
+from data.transforms import TransformChain, UnionWeights, FloatFeatures, SelfLoop, IndexedList
+from utils.memory import MemoryTracker
 import random
 random.seed(42)
 
@@ -35,41 +34,18 @@ class DGLFormDataset(torch.utils.data.Dataset):
         return len(self.lists[0])
 
 
-def self_loop(g):
-    """
-        Utility function only, to be used only when necessary as per user self_loop flag
-        : Overwriting the function dgl.transform.add_self_loop() to not miss ndata['feat'] and edata['feat']
-        
-        
-        This function is called inside a function in TUsDataset class.
-    """
-    new_g = dgl.DGLGraph()
-    new_g.add_nodes(g.number_of_nodes())
-    new_g.ndata['feat'] = g.ndata['feat']
-    
-    src, dst = g.all_edges(order="eid")
-    src = dgl.backend.zerocopy_to_numpy(src)
-    dst = dgl.backend.zerocopy_to_numpy(dst)
-    non_self_edges_idx = src != dst
-    nodes = np.arange(g.number_of_nodes())
-    new_g.add_edges(src[non_self_edges_idx], dst[non_self_edges_idx])
-    new_g.add_edges(nodes, nodes)
-    
-    # This new edata is not used since this function gets called only for GCN, GAT
-    # However, we need this for the generic requirement of ndata and edata
-    new_g.edata['feat'] = torch.zeros(new_g.number_of_edges())
-    return new_g
-
-
 class TUsDataset(torch.utils.data.Dataset):
-    def __init__(self, name, preprocess=None):
+    def __init__(self, name, preprocess=None, lazy=False, memory=None):
         t0 = time.time()
         self.name = name
-        self.max_node_num = 0
-        
-        #dataset = TUDataset(self.name, hidden_size=1)
-        dataset = LegacyTUDataset(self.name, hidden_size=1) # dgl 4.0
-        self.input_dim, self.label_dim, self.max_num_node = dataset.statistics()
+        self.lazy = lazy
+        self.memory = memory or MemoryTracker(enabled=False)
+
+        with self.memory.stage('load'):
+            #dataset = TUDataset(self.name, hidden_size=1)
+            dataset = LegacyTUDataset(self.name, hidden_size=1) # dgl 4.0
+            self.input_dim, self.label_dim, self.max_num_node = dataset.statistics()
+            self.max_node_num = max(g.num_nodes() for g in dataset.graph_lists)
 
         # frankenstein has labels 0 and 2; so correcting them as 0 and 1
         if self.name in ["FRANKENSTEIN", "MUTAG"]:
@@ -77,44 +53,19 @@ class TUsDataset(torch.utils.data.Dataset):
 
         print("[!] Dataset: ", self.name)
 
-        # transfer DGLHeteroGraph to DGLFormDataset
-        if preprocess in ['shortest_path_graph']:
-            # data = []
-            new_adj = os.path.exists('data/TUs/{}_{}_new_adj.npy'.format(self.name, preprocess))
-            if new_adj:
-                print('Load adj from data/TUs/{}_{}_new_adj.npy'.format(self.name, preprocess))
-                adjs = np.load('data/TUs/{}_{}_new_adj.npy'.format(self.name, preprocess), allow_pickle=True)
-                adjs = adjs.tolist()
-            else:
-                print('Feature engineering...')
-                adjs = []
-            for i in tqdm(range(len(dataset))):
-                G, label = dataset[i]
-                if G.num_nodes() > self.max_node_num:
-                    self.max_node_num = G.num_nodes()
-                if not new_adj:
-                    new_A = self.update_adj(G, preprocess)
-                    adjs.append(new_A)
-                else:
-                    new_A = torch.tensor(adjs[i])
-                e_feat = []
-                srcs, dsts = G.edges()
-                for j in range(len(list(srcs))):
-                    e_feat.append([new_A[srcs[j]][dsts[j]]])
-                G.edata['weight'] = torch.tensor((e_feat))
-
-            if not new_adj:
-                adjs = np.array(adjs)
-                np.save('data/TUs/{}_{}_new_adj.npy'.format(self.name, preprocess), adjs)
-
         # this function splits data into train/val/test and returns the indices
-        self.all_idx = self.get_all_split_idx(dataset)
-        
+        with self.memory.stage('split_idx'):
+            self.all_idx = self.get_all_split_idx(dataset)
         self.all = dataset
-        self.train = [self.format_dataset([dataset[idx] for idx in self.all_idx['train'][split_num]]) for split_num in range(10)]
-        self.val = [self.format_dataset([dataset[idx] for idx in self.all_idx['val'][split_num]]) for split_num in range(10)]
-        self.test = [self.format_dataset([dataset[idx] for idx in self.all_idx['test'][split_num]]) for split_num in range(10)]
-        
+
+        # transforms run once over all graphs; the 10 splits are views built from the result
+        steps = []
+        if preprocess in ['shortest_path_graph']:
+            steps.append(UnionWeights(preprocess))
+        steps.append(FloatFeatures())
+        self.transforms = TransformChain()
+        self.apply_transforms(steps)
+
         print("Time taken: {:.4f}s".format(time.time()-t0))
 
     def get_all_split_idx(self, dataset):
@@ -186,19 +137,33 @@ class TUsDataset(torch.utils.data.Dataset):
             Utility function to recover data,
             INTO-> dgl/pytorch compatible format 
         """
-        graphs = [data[0] for data in dataset]
+        graphs = [FloatFeatures()(data[0]) for data in dataset]
         labels = [data[1] for data in dataset]
 
-        for graph in graphs:
-            #graph.ndata['feat'] = torch.FloatTensor(graph.ndata['feat'])
-            graph.ndata['feat'] = graph.ndata['feat'].float() # dgl 4.0
-            # adding edge features for Residual Gated ConvNet, if not there
-            if 'feat' not in graph.edata.keys():
-                edge_feat_dim = graph.ndata['feat'].shape[1] # dim same as node feature dim
-                graph.edata['feat'] = torch.ones(graph.number_of_edges(), edge_feat_dim)
-
         return DGLFormDataset(graphs, labels)
-    
+
+    def apply_transforms(self, steps):
+        """
+            Append steps to the transform chain, run them once over all graphs
+            and rebuild the 10 train/val/test splits from the transformed graphs.
+        """
+        start = len(self.transforms)
+        self.transforms.extend(steps)
+        with self.memory.stage('preprocess'):
+            self.all.graph_lists = self.transforms.apply(self.all.graph_lists, self.name, start=start, lazy=self.lazy)
+        with self.memory.stage('splits'):
+            self._build_splits()
+
+    def _build_splits(self):
+        graphs, labels = self.all.graph_lists, self.all.graph_labels
+        if self.lazy:
+            split = lambda idx: DGLFormDataset(IndexedList(graphs, idx), IndexedList(labels, idx))
+        else:
+            split = lambda idx: DGLFormDataset([graphs[i] for i in idx], [labels[i] for i in idx])
+        self.train = [split(self.all_idx['train'][split_num]) for split_num in range(10)]
+        self.val = [split(self.all_idx['val'][split_num]) for split_num in range(10)]
+        self.test = [split(self.all_idx['test'][split_num]) for split_num in range(10)]
+
     # form a mini batch from a given list of samples = [(graph, label) pairs]
     def collate(self, samples):
         # The input samples is a list of pairs (graph, label).
@@ -211,41 +176,4 @@ class TUsDataset(torch.utils.data.Dataset):
 
         # function for adding self loops
         # this function will be called only if self_loop flag is True
-        for split_num in range(10):
-            self.train[split_num].graph_lists = [self_loop(g) for g in self.train[split_num].graph_lists]
-            self.val[split_num].graph_lists = [self_loop(g) for g in self.val[split_num].graph_lists]
-            self.test[split_num].graph_lists = [self_loop(g) for g in self.test[split_num].graph_lists]
-            
-        for split_num in range(10):
-            self.train[split_num] = DGLFormDataset(self.train[split_num].graph_lists, self.train[split_num].graph_labels)
-            self.val[split_num] = DGLFormDataset(self.val[split_num].graph_lists, self.val[split_num].graph_labels)
-            self.test[split_num] = DGLFormDataset(self.test[split_num].graph_lists, self.test[split_num].graph_labels)
-
-    def update_adj(self, G, preprocess):
-        A_array = G.adj().to_dense().numpy()
-        G = nx.from_numpy_matrix(A_array)
-
-        if preprocess == 'shortest_path_graph':
-            weight = compute_shortest_path(A_array, G, graph_type='union_graph')
-        else:
-            raise NotImplementedError
-
-        w = weight / weight.sum(1, keepdim=True)
-        w = torch.nan_to_num(w, nan=0)
-        w = w + torch.FloatTensor(A_array)
-
-        return w
-
-    def get_adj_from_weight(self, new_adj):
-        weight = new_adj - (new_adj > 0).float()
-        weight = weight * (weight > 0).float().sum(1, keepdim=True)
-
-        coeff = new_adj.sum(1, keepdim=True)
-        coeff = torch.diag((coeff.T)[0])
-
-        w = new_adj + coeff
-
-        w = w.detach().numpy()
-        w = np.nan_to_num(w, nan=0)
-
-        return weight, torch.tensor(w)
+        self.apply_transforms([SelfLoop()])
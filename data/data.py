@@ -3,7 +3,7 @@
 """
 
 
-def LoadData(DATASET_NAME, preprocess=None):
+def LoadData(DATASET_NAME, preprocess=None, graphsnn=False, lazy=False, memory=None):
     """
         This function is called in the main.py file 
         returns:
@@ -11,7 +11,7 @@ def LoadData(DATASET_NAME, preprocess=None):
     """
     if DATASET_NAME in ['ZINC', 'ZINC-full', 'AQSOL']:
         from data.molecules import MoleculeDataset
-        return MoleculeDataset(DATASET_NAME, preprocess=preprocess)
+        return MoleculeDataset(DATASET_NAME, preprocess=preprocess, graphsnn=graphsnn, lazy=lazy, memory=memory)
     else:
         from data.TUs import TUsDataset
-        return TUsDataset(DATASET_NAME, preprocess=preprocess)
+        return TUsDataset(DATASET_NAME, preprocess=preprocess, lazy=lazy, memory=memory)
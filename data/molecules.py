@@ -6,13 +6,9 @@ import os
 import numpy as np
 
 import csv
-import networkx as nx
 import dgl
-from tqdm import tqdm
-from scipy import sparse as sp
-import numpy as np
-import torch.nn.functional as F
-from preprocessing.preprocess import compute_curvature, compute_shortest_path, overlap_subgraph, compute_edge_betweenness, compute_edge_cycle
+from data.transforms import TransformChain, UnionWeights, SelfLoop, PositionalEncoding
+from utils.memory import MemoryTracker
 
 
 # *NOTE
@@ -183,72 +179,19 @@ class MoleculeDatasetDGL(torch.utils.data.Dataset):
         print("Time taken: {:.4f}s".format(time.time() - t0))
 
 
-def self_loop(g):
-    """
-        Utility function only, to be used only when necessary as per user self_loop flag
-        : Overwriting the function dgl.transform.add_self_loop() to not miss ndata['feat'] and edata['feat']
-
-
-        This function is called inside a function in MoleculeDataset class.
-    """
-    new_g = dgl.DGLGraph()
-    new_g.add_nodes(g.number_of_nodes())
-    new_g.ndata['feat'] = g.ndata['feat']
-
-    src, dst = g.all_edges(order="eid")
-    src = dgl.backend.zerocopy_to_numpy(src)
-    dst = dgl.backend.zerocopy_to_numpy(dst)
-    non_self_edges_idx = src != dst
-    nodes = np.arange(g.number_of_nodes())
-    new_g.add_edges(src[non_self_edges_idx], dst[non_self_edges_idx])
-    new_g.add_edges(nodes, nodes)
-
-    # This new edata is not used since this function gets called only for GCN, GAT
-    # However, we need this for the generic requirement of ndata and edata
-    new_g.edata['feat'] = torch.zeros(new_g.number_of_edges())
-    return new_g
-
-
-def positional_encoding(g, pos_enc_dim):
-    """
-        Graph positional encoding v/ Laplacian eigenvectors
-    """
-
-    # Laplacian
-    A = g.adjacency_matrix_scipy(return_edge_ids=False).astype(float)
-    N = sp.diags(dgl.backend.asnumpy(g.in_degrees()).clip(1) ** -0.5, dtype=float)
-    L = sp.eye(g.number_of_nodes()) - N * A * N
-
-    # Eigenvectors with numpy
-    EigVal, EigVec = np.linalg.eig(L.toarray())
-    idx = EigVal.argsort()  # increasing order
-    EigVal, EigVec = EigVal[idx], np.real(EigVec[:, idx])
-    g.ndata['pos_enc'] = torch.from_numpy(EigVec[:, 1:pos_enc_dim + 1]).float()
-
-    # # Eigenvectors with scipy
-    # EigVal, EigVec = sp.linalg.eigs(L, k=pos_enc_dim+1, which='SR')
-    # EigVec = EigVec[:, EigVal.argsort()] # increasing order
-    # g.ndata['pos_enc'] = torch.from_numpy(np.abs(EigVec[:,1:pos_enc_dim+1])).float()
-
-    n = g.number_of_nodes()
-    if n <= pos_enc_dim:
-        g.ndata['pos_enc'] = F.pad(g.ndata['pos_enc'], (0, pos_enc_dim - n + 1), value=float('0'))
-
-    return g
-
-
 class MoleculeDataset(torch.utils.data.Dataset):
 
-    def __init__(self, name, preprocess=None, graphsnn=False):
+    def __init__(self, name, preprocess=None, graphsnn=False, lazy=False, memory=None):
         """
             Loading Moleccular datasets
         """
         start = time.time()
         print("[I] Loading dataset %s..." % (name))
         self.name = name
-        self.max_node_num = 0
+        self.lazy = lazy
+        self.memory = memory or MemoryTracker(enabled=False)
         data_dir = 'data/molecules/'
-        with open(data_dir + name + '.pkl', "rb") as f:
+        with self.memory.stage('load'), open(data_dir + name + '.pkl', "rb") as f:
             f = pickle.load(f)
             self.train = f[0]
             self.val = f[1]
@@ -256,60 +199,31 @@ class MoleculeDataset(torch.utils.data.Dataset):
             self.num_atom_type = f[3]
             self.num_bond_type = f[4]
         print('train, test, val sizes :', len(self.train), len(self.test), len(self.val))
+        self.max_node_num = max(g.num_nodes() for split in [self.train, self.val, self.test]
+                                for g in split.graph_lists)
 
         # preprocessing
-        if graphsnn or preprocess in ['overlap_subgraph', 'curvature', 'shortest_path', 'betweenness', 'cycle', 'shortest_path_graph']:
-            save_dir = 'data/CYCLES'
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir)
-            for split in ['train', 'val', 'test']:
-                data = []
-                new_adj = os.path.exists('{}/{}_{}_{}_new_adj.npy'.format(save_dir, self.name, split, preprocess))
-                if new_adj:
-                    print('Load adj from {}/{}_{}_{}_new_adj.npy'.format(save_dir, self.name, split, preprocess))
-                    adjs = np.load('{}/{}_{}_{}_new_adj.npy'.format(save_dir, self.name, split, preprocess),
-                                   allow_pickle=True)
-                    adjs = adjs.tolist()
-                else:
-                    print('Feature engineering...')
-                    adjs = []
-
-                if split == 'train':
-                    dataset = self.train
-                elif split == 'val':
-                    dataset = self.val
-                elif split == 'test':
-                    dataset = self.test
-                else:
-                    raise NotImplementedError
-
-                for i in tqdm(range(len(dataset))):
-                    G, label = dataset[i]
-                    if G.num_nodes() > self.max_node_num:
-                        self.max_node_num = G.num_nodes()
-                    if not new_adj:
-                        new_A = self.update_adj(G, preprocess)
-                        adjs.append(new_A)
-                    else:
-                        new_A = torch.tensor(adjs[i])
-                    weight, w = self.get_adj_from_weight(new_A)
-                    e_feat = []
-                    srcs, dsts = G.edges()
-                    for j in range(len(list(srcs))):
-                        # e_feat.append([weight[srcs[j]][dsts[j]]])
-                        e_feat.append([new_A[srcs[j]][dsts[j]]])
-                    G.edata['weight'] = torch.tensor((e_feat))
-                    if graphsnn:
-                        G.ndata['adj'] = w.clone()
-                    data.append([G, label])
-
-                if not new_adj:
-                    adjs = np.array(adjs)
-                    np.save('{}/{}_{}_{}_new_adj.npy'.format(save_dir, self.name, split, preprocess), adjs)
+        steps = []
+        if graphsnn or preprocess in ['shortest_path_graph']:
+            steps.append(UnionWeights(preprocess, dense_adj=graphsnn))
+        self.transforms = TransformChain()
+        self.apply_transforms(steps)
 
         print("[I] Finished loading.")
         print("[I] Data load time: {:.4f}s".format(time.time() - start))
 
+    def apply_transforms(self, steps):
+        """
+            Append steps to the transform chain and run them over the train/val/test graph lists
+        """
+        start = len(self.transforms)
+        self.transforms.extend(steps)
+        with self.memory.stage('preprocess'):
+            for split in ['train', 'val', 'test']:
+                dataset = getattr(self, split)
+                dataset.graph_lists = self.transforms.apply(dataset.graph_lists, '{}_{}'.format(self.name, split),
+                                                            start=start, lazy=self.lazy)
+
     # form a mini batch from a given list of samples = [(graph, label) pairs]
     def collate(self, samples):
         # The input samples is a list of pairs (graph, label).
@@ -410,45 +324,12 @@ class MoleculeDataset(torch.utils.data.Dataset):
 
         # function for adding self loops
         # this function will be called only if self_loop flag is True
-
-        self.train.graph_lists = [self_loop(g) for g in self.train.graph_lists]
-        self.val.graph_lists = [self_loop(g) for g in self.val.graph_lists]
-        self.test.graph_lists = [self_loop(g) for g in self.test.graph_lists]
+        self.apply_transforms([SelfLoop()])
 
     def _add_positional_encodings(self, pos_enc_dim):
 
         # Graph positional encoding v/ Laplacian eigenvectors
-        self.train.graph_lists = [positional_encoding(g, pos_enc_dim) for g in self.train.graph_lists]
-        self.val.graph_lists = [positional_encoding(g, pos_enc_dim) for g in self.val.graph_lists]
-        self.test.graph_lists = [positional_encoding(g, pos_enc_dim) for g in self.test.graph_lists]
-
-    def update_adj(self, G, preprocess, l=2):
-        A_array = G.adj().to_dense().numpy()
-        G = nx.from_numpy_matrix(A_array)
-
-        if preprocess == 'shortest_path_graph':
-            weight = compute_shortest_path(A_array, G, graph_type='union_graph')
-        else:
-            raise NotImplementedError
-
-        w = weight / weight.sum(1, keepdim=True)
-        w = w + torch.FloatTensor(A_array)
-
-        return w
-
-    def get_adj_from_weight(self, new_adj):
-        weight = new_adj - (new_adj > 0).float()
-        weight = weight * (weight > 0).float().sum(1, keepdim=True)
-
-        coeff = new_adj.sum(1, keepdim=True)
-        coeff = torch.diag((coeff.T)[0])
-
-        w = new_adj + coeff
-
-        w = w.detach().numpy()
-        w = np.nan_to_num(w, nan=0)
-
-        return weight, torch.tensor(w)
+        self.apply_transforms([PositionalEncoding(pos_enc_dim)])
 
     def pad(self, mtx, desired_dim1, desired_dim2=None, value=0):
         sz = mtx.shape
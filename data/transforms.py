@@ -0,0 +1,258 @@
+"""
+    Composable graph transforms for the dataset classes
+
+    A TransformChain is an ordered list of steps (self-loops, positional encodings,
+    union subgraph weights, ...). Every step carries a hash of its parameters, and the
+    output of each persisted prefix of the chain is saved under data/cache/, so a later
+    run with the same chain (or one sharing a prefix, e.g. GCN with self-loops and
+    UnionSNN on the same preprocessed data) loads it instead of recomputing it.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+import dgl
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy import sparse as sp
+from tqdm import tqdm
+
+from preprocessing.preprocess import compute_union_weights, adj_from_union_weights
+
+
+CACHE_DIR = 'data/cache'
+CACHE_VERSION = 1    # bump when the output of an existing step changes
+
+
+def self_loop(g):
+    """
+        Utility function only, to be used only when necessary as per user self_loop flag
+        : Overwriting the function dgl.transform.add_self_loop() to not miss ndata['feat'] and edata['feat']
+    """
+    new_g = dgl.DGLGraph()
+    new_g.add_nodes(g.number_of_nodes())
+    new_g.ndata['feat'] = g.ndata['feat']
+
+    src, dst = g.all_edges(order="eid")
+    src = dgl.backend.zerocopy_to_numpy(src)
+    dst = dgl.backend.zerocopy_to_numpy(dst)
+    non_self_edges_idx = src != dst
+    nodes = np.arange(g.number_of_nodes())
+    new_g.add_edges(src[non_self_edges_idx], dst[non_self_edges_idx])
+    new_g.add_edges(nodes, nodes)
+
+    # This new edata is not used since this function gets called only for GCN, GAT
+    # However, we need this for the generic requirement of ndata and edata
+    new_g.edata['feat'] = torch.zeros(new_g.number_of_edges())
+    return new_g
+
+
+def positional_encoding(g, pos_enc_dim):
+    """
+        Graph positional encoding v/ Laplacian eigenvectors
+    """
+
+    # Laplacian
+    A = g.adjacency_matrix_scipy(return_edge_ids=False).astype(float)
+    N = sp.diags(dgl.backend.asnumpy(g.in_degrees()).clip(1) ** -0.5, dtype=float)
+    L = sp.eye(g.number_of_nodes()) - N * A * N
+
+    # Eigenvectors with numpy
+    EigVal, EigVec = np.linalg.eig(L.toarray())
+    idx = EigVal.argsort()  # increasing order
+    EigVal, EigVec = EigVal[idx], np.real(EigVec[:, idx])
+    g.ndata['pos_enc'] = torch.from_numpy(EigVec[:, 1:pos_enc_dim + 1]).float()
+
+    n = g.number_of_nodes()
+    if n <= pos_enc_dim:
+        g.ndata['pos_enc'] = F.pad(g.ndata['pos_enc'], (0, pos_enc_dim - n + 1), value=float('0'))
+
+    return g
+
+
+class GraphTransform:
+    """
+        One step of a TransformChain.
+        Subclasses set `name`, pass every parameter that changes their output to
+        __init__ (it becomes part of the cache hash) and implement __call__(g) -> g.
+        Steps that are cheap compared to reading the graphs back from disk set persist = False.
+    """
+    name = 'identity'
+    persist = True
+
+    def __init__(self, **params):
+        self.params = params
+
+    def key(self):
+        return '{}{}'.format(self.name, json.dumps(self.params, sort_keys=True))
+
+    def __call__(self, g):
+        return g
+
+    def __repr__(self):
+        return self.key()
+
+
+class UnionWeights(GraphTransform):
+    """
+        Union subgraph weight of every edge in edata['weight'] (shape [E, 1]);
+        with dense_adj, also the dense structural coefficients in ndata['adj'] (GraphSNN)
+    """
+    name = 'union_weights'
+
+    def __init__(self, preprocess='shortest_path_graph', dense_adj=False):
+        super().__init__(preprocess=preprocess, dense_adj=dense_adj)
+
+    def __call__(self, g):
+        new_A = compute_union_weights(g.adj().to_dense().numpy(), self.params['preprocess'])
+        srcs, dsts = g.edges()
+        g.edata['weight'] = new_A[srcs.long(), dsts.long()].unsqueeze(1)
+        if self.params['dense_adj']:
+            _, w = adj_from_union_weights(new_A)
+            g.ndata['adj'] = w.clone()
+        return g
+
+
+class FloatFeatures(GraphTransform):
+    """
+        Node features as float, and all-ones edge features for graphs that have none
+    """
+    name = 'float_features'
+    persist = False
+
+    def __call__(self, g):
+        g.ndata['feat'] = g.ndata['feat'].float()
+        if 'feat' not in g.edata.keys():
+            edge_feat_dim = g.ndata['feat'].shape[1]  # dim same as node feature dim
+            g.edata['feat'] = torch.ones(g.number_of_edges(), edge_feat_dim)
+        return g
+
+
+class SelfLoop(GraphTransform):
+    name = 'self_loop'
+    persist = False
+
+    def __call__(self, g):
+        return self_loop(g)
+
+
+class PositionalEncoding(GraphTransform):
+    name = 'pos_enc'
+
+    def __init__(self, pos_enc_dim):
+        super().__init__(pos_enc_dim=pos_enc_dim)
+
+    def __call__(self, g):
+        return positional_encoding(g, self.params['pos_enc_dim'])
+
+
+class LazyGraphList:
+    """
+        Graph list that runs the given steps on a graph the first time it is accessed
+    """
+    def __init__(self, graphs, steps):
+        self.graphs = graphs
+        self.steps = list(steps)
+        self._done = {}
+
+    def __len__(self):
+        return len(self.graphs)
+
+    def __getitem__(self, idx):
+        if idx not in self._done:
+            g = self.graphs[idx]
+            for step in self.steps:
+                g = step(g)
+            self._done[idx] = g
+        return self._done[idx]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class IndexedList:
+    """
+        Read-only view base[idx[0]], base[idx[1]], ... that does not touch base until indexed
+    """
+    def __init__(self, base, idx):
+        self.base = base
+        self.idx = list(idx)
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __getitem__(self, i):
+        return self.base[self.idx[i]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class TransformChain:
+    """
+        Ordered list of GraphTransform steps with an on-disk cache per persisted prefix.
+        The cache file of a prefix is keyed by the dataset tag, the number of graphs and
+        the hashes of all the steps in the prefix.
+    """
+    def __init__(self, steps=(), cache_dir=CACHE_DIR):
+        self.steps = list(steps)
+        self.cache_dir = cache_dir
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __repr__(self):
+        return 'TransformChain({})'.format(self.steps)
+
+    def extend(self, steps):
+        self.steps.extend(steps)
+
+    def digest(self, tag, num_graphs, n_steps):
+        h = hashlib.sha1('{}|{}|{}'.format(CACHE_VERSION, tag, num_graphs).encode())
+        for step in self.steps[:n_steps]:
+            h.update(step.key().encode())
+        return h.hexdigest()[:16]
+
+    def cache_path(self, tag, num_graphs, n_steps):
+        return os.path.join(self.cache_dir, '{}_{}.bin'.format(tag, self.digest(tag, num_graphs, n_steps)))
+
+    def apply(self, graphs, tag, start=0, lazy=False):
+        """
+            Run steps[start:] over graphs, which have already been through steps[:start].
+            Resumes from the longest cached prefix; in bulk mode the output of every
+            persisted step is saved, in lazy mode the remaining steps run per graph on access.
+        """
+        num_graphs = len(graphs)
+        for n_steps in range(len(self.steps), start, -1):
+            path = self.cache_path(tag, num_graphs, n_steps)
+            if self.steps[n_steps - 1].persist and os.path.exists(path):
+                print('[I] Load transformed graphs from {}'.format(path))
+                graphs, _ = dgl.load_graphs(path)
+                start = n_steps
+                break
+
+        if lazy:
+            return LazyGraphList(graphs, self.steps[start:]) if start < len(self.steps) else graphs
+
+        for n_steps in range(start + 1, len(self.steps) + 1):
+            step = self.steps[n_steps - 1]
+            print('[I] Applying {} to {} graphs ({})'.format(step, num_graphs, tag))
+            graphs = [step(g) for g in tqdm(graphs)]
+            if step.persist:
+                self._save(self.cache_path(tag, num_graphs, n_steps), graphs)
+        return graphs
+
+    def _save(self, path, graphs):
+        # written to a temporary file next to it and renamed, so that a concurrent run (or
+        # another rank) never loads a partly written cache file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        os.close(fd)
+        try:
+            dgl.save_graphs(tmp_path, graphs)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
@@ -0,0 +1,211 @@
+"""
+    Export a trained checkpoint as a self-contained inference artifact
+
+    The artifact has a plain tensor interface that does not depend on DGL or on the
+    graph structure it was traced with:
+        node_feat      [N, in_dim] node features ([N] atom types for the molecule nets)
+        edge_index     [2, E] (src, dst) of all edges, node ids counted over the whole batch
+        edge_weight    [E, 1] union subgraph weights (edata['weight']), ones if the net does not use them
+        graph_offsets  [B + 1] index of the first node of every graph, followed by N
+    and returns the scores [B, n_classes] ([B, 1] for regression).
+    A scoring worker only needs torch to run it:
+
+        from export import load_artifact
+        model = load_artifact('unionsnn_mutag.pt')
+        scores = model(node_feat, edge_index, edge_weight, graph_offsets)
+
+    The checkpoint directory must hold the net_params.json written by main.py / main_graph_reg.py.
+
+        python export.py --ckpt_dir out/TUs_graph_classification/checkpoints/UnionSNN_MUTAG_GPU0_... \
+            --run 0 --out unionsnn_mutag.pt --fuse --verify
+
+    With --fuse the BatchNorms are folded into the linear layers first (fuse_for_inference()),
+    after checking that the fused net gives the same scores as the unfused one.
+"""
+import argparse
+import glob
+import json
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from layers.fusion import check_equivalence
+
+
+class TensorInterface(nn.Module):
+    """
+        Wraps a net's forward_tensors() behind the (node_feat, edge_index, edge_weight, graph_offsets) interface
+    """
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, node_feat, edge_index, edge_weight, graph_offsets):
+        num_nodes = graph_offsets[1:] - graph_offsets[:-1]
+        batch = torch.repeat_interleave(torch.arange(num_nodes.size(0), device=node_feat.device), num_nodes,
+                                        output_size=node_feat.size(0))
+        return self.net.forward_tensors(node_feat, edge_index, edge_weight, batch, num_nodes.size(0))
+
+
+def load_config(ckpt_dir):
+    with open(os.path.join(ckpt_dir, 'net_params.json')) as f:
+        return json.load(f)
+
+
+def checkpoint_file(ckpt_dir, run, epoch=None):
+    # the given epoch, or the most recent one kept in RUN_<run>
+    run_dir = os.path.join(ckpt_dir, 'RUN_' + str(run))
+    if epoch is not None:
+        return os.path.join(run_dir, 'epoch_{}.pkl'.format(epoch))
+    files = glob.glob(run_dir + '/*.pkl')
+    if not files:
+        raise FileNotFoundError('No checkpoint in {}'.format(run_dir))
+    return max(files, key=lambda file: int(file.split('_')[-1].split('.')[0]))
+
+
+def build_model(config, checkpoint, backend='scatter', **overrides):
+    if config['task'] == 'graph_reg':
+        from nets.graph_reg.load_net import gnn_model
+    else:
+        from nets.load_net import gnn_model
+    net_params = dict(config['net_params'], backend=backend, exec_mode='sparse', **overrides)
+    model = gnn_model(config['model'], net_params)
+    state = torch.load(checkpoint, map_location='cpu', weights_only=False)
+    # training checkpoints (utils/checkpoint_manager.py) hold the model next to the optimizer state
+    model.load_state_dict(state['model'] if 'optimizer' in state else state)
+    return model.eval()
+
+
+def synthetic_inputs(net_params, sizes):
+    """
+        Random batch of graphs with the given numbers of nodes, used as tracing example
+    """
+    node_feat, edge_index, offsets = [], [], [0]
+    for n in sizes:
+        if 'num_atom_type' in net_params:
+            node_feat.append(torch.randint(net_params['num_atom_type'], (n,)))
+        else:
+            node_feat.append(torch.rand(n, net_params['in_dim']))
+        src = torch.randint(n, (3 * n,))
+        dst = torch.randint(n, (3 * n,))
+        edge_index.append(torch.stack([torch.cat([src, dst]), torch.cat([dst, src])]) + offsets[-1])
+        offsets.append(offsets[-1] + n)
+    edge_index = torch.cat(edge_index, dim=1)
+    return torch.cat(node_feat), edge_index, torch.rand(edge_index.size(1), 1), torch.tensor(offsets)
+
+
+def graph_inputs(g):
+    """
+        The tensor interface inputs for a batched DGLGraph
+    """
+    from layers.scatter_ops import graph_tensors
+    edge_index, _, _ = graph_tensors(g)
+    edge_weight = g.edata['weight'] if 'weight' in g.edata else torch.ones(g.num_edges(), 1)
+    graph_offsets = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(g.batch_num_nodes(), 0)])
+    return g.ndata['feat'], edge_index, edge_weight, graph_offsets
+
+
+def load_split(config, split, run, dataset=None):
+    """
+        (dataset, samples): the (graph, label) samples of the train, val or test split the
+        checkpoint was trained on, prepared as in the training pipeline (pass the dataset
+        returned by an earlier call to skip loading it again)
+    """
+    from data.data import LoadData
+
+    net_params = config['net_params']
+    if dataset is None:
+        dataset = LoadData(config['dataset'], preprocess=net_params['preprocess'], graphsnn=(config['model'] == 'GraphSNN'))
+        if config['model'] in ['GCN', 'GAT'] and net_params.get('self_loop'):
+            dataset._add_self_loops()
+    samples = getattr(dataset, split)
+    return dataset, (samples if config['task'] == 'graph_reg' else samples[run])
+
+
+def export(model, config, out, fmt='torchscript'):
+    wrapper = TensorInterface(model).eval()
+    example = synthetic_inputs(config['net_params'], (5, 7))
+    extra = json.dumps(config)
+    with torch.no_grad():
+        if fmt == 'torchscript':
+            # checked against a batch of a different shape so no size gets baked into the trace
+            artifact = torch.jit.trace(wrapper, example, check_inputs=[synthetic_inputs(config['net_params'], (3, 9, 4))])
+            torch.jit.save(artifact, out, _extra_files={'config.json': extra})
+        elif fmt == 'export':
+            num_nodes = torch.export.Dim('num_nodes')
+            num_edges = torch.export.Dim('num_edges')
+            num_offsets = torch.export.Dim('num_offsets')
+            dynamic_shapes = {'node_feat': {0: num_nodes}, 'edge_index': {1: num_edges},
+                              'edge_weight': {0: num_edges}, 'graph_offsets': {0: num_offsets}}
+            artifact = torch.export.export(wrapper, example, dynamic_shapes=dynamic_shapes)
+            torch.export.save(artifact, out, extra_files={'config.json': extra})
+        else:
+            raise NotImplementedError('Unknown export format {}'.format(fmt))
+    print('[I] Exported {} ({}) to {}'.format(config['model'], fmt, out))
+
+
+def load_artifact(path):
+    """
+        Load an exported artifact; .pt2 files come from torch.export, anything else is TorchScript
+    """
+    if path.endswith('.pt2'):
+        return torch.export.load(path).module()
+    return torch.jit.load(path, map_location='cpu')
+
+
+def verify(config, checkpoint, out, run, num_graphs):
+    """
+        Compare the artifact with the DGL model on the first test graphs of the dataset
+    """
+    import dgl
+
+    _, testset = load_split(config, 'test', run)
+    g = dgl.batch([testset[i][0] for i in range(min(num_graphs, len(testset)))])
+
+    start = time.time()
+    artifact = load_artifact(out)
+    print('[I] Artifact loaded in {:.1f} ms'.format((time.time() - start) * 1000))
+
+    model = build_model(config, checkpoint, backend='dgl')
+    with torch.no_grad():
+        expected = model(g, g.ndata['feat'], g.edata['feat'])
+        scores = artifact(*graph_inputs(g))
+    max_diff = (scores - expected).abs().max().item()
+    print('[I] Max abs difference to the DGL model on {} graphs: {:.3e}'.format(g.batch_size, max_diff))
+    if not torch.allclose(scores, expected, rtol=1e-4, atol=1e-5):
+        raise AssertionError('Exported model does not match the checkpoint')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt_dir', help="Please give the checkpoint directory of a training run")
+    parser.add_argument('--run', default=0, help="Please give the RUN_ folder (split) to export")
+    parser.add_argument('--epoch', help="Please give a value for epoch (default: latest)")
+    parser.add_argument('--out', help="Please give the output file (.pt for TorchScript, .pt2 for torch.export)")
+    parser.add_argument('--format', default=None, help="Please give a value for format (torchscript or export)")
+    parser.add_argument('--fuse', action='store_true', help="Fold BatchNorm into the linear layers before exporting")
+    parser.add_argument('--verify', action='store_true', help="Compare the artifact with the DGL model")
+    parser.add_argument('--verify_graphs', type=int, default=64)
+    args = parser.parse_args()
+
+    config = load_config(args.ckpt_dir)
+    run = '' if config['task'] == 'graph_reg' else int(args.run)   # main_graph_reg.py has a single RUN_
+    checkpoint = checkpoint_file(args.ckpt_dir, run, args.epoch)
+    fmt = args.format or ('export' if args.out.endswith('.pt2') else 'torchscript')
+
+    model = build_model(config, checkpoint)
+    if args.fuse:
+        fused = model.fuse_for_inference()
+        max_diff = check_equivalence(TensorInterface(model), TensorInterface(fused),
+                                     synthetic_inputs(config['net_params'], (6, 11, 4)))
+        print('[I] BatchNorm folded, max abs difference to the unfused net: {:.3e}'.format(max_diff))
+        model = fused
+    export(model, config, args.out, fmt)
+    if args.verify:
+        verify(config, checkpoint, args.out, run, args.verify_graphs)
+
+
+if __name__ == '__main__':
+    main()
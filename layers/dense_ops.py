@@ -0,0 +1,105 @@
+import torch
+
+from layers.scatter_ops import SCATTER
+
+"""
+    Dense block-batched message passing for batches of small graphs.
+    The batch is padded into [B, Nmax, Nmax] adjacency blocks and neighbour
+    aggregation runs as torch.bmm instead of gather / index_add over the edges.
+
+    Only a scalar weight per edge (or none) has a bmm form. Per-channel edge weights [E, d]
+    (UnionSNN) would need one Nmax x Nmax block per graph and channel, O(B Nmax^2 d) memory and
+    work against O(E d) sparse, kept for backward too; they always aggregate sparse.
+
+    'auto' goes dense from the measured crossover (forward and backward of one aggregation on
+    CPU, 1 thread, B 32 and 128, Nmax 10 to 160, d 64 and 128; per layer and net with
+    benchmarks/models.py --exec_modes sparse,dense): dense wins once the padded blocks hold
+    about 2 edges per row (num_edges / (B Nmax)) and Nmax is at least 16, by up to 14x on
+    larger graphs; below that the padding and the DenseBatch setup cost up to 3x the sparse
+    time, whatever d (it scales both paths alike). Above 128 nodes the [B, Nmax, Nmax] blocks
+    grow large, since one big graph pads the whole batch.
+"""
+
+
+class DenseBatch:
+    """
+        Padded layout of a batch: node i of graph b sits at row b * Nmax + (i - first node of b),
+        and edge (src, dst) at entry [b, dst, src] of the adjacency blocks, so that A @ H sums
+        the in-neighbours of every node.
+    """
+    def __init__(self, edge_index, batch, num_graphs):
+        self.edge_index = edge_index
+        self.num_graphs = num_graphs
+        self.num_nodes = batch.size(0)
+        self.num_edges = edge_index.size(1)
+
+        counts = torch.bincount(batch, minlength=num_graphs)
+        self.n_max = int(counts.max()) if self.num_nodes > 0 else 0
+        first = torch.cumsum(counts, 0) - counts
+        local = torch.arange(self.num_nodes, device=batch.device) - first[batch]
+        src, dst = edge_index[0], edge_index[1]
+
+        self.node_pos = batch * self.n_max + local
+        self.edge_pos = (batch[dst] * self.n_max + local[dst]) * self.n_max + local[src]
+        self.in_degree = torch.bincount(dst, minlength=self.num_nodes)
+
+    def density(self):
+        # fraction of the padded adjacency blocks that holds an edge
+        return self.num_edges / max(self.num_graphs * self.n_max * self.n_max, 1)
+
+    def row_degree(self):
+        # edges per row of the padded adjacency blocks, the work of bmm per unit of sparse work
+        return self.num_edges / max(self.num_graphs * self.n_max, 1)
+
+    def adj(self, values=None, dtype=torch.float32):
+        """
+            [B, Nmax, Nmax] adjacency blocks, or [B, Nmax, Nmax, d] for per-channel values [E, d]
+        """
+        if values is None:
+            values = torch.ones(self.num_edges, dtype=dtype, device=self.edge_pos.device)
+        size = self.num_graphs * self.n_max * self.n_max
+        A = values.new_zeros((size,) + tuple(values.shape[1:]))
+        A = A.index_put((self.edge_pos,), values, accumulate=True)  # parallel edges add up, as in the sparse sum
+        return A.view((self.num_graphs, self.n_max, self.n_max) + tuple(values.shape[1:]))
+
+    def to_dense(self, h):
+        H = h.new_zeros((self.num_graphs * self.n_max,) + tuple(h.shape[1:]))
+        return H.index_copy(0, self.node_pos, h).view((self.num_graphs, self.n_max) + tuple(h.shape[1:]))
+
+    def from_dense(self, H):
+        return H.reshape((self.num_graphs * self.n_max,) + tuple(H.shape[2:]))[self.node_pos]
+
+    def aggregate(self, h, weight=None, aggr='sum'):
+        if aggr == 'max' or (weight is not None and weight.size(-1) > 1):
+            # no matmul form for max, nor for per-channel edge weights (UnionSNN); stay sparse
+            m = h[self.edge_index[0]] if weight is None else h[self.edge_index[0]] * weight
+            return SCATTER[aggr](m, self.edge_index[1], h.size(0))
+
+        H = self.to_dense(h)
+        A = self.adj(None if weight is None else weight.view(-1).to(h.dtype), dtype=h.dtype)
+        out = self.from_dense(torch.bmm(A, H))
+
+        if aggr == 'mean':
+            out = out / self.in_degree.clamp(min=1).to(out.dtype).unsqueeze(1)
+        return out
+
+
+def select_dense_batch(exec_mode, edge_index, batch, num_graphs, max_nodes=128, min_nodes=16, min_degree=2.,
+                       per_channel=False):
+    """
+        DenseBatch for this batch if it should run dense, else None.
+        exec_mode is 'sparse', 'dense' or 'auto'; 'auto' goes dense when the largest graph
+        has between min_nodes and max_nodes nodes and the padded blocks hold at least
+        min_degree edges per row, and never for per_channel edge weights (which have no
+        dense form, see DenseBatch.aggregate).
+    """
+    if exec_mode == 'sparse' or (exec_mode == 'auto' and per_channel):
+        return None
+    dense = DenseBatch(edge_index, batch, num_graphs)
+    if exec_mode == 'dense':
+        return dense
+    if exec_mode == 'auto':
+        if min_nodes <= dense.n_max <= max_nodes and dense.row_degree() >= min_degree:
+            return dense
+        return None
+    raise KeyError('Execution mode {} not recognized.'.format(exec_mode))
@@ -0,0 +1,78 @@
+import torch
+import torch.nn as nn
+
+"""
+    Inference-time folding of eval-mode BatchNorm into the preceding linear map
+    BN(x W^T + b) = x (s * W)^T + (b - mean) * s + beta, with s = gamma / sqrt(var + eps)
+"""
+
+
+def _bn_scale_shift(bn):
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+    return scale, shift
+
+
+@torch.no_grad()
+def fold_batch_norm(linear, bn):
+    """
+        nn.Linear equal to bn(linear(x)) with bn in eval mode
+    """
+    scale, shift = _bn_scale_shift(bn)
+    fused = nn.Linear(linear.in_features, linear.out_features, bias=True).to(linear.weight)
+    fused.weight.copy_(linear.weight * scale.unsqueeze(1))
+    bias = linear.bias if linear.bias is not None else torch.zeros_like(shift)
+    fused.bias.copy_(bias * scale + shift)
+    return fused
+
+
+@torch.no_grad()
+def fold_batch_norm_graph_conv(conv, bn):
+    """
+        Fold bn into a DGL GraphConv in place; the conv weight is [in, out] and
+        the bias is added after the (linear) normalised aggregation
+    """
+    scale, shift = _bn_scale_shift(bn)
+    conv.weight.mul_(scale.unsqueeze(0))
+    if conv.bias is None:
+        conv.bias = nn.Parameter(shift.clone())
+    else:
+        conv.bias.copy_(conv.bias * scale + shift)
+
+
+def fuse_mlp(mlp):
+    """
+        Fold the hidden BatchNorms of a GIN-style MLP (layers.gin_layer / layers.unionsnn_layer) in place
+    """
+    if mlp.linear_or_not:
+        return
+    for i in range(mlp.num_layers - 1):
+        mlp.linears[i] = fold_batch_norm(mlp.linears[i], mlp.batch_norms[i])
+        mlp.batch_norms[i] = nn.Identity()
+
+
+def fuse_mlp_output(mlp, bn):
+    # fold a BatchNorm that follows the MLP into its output layer
+    if mlp.linear_or_not:
+        mlp.linear = fold_batch_norm(mlp.linear, bn)
+    else:
+        mlp.linears[-1] = fold_batch_norm(mlp.linears[-1], bn)
+
+
+@torch.no_grad()
+def check_equivalence(reference, fused, inputs, rtol=1e-4, atol=1e-5):
+    """
+        Run both models (eval mode) on the same inputs; returns the max abs difference
+        and raises an AssertionError if the outputs are not close
+    """
+    reference.eval()
+    fused.eval()
+    expected = reference(*inputs)
+    output = fused(*inputs)
+    max_diff = (output - expected).abs().max().item()
+    if not torch.allclose(output, expected, rtol=rtol, atol=atol):
+        raise AssertionError('Fused model differs from the reference by up to {:.3e}'.format(max_diff))
+    return max_diff
@@ -6,6 +6,9 @@ import dgl
 import dgl.function as fn
 from dgl.nn.pytorch import GraphConv
 
+from layers.fusion import fold_batch_norm, fold_batch_norm_graph_conv
+from layers.scatter_ops import aggregate
+
 """
     GCN: Graph Convolutional Networks
     Thomas N. Kipf, Max Welling, Semi-Supervised Classification with Graph Convolutional Networks (ICLR 2017)
@@ -66,8 +69,35 @@ class GCNLayer(nn.Module):
         else:
             h = self.conv(g, feature)
 
+        return self.node_update(h, h_in)
+
+    def forward_tensors(self, feature, edge_index, edge_weight, dense=None):
+        """
+            Same as forward() on plain tensors: edge_index [2, E] holds (src, dst)
+            and edge_weight [E, 1] the edge weights (edata['weight']).
+            With a DenseBatch, the aggregation runs on padded adjacency blocks.
+        """
+        h_in = feature   # to be used for residual connection
+
+        if self.e_feat or self.dgl_builtin == False:
+            h = aggregate(feature, edge_index, edge_weight if self.e_feat else None, 'mean', dense)
+            h = self.apply_mod.linear(h)
+        else:
+            # GraphConv with norm='both': D_in^-1/2 A D_out^-1/2 X W + b
+            num_nodes = feature.size(0)
+            deg_out = torch.bincount(edge_index[0], minlength=num_nodes).clamp(min=1).to(feature.dtype)
+            deg_in = torch.bincount(edge_index[1], minlength=num_nodes).clamp(min=1).to(feature.dtype)
+            h = torch.matmul(feature * deg_out.pow(-0.5).unsqueeze(1), self.conv.weight)
+            h = aggregate(h, edge_index, None, 'sum', dense)
+            h = h * deg_in.pow(-0.5).unsqueeze(1)
+            if self.conv.bias is not None:
+                h = h + self.conv.bias
+
+        return self.node_update(h, h_in)
+
+    def node_update(self, h, h_in):
         if self.batch_norm:
-            h = self.batchnorm_h(h) # batch normalization  
+            h = self.batchnorm_h(h.float()) # batch normalization, in fp32 under autocast
        
         if self.activation:
             h = self.activation(h)
@@ -77,6 +107,19 @@ class GCNLayer(nn.Module):
             
         h = self.dropout(h)
         return h
+
+    def fuse_for_inference(self):
+        """
+            Eval only, in place: fold batchnorm_h into the linear map that precedes it and drop dropout
+        """
+        if self.batch_norm:
+            if self.e_feat or self.dgl_builtin == False:
+                self.apply_mod.linear = fold_batch_norm(self.apply_mod.linear, self.batchnorm_h)
+            else:
+                fold_batch_norm_graph_conv(self.conv, self.batchnorm_h)
+            self.batchnorm_h = nn.Identity()
+            self.batch_norm = False
+        self.dropout = nn.Identity()
     
     def __repr__(self):
         return '{}(in_channels={}, out_channels={}, residual={})'.format(self.__class__.__name__,
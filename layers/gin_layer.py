@@ -3,6 +3,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import dgl.function as fn
 
+from layers.fusion import fuse_mlp, fuse_mlp_output
+from layers.scatter_ops import aggregate
+
 """
     GIN: Graph Isomorphism Networks
     HOW POWERFUL ARE GRAPH NEURAL NETWORKS? (Keyulu Xu, Weihua Hu, Jure Leskovec and Stefanie Jegelka, ICLR 2019)
@@ -46,6 +49,7 @@ class GINLayer(nn.Module):
             self._reducer = fn.mean
         else:
             raise KeyError('Aggregator type {} not recognized.'.format(aggr_type))
+        self.aggr_type = aggr_type
             
         self.batch_norm = batch_norm
         self.residual = residual
@@ -73,12 +77,26 @@ class GINLayer(nn.Module):
         g = g.local_var()
         g.ndata['h'] = h
         g.update_all(self.message_func, self._reducer('m', 'neigh'))
-        h = (1 + self.eps) * h + g.ndata['neigh']
+        return self.node_update(h, g.ndata['neigh'], h_in)
+
+    def forward_tensors(self, h, edge_index, edge_weight, dense=None):
+        """
+            Same as forward() on plain tensors: edge_index [2, E] holds (src, dst)
+            and edge_weight [E, 1] the edge weights (edata['weight']).
+            With a DenseBatch, the aggregation runs on padded adjacency blocks.
+        """
+        h_in = h # for residual connection
+
+        neigh = aggregate(h, edge_index, edge_weight if self.e_feat else None, self.aggr_type, dense)
+        return self.node_update(h, neigh, h_in)
+
+    def node_update(self, h, neigh, h_in):
+        h = (1 + self.eps) * h + neigh
         if self.apply_func is not None:
             h = self.apply_func(h)
 
         if self.batch_norm:
-            h = self.bn_node_h(h) # batch normalization  
+            h = self.bn_node_h(h.float()) # batch normalization, in fp32 under autocast
        
         h = F.relu(h) # non-linear activation
         
@@ -88,8 +106,22 @@ class GINLayer(nn.Module):
         h = F.dropout(h, self.dropout, training=self.training)
         
         return h
-    
-    
+
+    def fuse_for_inference(self):
+        """
+            Eval only, in place: fold the MLP BatchNorms and bn_node_h into the MLP linear layers
+            and drop dropout (see nets' fuse_for_inference())
+        """
+        if self.apply_func is None:
+            return
+        fuse_mlp(self.apply_func.mlp)
+        if self.batch_norm:
+            fuse_mlp_output(self.apply_func.mlp, self.bn_node_h)
+            self.bn_node_h = nn.Identity()
+            self.batch_norm = False
+        self.dropout = 0
+
+
 class ApplyNodeFunc(nn.Module):
     """
         This class is used in class GINNet
@@ -141,5 +173,5 @@ class MLP(nn.Module):
             # If MLP
             h = x
             for i in range(self.num_layers - 1):
-                h = F.relu(self.batch_norms[i](self.linears[i](h)))
+                h = F.relu(self.batch_norms[i](self.linears[i](h).float()))
             return self.linears[-1](h)
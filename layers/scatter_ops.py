@@ -0,0 +1,67 @@
+import torch
+
+"""
+    Pure-PyTorch message passing and pooling on (edge_index, batch) tensors.
+    Used by the scatter backend of the nets; nothing in here needs DGL.
+"""
+
+
+def scatter_sum(src, index, dim_size):
+    out = src.new_zeros((dim_size,) + tuple(src.shape[1:]))
+    return out.index_add_(0, index, src)
+
+
+def scatter_mean(src, index, dim_size):
+    out = scatter_sum(src, index, dim_size)
+    count = src.new_zeros(dim_size).index_add_(0, index, src.new_ones(index.size(0)))
+    return out / count.clamp(min=1).view((-1,) + (1,) * (src.dim() - 1))
+
+
+def scatter_max(src, index, dim_size):
+    # rows that receive nothing stay 0, as with DGL's max reducer
+    out = src.new_zeros((dim_size,) + tuple(src.shape[1:]))
+    index = index.view((-1,) + (1,) * (src.dim() - 1)).expand_as(src)
+    return out.scatter_reduce(0, index, src, reduce='amax', include_self=False)
+
+
+def segment_softmax(src, index, num_segments):
+    """
+        Softmax of src [E, d] over dim 0 within every segment (rows sharing the same index),
+        computed with two scatter reductions instead of a loop over the segments
+    """
+    shape = (num_segments,) + tuple(src.shape[1:])
+    expanded = index.view((-1,) + (1,) * (src.dim() - 1)).expand_as(src)
+    seg_max = src.new_full(shape, float('-inf')).scatter_reduce(0, expanded, src, reduce='amax', include_self=True)
+    out = (src - seg_max.detach()[index]).exp()
+    return out / scatter_sum(out, index, num_segments)[index]
+
+
+SCATTER = {
+    'sum': scatter_sum,
+    'mean': scatter_mean,
+    'max': scatter_max,
+}
+
+
+def graph_tensors(g):
+    """
+        (edge_index [2, E], batch [N], num_graphs) of a batched DGLGraph,
+        where edge_index holds (src, dst) and batch maps every node to its graph
+    """
+    src, dst = g.edges()
+    batch_num_nodes = torch.as_tensor(g.batch_num_nodes(), device=src.device)
+    batch = torch.repeat_interleave(torch.arange(batch_num_nodes.size(0), device=src.device), batch_num_nodes)
+    return torch.stack([src, dst]).long(), batch, batch_num_nodes.size(0)
+
+
+def aggregate(h, edge_index, weight=None, aggr='sum', dense=None):
+    """
+        Aggregate the messages h[src] (* weight) at dst with the given reducer;
+        sparse with scatter ops, or as a batched dense matmul when a DenseBatch is given
+    """
+    if dense is not None:
+        return dense.aggregate(h, weight, aggr)
+    m = h[edge_index[0]]
+    if weight is not None:
+        m = m * weight
+    return SCATTER[aggr](m, edge_index[1], h.size(0))
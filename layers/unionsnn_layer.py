@@ -1,7 +1,15 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import dgl.function as fn
+import importlib.util
+
+from layers.fusion import fuse_mlp, fuse_mlp_output
+from layers.scatter_ops import SCATTER, aggregate, segment_softmax
+
+if importlib.util.find_spec("dgl") is not None:
+    import dgl.function as fn
+else:
+    fn = None   # without DGL only the scatter backend (forward_tensors) is available
 
 
 class UnionSNNLayer(nn.Module):
@@ -27,21 +35,22 @@ class UnionSNNLayer(nn.Module):
         Initial :math:`\epsilon` value, default: ``0``.
     learn_eps : bool, optional
         If True, :math:`\epsilon` will be a learnable parameter.
+    softmax_scope : optional
+        Edges the message weight softmax normalises over: ``batch`` (all edges of the batched
+        graph, default), ``graph`` (edges of the same graph) or ``dst`` (in-edges of the same node).
+        With ``graph`` or ``dst`` a graph's output does not depend on the rest of its batch.
     
     """
     def __init__(self, apply_func, aggr_type, dropout, batch_norm, residual=False, init_eps=0, learn_eps=False,
-                 e_feat=False, in_dim=None):
+                 e_feat=False, in_dim=None, softmax_scope='batch'):
         super().__init__()
         self.apply_func = apply_func
         
-        if aggr_type == 'sum':
-            self._reducer = fn.sum
-        elif aggr_type == 'max':
-            self._reducer = fn.max
-        elif aggr_type == 'mean':
-            self._reducer = fn.mean
-        else:
+        if aggr_type not in SCATTER:
             raise KeyError('Aggregator type {} not recognized.'.format(aggr_type))
+        self.aggr_type = aggr_type
+        if fn is not None:
+            self._reducer = getattr(fn, aggr_type)
             
         self.batch_norm = batch_norm
         self.residual = residual
@@ -57,6 +66,13 @@ class UnionSNNLayer(nn.Module):
         widths = [1, out_dim]
         self.w_mlp_out = create_wmlp(widths, out_dim, 1)
         self.softmax = nn.Softmax(dim=0)
+        if softmax_scope not in ['batch', 'graph', 'dst']:
+            raise KeyError('Softmax scope {} not recognized.'.format(softmax_scope))
+        self.softmax_scope = softmax_scope
+
+        # eval-time edge weight cache, filled by UnionSNNNet.precompute_edge_weights
+        self.cache_key = None
+        self._cache_version = None
         
         if in_dim != out_dim:
             self.residual = False
@@ -68,7 +84,8 @@ class UnionSNNLayer(nn.Module):
             self.register_buffer('eps', torch.FloatTensor([init_eps]))
             
         self.bn_node_h = nn.BatchNorm1d(out_dim)
-        self.message_func = fn.copy_u('h', 'm') if not e_feat else fn.u_mul_e('h', 'w', 'm')
+        if fn is not None:
+            self.message_func = fn.copy_u('h', 'm') if not e_feat else fn.u_mul_e('h', 'w', 'm')
 
     def forward(self, g, h):
         h_in = h # for residual connection
@@ -77,17 +94,89 @@ class UnionSNNLayer(nn.Module):
 
         # h = self.relu(self.lin(h))
         h = self.lin(h)
-        out_weight = self.w_mlp_out(g.edata['weight'])
-        g.edata['w'] = 1 + self.softmax(out_weight)
+        w = self.edge_weights(g.edata['weight'], *self._segments(g), cached=self.cached_weights(g.edata))
+        g.edata['w'] = w.to(h.dtype)
         g.ndata['h'] = h
         g.update_all(self.message_func, self._reducer('m', 'neigh'))
-        h = (1 + self.eps) * h + g.ndata['neigh']
+        return self.node_update(h, g.ndata['neigh'], h_in)
+
+    def forward_tensors(self, h, edge_index, edge_weight, dense=None, batch=None, cached=None):
+        """
+            Same as forward() on plain tensors: edge_index [2, E] holds (src, dst)
+            and edge_weight [E, 1] the union weights (edata['weight']).
+            With a DenseBatch, the aggregation runs on padded adjacency blocks.
+            batch [N] (node to graph) is needed for softmax_scope='graph';
+            cached holds this layer's precomputed edge weights (see cached_weights()), if any.
+        """
+        h_in = h # for residual connection
+
+        h = self.lin(h)
+        w = None
+        if self.e_feat:
+            if self.softmax_scope == 'graph':
+                # there are never more graphs than nodes, so N segments is always enough
+                segments = (batch[edge_index[1]], h.size(0))
+            elif self.softmax_scope == 'dst':
+                segments = (edge_index[1], h.size(0))
+            else:
+                segments = (None, None)
+            w = self.edge_weights(edge_weight, *segments, cached=cached).to(h.dtype)
+        neigh = aggregate(h, edge_index, w, self.aggr_type, dense)
+        return self.node_update(h, neigh, h_in)
+
+    def edge_weights(self, weight, segment=None, num_segments=None, cached=None):
+        # message weights from the union subgraph weights;
+        # softmax over all edges of the batch, or within each segment of edges, always in fp32
+        if cached is not None and segment is not None:
+            return cached
+        out_weight = (self.w_mlp_out(weight) if cached is None else cached).float()
+        if segment is None:
+            return 1 + self.softmax(out_weight)
+        return 1 + segment_softmax(out_weight, segment, num_segments)
+
+    def cacheable_edge_weights(self, weight, segment=None, num_segments=None):
+        """
+            The part of edge_weights() that only depends on the graph itself: the final
+            weights for the 'graph' and 'dst' scopes, the MLP output (before the batch-wide
+            softmax) for the 'batch' scope
+        """
+        if self.softmax_scope == 'batch':
+            return self.w_mlp_out(weight)
+        return self.edge_weights(weight, segment, num_segments)
+
+    def param_version(self):
+        # changes whenever the edge weight MLP is updated, reloaded or moved
+        return tuple((p.data_ptr(), p._version) for p in self.w_mlp_out.parameters())
+
+    def cached_weights(self, edata):
+        """
+            This layer's precomputed edge weights from edata, or None when training,
+            when there are none or when the parameters changed since they were computed
+        """
+        if self.training or self.cache_key is None or self.cache_key not in edata:
+            return None
+        if self._cache_version != self.param_version():
+            return None
+        return edata[self.cache_key]
+
+    def _segments(self, g):
+        # (segment id of every edge, number of segments) for the softmax scope on a batched DGLGraph
+        if self.softmax_scope == 'graph':
+            batch_num_edges = torch.as_tensor(g.batch_num_edges(), device=g.device)
+            return torch.repeat_interleave(torch.arange(batch_num_edges.size(0), device=g.device),
+                                           batch_num_edges), batch_num_edges.size(0)
+        if self.softmax_scope == 'dst':
+            return g.edges()[1].long(), g.num_nodes()
+        return None, None
+
+    def node_update(self, h, neigh, h_in):
+        h = (1 + self.eps) * h + neigh
         # h = 2 * self.eps * h + g.ndata['neigh']
         if self.apply_func is not None:
             h = self.apply_func(h)
 
         if self.batch_norm:
-            h = self.bn_node_h(h) # batch normalization  
+            h = self.bn_node_h(h.float()) # batch normalization, in fp32 under autocast
        
         h = F.relu(h) # non-linear activation
         
@@ -97,8 +186,22 @@ class UnionSNNLayer(nn.Module):
         h = F.dropout(h, self.dropout, training=self.training)
         
         return h
-    
-    
+
+    def fuse_for_inference(self):
+        """
+            Eval only, in place: fold the MLP BatchNorms and bn_node_h into the MLP linear layers
+            and drop dropout (see nets' fuse_for_inference())
+        """
+        if self.apply_func is None:
+            return
+        fuse_mlp(self.apply_func.mlp)
+        if self.batch_norm:
+            fuse_mlp_output(self.apply_func.mlp, self.bn_node_h)
+            self.bn_node_h = nn.Identity()
+            self.batch_norm = False
+        self.dropout = 0
+
+
 class ApplyNodeFunc(nn.Module):
     """
         This class is used in class GINNet
@@ -150,7 +253,7 @@ class MLP(nn.Module):
             # If MLP
             h = x
             for i in range(self.num_layers - 1):
-                h = F.relu(self.batch_norms[i](self.linears[i](h)))
+                h = F.relu(self.batch_norms[i](self.linears[i](h).float()))
             return self.linears[-1](h)
 
 
@@ -3,7 +3,7 @@ import os
 import socket
 import time
 import random
-import glob
+import functools
 import argparse, json
 import torch
 import torch.nn as nn
@@ -15,6 +15,14 @@ from tqdm import tqdm
 
 from nets.load_net import gnn_model # import GNNs
 from data.data import LoadData # import dataset
+from utils.compiled import CompiledStep
+from utils.checkpointing import checkpoint_report
+from utils.fold_scheduler import run_folds
+from utils.evaluation import EvalSchedule
+from utils.timing import PhaseTimer, timing_summary, add_totals
+from utils.profiling import Profiler
+from utils.memory import MemoryTracker
+from utils.checkpoint_manager import CheckpointManager, training_state, latest_checkpoint, set_rng_state
 
 
 def gpu_setup(use_gpu, gpu_id):
@@ -42,7 +50,181 @@ def view_model_param(MODEL_NAME, net_params):
     return total_param
 
 
-def train_val_pipeline(MODEL_NAME, DATASET_NAME, params, net_params, dirs):
+def train_val_split(MODEL_NAME, dataset, params, net_params, dirs, split_number):
+    """
+        Trains and evaluates the model on one train-val-test split of the TUs dataset
+    """
+    root_log_dir, root_ckpt_dir, write_file_name, write_config_file = dirs
+    device = net_params['device']
+    per_epoch_time = []
+
+    ckpt_dir = os.path.join(root_ckpt_dir, "RUN_" + str(split_number))
+    result_file = os.path.join(ckpt_dir, 'result.json')
+    if params.get('resume') and os.path.exists(result_file):
+        print("RUN NUMBER {} already finished, skipping".format(split_number))
+        with open(result_file) as f:
+            return json.load(f)
+
+    t0_split = time.time()
+    log_dir = os.path.join(root_log_dir, "RUN_" + str(split_number))
+    writer = SummaryWriter(log_dir=log_dir)
+
+    # setting seeds
+    random.seed(params['seed'])
+    np.random.seed(params['seed'])
+    torch.manual_seed(params['seed'])
+    if device.type == 'cuda':
+        torch.cuda.manual_seed(params['seed'])
+
+    print("RUN NUMBER: ", split_number)
+    trainset, valset, testset = dataset.train[split_number], dataset.val[split_number], dataset.test[split_number]
+    print("Training Graphs: ", len(trainset))
+    print("Validation Graphs: ", len(valset))
+    print("Test Graphs: ", len(testset))
+    print("Number of Classes: ", net_params['n_classes'])
+
+    model = gnn_model(MODEL_NAME, net_params)
+    model = model.to(device)
+    optimizer = optim.Adam(model.parameters(), lr=params['init_lr'], weight_decay=params['weight_decay'])
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min',
+                                                     factor=params['lr_reduce_factor'],
+                                                     patience=params['lr_schedule_patience'],
+                                                     verbose=True)
+
+    epoch_train_losses, epoch_val_losses = [], []
+    epoch_train_accs, epoch_val_accs = [], []
+
+    # batching exception for Diffpool
+    drop_last = True if MODEL_NAME == 'DiffPool' else False
+
+    from train_TUs_graph_classification import train_epoch_sparse as train_epoch, evaluate_network_sparse as evaluate_network
+    memory = dataset.memory
+    collate = memory.wrap('collate', dataset.collate)
+    train_loader = DataLoader(trainset, batch_size=params['batch_size'], shuffle=True, drop_last=drop_last, collate_fn=collate)
+    val_loader = DataLoader(valset, batch_size=params['batch_size'], shuffle=False, drop_last=drop_last, collate_fn=collate)
+    test_loader = DataLoader(testset, batch_size=params['batch_size'], shuffle=False, drop_last=drop_last, collate_fn=collate)
+    if split_number == 0:
+        memory.write_stages(writer)
+    compiled_step = CompiledStep(model, precision=params.get('precision', 'fp32')) if params.get('compile', False) else None
+    if net_params.get('checkpoint_layers', False) and split_number == 0:
+        batch_graphs, batch_labels = next(iter(val_loader))
+        print(checkpoint_report(model, batch_graphs.to(device), batch_labels.to(device), device))
+
+    eval_schedule = EvalSchedule(params.get('eval_policy', 'every'), params.get('eval_every', 1))
+    epoch_val_loss, epoch_val_acc, epoch_test_acc = float('nan'), float('nan'), float('nan')
+
+    # time per phase of the train and eval loops, to the writer and the results file
+    train_timer = PhaseTimer(device, params.get('timing', False))
+    eval_timer = PhaseTimer(device, params.get('timing', False))
+    profiler = None
+    if params.get('profile', False):
+        wait, warmup, active = params.get('profile_schedule', [1, 1, 3])
+        profiler = Profiler(os.path.join(log_dir, 'profile'), params.get('profile_epochs', [1]),
+                            params.get('profile_folds', [0]), wait, warmup, active, device)
+
+    checkpoints = CheckpointManager(ckpt_dir, params.get('keep_checkpoints', 3))
+    start_epoch = 0
+    epoch_peak_rss = []   # peak RSS (MB) of every epoch, with params['memory']
+    state = latest_checkpoint(ckpt_dir) if params.get('resume') else None
+    if state is not None:
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        eval_schedule.load_state_dict(state['eval_schedule'])
+        set_rng_state(state['rng'])
+        per_epoch_time = state['per_epoch_time']
+        train_timer.total, eval_timer.total = state['timing']['train'], state['timing']['eval']
+        t0_split -= state['elapsed']
+        epoch = state['epoch']
+        start_epoch = epoch + 1
+        print("Resuming RUN NUMBER {} after epoch {}".format(split_number, epoch))
+
+    with tqdm(range(start_epoch, params['epochs'])) as t:
+        for epoch in t:
+
+            t.set_description('Epoch %d' % epoch)
+
+            start = time.time()
+
+            if profiler is not None:
+                with profiler.epoch(model, split_number, epoch):
+                    epoch_train_loss, epoch_train_acc, optimizer = train_epoch(model, optimizer, device, profiler.wrap(train_loader), epoch,
+                                                                               compiled_step, params.get('precision', 'fp32'), train_timer)
+            else:
+                epoch_train_loss, epoch_train_acc, optimizer = train_epoch(model, optimizer, device, train_loader, epoch, compiled_step,
+                                                                           params.get('precision', 'fp32'), train_timer)
+
+            epoch_train_losses.append(epoch_train_loss)
+            epoch_train_accs.append(epoch_train_acc)
+            writer.add_scalar('train/_loss', epoch_train_loss, epoch)
+            writer.add_scalar('train/_acc', epoch_train_acc, epoch)
+            writer.add_scalar('learning_rate', optimizer.param_groups[0]['lr'], epoch)
+
+            evaluated = eval_schedule.evaluate_val(epoch, epoch_train_loss)
+            if evaluated:
+                epoch_val_loss, epoch_val_acc = evaluate_network(model, device, val_loader, epoch, eval_timer)
+                eval_schedule.update(model, epoch, epoch_val_loss)
+                epoch_val_losses.append(epoch_val_loss)
+                epoch_val_accs.append(epoch_val_acc)
+                writer.add_scalar('val/_loss', epoch_val_loss, epoch)
+                writer.add_scalar('val/_acc', epoch_val_acc, epoch)
+                if eval_schedule.evaluate_test():
+                    _, epoch_test_acc = evaluate_network(model, device, test_loader, epoch, eval_timer)
+                    writer.add_scalar('test/_acc', epoch_test_acc, epoch)
+            train_timer.end_epoch(writer, 'timing_train', epoch)
+            eval_timer.end_epoch(writer, 'timing_eval', epoch)
+            if memory.enabled:
+                epoch_peak_rss.append(memory.end_epoch(writer, epoch))
+
+            t.set_postfix(time=time.time()-start, lr=optimizer.param_groups[0]['lr'],
+                          train_loss=epoch_train_loss, val_loss=epoch_val_loss,
+                          train_acc=epoch_train_acc, val_acc=epoch_val_acc,
+                          test_acc=epoch_test_acc)
+
+            per_epoch_time.append(time.time()-start)
+
+            if evaluated:
+                scheduler.step(epoch_val_loss)
+
+            # Saving checkpoint (written in the background)
+            checkpoints.save(epoch, training_state(epoch, split_number, model, optimizer, scheduler,
+                                                   eval_schedule=eval_schedule.state_dict(),
+                                                   timing={'train': train_timer.total, 'eval': eval_timer.total},
+                                                   per_epoch_time=per_epoch_time, elapsed=time.time()-t0_split),
+                             epoch_val_loss if evaluated else None)
+
+            if evaluated and optimizer.param_groups[0]['lr'] < params['min_lr']:
+                print("\n!! LR EQUAL TO MIN LR SET.")
+                break
+
+            # Stop training after params['max_time'] hours
+            if time.time()-t0_split > params['max_time']*3600/10:       # Dividing max_time by 10, since there are 10 runs in TUs
+                print('-' * 89)
+                print("Max_time for one train-val-test split experiment elapsed {:.3f} hours, so stopping".format(params['max_time']/10))
+                break
+
+    best_epoch = eval_schedule.restore_best(model)
+    _, test_acc = evaluate_network(model, device, test_loader, epoch)
+    _, train_acc = evaluate_network(model, device, train_loader, epoch)
+
+    checkpoint = "LAST EPOCH" if best_epoch is None else "BEST VAL EPOCH {}".format(best_epoch)
+    print("Test Accuracy [{}]: {:.4f}".format(checkpoint, test_acc))
+    print("Train Accuracy [{}]: {:.4f}".format(checkpoint, train_acc))
+    print("Convergence Time (Epochs): {:.4f}".format(epoch))
+    if compiled_step is not None:
+        print(compiled_step.report())
+    writer.close()
+    checkpoints.close()
+
+    result = {'test_acc': test_acc, 'train_acc': train_acc, 'epoch': epoch,
+              'per_epoch_time': per_epoch_time, 'model': str(model),
+              'timing': {'train': train_timer.total, 'eval': eval_timer.total},
+              'peak_rss_mb': max(epoch_peak_rss, default=None)}
+    with open(result_file, 'w') as f:
+        json.dump(result, f)
+    return result
+
+def train_val_pipeline(MODEL_NAME, dataset, params, net_params, dirs):
     avg_test_acc = []
     avg_train_acc = []
     avg_convergence_epochs = []
@@ -50,7 +232,7 @@ def train_val_pipeline(MODEL_NAME, DATASET_NAME, params, net_params, dirs):
     t0 = time.time()
     per_epoch_time = []
 
-    dataset = LoadData(DATASET_NAME, preprocess=net_params['preprocess'])
+    DATASET_NAME = dataset.name
 
     if MODEL_NAME in ['GCN', 'GAT']:
         if net_params['self_loop']:
@@ -66,121 +248,214 @@ def train_val_pipeline(MODEL_NAME, DATASET_NAME, params, net_params, dirs):
     with open(write_config_file + '.txt', 'w') as f:
         f.write("""Dataset: {},\nModel: {}\n\nparams={}\n\nnet_params={}\n\n\nTotal Parameters: {}\n\n""".format(DATASET_NAME, MODEL_NAME, params, net_params, net_params['total_param']))
 
+    # Model definition next to the checkpoints, so that export.py can rebuild the net
+    if not os.path.exists(root_ckpt_dir):
+        os.makedirs(root_ckpt_dir)
+    with open(os.path.join(root_ckpt_dir, 'net_params.json'), 'w') as f:
+        json.dump({'model': MODEL_NAME, 'dataset': DATASET_NAME, 'task': 'TUs',
+                   'net_params': {k: v for k, v in net_params.items() if k != 'device'}},
+                  f, indent=2, default=lambda v: v.item())
+
+    if params.get('fold_ensemble', False):
+        return train_val_pipeline_folds(MODEL_NAME, dataset, params, net_params, dirs)
+
+    train_split = functools.partial(train_val_split, MODEL_NAME, dataset, params, net_params, dirs)
+    results = {}
+    timing = {'train': {}, 'eval': {}}
     # At any point you can hit Ctrl + C to break out of training early.
     try:
-        for split_number in range(10):
-            t0_split = time.time()
-            log_dir = os.path.join(root_log_dir, "RUN_" + str(split_number))
-            writer = SummaryWriter(log_dir=log_dir)
-
-            # setting seeds
-            random.seed(params['seed'])
-            np.random.seed(params['seed'])
-            torch.manual_seed(params['seed'])
-            if device.type == 'cuda':
-                torch.cuda.manual_seed(params['seed'])
-
-            print("RUN NUMBER: ", split_number)
-            trainset, valset, testset = dataset.train[split_number], dataset.val[split_number], dataset.test[split_number]
-            print("Training Graphs: ", len(trainset))
-            print("Validation Graphs: ", len(valset))
-            print("Test Graphs: ", len(testset))
-            print("Number of Classes: ", net_params['n_classes'])
-
-            model = gnn_model(MODEL_NAME, net_params)
-            model = model.to(device)
-            optimizer = optim.Adam(model.parameters(), lr=params['init_lr'], weight_decay=params['weight_decay'])
-            scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min',
-                                                             factor=params['lr_reduce_factor'],
-                                                             patience=params['lr_schedule_patience'],
-                                                             verbose=True)
-
-            epoch_train_losses, epoch_val_losses = [], []
-            epoch_train_accs, epoch_val_accs = [], []
-
-            # batching exception for Diffpool
-            drop_last = True if MODEL_NAME == 'DiffPool' else False
-
-            from train_TUs_graph_classification import train_epoch_sparse as train_epoch, evaluate_network_sparse as evaluate_network
-            train_loader = DataLoader(trainset, batch_size=params['batch_size'], shuffle=True, drop_last=drop_last, collate_fn=dataset.collate)
-            val_loader = DataLoader(valset, batch_size=params['batch_size'], shuffle=False, drop_last=drop_last, collate_fn=dataset.collate)
-            test_loader = DataLoader(testset, batch_size=params['batch_size'], shuffle=False, drop_last=drop_last, collate_fn=dataset.collate)
-
-            with tqdm(range(params['epochs'])) as t:
-                for epoch in t:
-
-                    t.set_description('Epoch %d' % epoch)
-
-                    start = time.time()
-
-                    epoch_train_loss, epoch_train_acc, optimizer = train_epoch(model, optimizer, device, train_loader, epoch)
-
-                    # _, epoch_train_acc = evaluate_network(model, device, val_loader, epoch)
-                    epoch_val_loss, epoch_val_acc = evaluate_network(model, device, val_loader, epoch)
-                    _, epoch_test_acc = evaluate_network(model, device, test_loader, epoch)
-
-                    epoch_train_losses.append(epoch_train_loss)
-                    epoch_val_losses.append(epoch_val_loss)
-                    epoch_train_accs.append(epoch_train_acc)
-                    epoch_val_accs.append(epoch_val_acc)
+        fold_workers = params.get('fold_workers', 1)
+        if fold_workers > 1 and device.type == 'cuda':
+            print("[!] fold_workers needs CPU training (workers are forked), running the splits one after the other.")
+            fold_workers = 1
+        if fold_workers > 1:
+            for split_number, result in run_folds(train_split, list(range(10)), fold_workers):
+                print("RUN {} done: test acc {:.4f}".format(split_number, result['test_acc']))
+                results[split_number] = result
+        else:
+            for split_number in range(10):
+                results[split_number] = train_split(split_number)
+
+    except KeyboardInterrupt:
+        print('-' * 89)
+        print('Exiting from training early because of KeyboardInterrupt')
+
+    for split_number in sorted(results):
+        avg_test_acc.append(results[split_number]['test_acc'])
+        avg_train_acc.append(results[split_number]['train_acc'])
+        avg_convergence_epochs.append(results[split_number]['epoch'])
+        per_epoch_time.extend(results[split_number]['per_epoch_time'])
+        model = results[split_number]['model']
+        for phase in ['train', 'eval']:
+            add_totals(timing[phase], results[split_number]['timing'][phase])
+
+    print("TOTAL TIME TAKEN: {:.4f}hrs".format((time.time()-t0)/3600))
+    print("AVG TIME PER EPOCH: {:.4f}s".format(np.mean(per_epoch_time)))
+    print("AVG CONVERGENCE Time (Epochs): {:.4f}".format(np.mean(np.array(avg_convergence_epochs))))
+    # Final test accuracy value averaged over 10-fold
+    print("""\n\n\nFINAL RESULTS\n\nTEST ACCURACY averaged: {:.4f} with s.d. {:.4f}"""          .format(np.mean(np.array(avg_test_acc))*100, np.std(avg_test_acc)*100))
+    print("\nAll splits Test Accuracies:\n", avg_test_acc)
+    print("""\n\n\nFINAL RESULTS\n\nTRAIN ACCURACY averaged: {:.4f} with s.d. {:.4f}"""          .format(np.mean(np.array(avg_train_acc))*100, np.std(avg_train_acc)*100))
+    print("\nAll splits Train Accuracies:\n", avg_train_acc)
+
+    """
+        Write the results in out/results folder
+    """
+    with open(write_file_name + '.txt', 'w') as f:
+        f.write("""Dataset: {},\nModel: {}\n\nparams={}\n\nnet_params={}\n\n{}\n\nTotal Parameters: {}\n\n
+    FINAL RESULTS\nTEST ACCURACY averaged: {:.4f} with s.d. {:.4f}\nTRAIN ACCURACY averaged: {:.4f} with s.d. {:.4f}\n\n
+    Average Convergence Time (Epochs): {:.4f} with s.d. {:.4f}\nTotal Time Taken: {:.4f} hrs\nAverage Time Per Epoch: {:.4f} s\n\n\nAll Splits Test Accuracies: {}""" \
+                .format(DATASET_NAME, MODEL_NAME, params, net_params, model, net_params['total_param'],
+                        np.mean(np.array(avg_test_acc))*100, np.std(avg_test_acc)*100,
+                        np.mean(np.array(avg_train_acc))*100, np.std(avg_train_acc)*100,
+                        np.mean(avg_convergence_epochs), np.std(avg_convergence_epochs),
+                        (time.time()-t0)/3600, np.mean(per_epoch_time), avg_test_acc))
+        if params.get('timing', False):
+            f.write("\n\n\nTIME PER PHASE (all splits)\n\nTraining:\n{}\n\nEvaluation:\n{}\n".format(
+                timing_summary(timing['train']), timing_summary(timing['eval'])))
+        if dataset.memory.enabled:
+            f.write("\n\n\nMEMORY\n\n{}\n\nPeak RSS per split (MB): {}\n".format(
+                dataset.memory.summary(), [results[split_number].get('peak_rss_mb') for split_number in sorted(results)]))
+
+    if params.get('timing', False):
+        print("\nTraining time per phase:\n{}\n\nEvaluation time per phase:\n{}".format(
+            timing_summary(timing['train']), timing_summary(timing['eval'])))
+
+
+def train_val_pipeline_folds(MODEL_NAME, dataset, params, net_params, dirs):
+    """
+        The 10 train-val-test splits trained side by side as one FoldEnsemble: every fold
+        keeps its own model, optimizer, LR schedule, evaluation schedule and stopping epoch,
+        as in train_val_pipeline
+    """
+    from nets.fold_ensemble import FoldEnsemble
+    from train_TUs_graph_classification import train_epoch_ensemble, evaluate_network_ensemble
+
+    t0 = time.time()
+    per_epoch_time = []
+
+    DATASET_NAME = dataset.name
+    root_log_dir, root_ckpt_dir, write_file_name, write_config_file = dirs
+    device = net_params['device']
+    folds = list(range(10))
+
+    models, optimizers, schedulers, writers = [], [], [], []
+    train_loaders, val_loaders, test_loaders = {}, {}, {}
+    for split_number in folds:
+        # same initialisation as the fold gets in train_val_pipeline
+        random.seed(params['seed'])
+        np.random.seed(params['seed'])
+        torch.manual_seed(params['seed'])
+        if device.type == 'cuda':
+            torch.cuda.manual_seed(params['seed'])
+
+        model = gnn_model(MODEL_NAME, net_params)
+        model = model.to(device)
+        optimizer = optim.Adam(model.parameters(), lr=params['init_lr'], weight_decay=params['weight_decay'])
+        models.append(model)
+        optimizers.append(optimizer)
+        schedulers.append(optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min',
+                                                               factor=params['lr_reduce_factor'],
+                                                               patience=params['lr_schedule_patience'],
+                                                               verbose=True))
+        writers.append(SummaryWriter(log_dir=os.path.join(root_log_dir, "RUN_" + str(split_number))))
+
+        trainset, valset, testset = dataset.train[split_number], dataset.val[split_number], dataset.test[split_number]
+        train_loaders[split_number] = DataLoader(trainset, batch_size=params['batch_size'], shuffle=True, collate_fn=dataset.collate)
+        val_loaders[split_number] = DataLoader(valset, batch_size=params['batch_size'], shuffle=False, collate_fn=dataset.collate)
+        test_loaders[split_number] = DataLoader(testset, batch_size=params['batch_size'], shuffle=False, collate_fn=dataset.collate)
+
+    ensemble = FoldEnsemble(models)
+    active = list(folds)
+    if params.get('resume'):
+        print("[!] --resume is not supported with fold_ensemble, training the splits from the start.")
+    checkpoints = [CheckpointManager(os.path.join(root_ckpt_dir, "RUN_" + str(split_number)), params.get('keep_checkpoints', 3))
+                   for split_number in folds]
+    convergence_epochs = {}
+    # every fold evaluates on its own schedule; last_val / last_test hold the latest (loss, acc) of each fold
+    eval_schedules = [EvalSchedule(params.get('eval_policy', 'every'), params.get('eval_every', 1)) for _ in folds]
+    last_val, last_test = {}, {}
+
+    # At any point you can hit Ctrl + C to break out of training early.
+    try:
+        with tqdm(range(params['epochs'])) as t:
+            for epoch in t:
+
+                t.set_description('Epoch %d' % epoch)
+
+                start = time.time()
+
+                train_results = train_epoch_ensemble(ensemble, optimizers, device, {f: train_loaders[f] for f in active}, epoch)
+                evaluated = [f for f in active if eval_schedules[f].evaluate_val(epoch, train_results[f][0])]
+                tested = [f for f in evaluated if eval_schedules[f].evaluate_test()]
+                if evaluated:
+                    last_val.update(evaluate_network_ensemble(ensemble, device, {f: val_loaders[f] for f in evaluated}, epoch))
+                if tested:
+                    last_test.update(evaluate_network_ensemble(ensemble, device, {f: test_loaders[f] for f in tested}, epoch))
+
+                for split_number in list(active):
+                    epoch_train_loss, epoch_train_acc = train_results[split_number]
+                    optimizer, writer = optimizers[split_number], writers[split_number]
 
                     writer.add_scalar('train/_loss', epoch_train_loss, epoch)
-                    writer.add_scalar('val/_loss', epoch_val_loss, epoch)
                     writer.add_scalar('train/_acc', epoch_train_acc, epoch)
-                    writer.add_scalar('val/_acc', epoch_val_acc, epoch)
-                    writer.add_scalar('test/_acc', epoch_test_acc, epoch)
                     writer.add_scalar('learning_rate', optimizer.param_groups[0]['lr'], epoch)
-
-                    _, epoch_test_acc = evaluate_network(model, device, test_loader, epoch)
-                    t.set_postfix(time=time.time()-start, lr=optimizer.param_groups[0]['lr'],
-                                  train_loss=epoch_train_loss, val_loss=epoch_val_loss,
-                                  train_acc=epoch_train_acc, val_acc=epoch_val_acc,
-                                  test_acc=epoch_test_acc)
-
-                    per_epoch_time.append(time.time()-start)
-
-                    # Saving checkpoint
-                    ckpt_dir = os.path.join(root_ckpt_dir, "RUN_" + str(split_number))
-                    if not os.path.exists(ckpt_dir):
-                        os.makedirs(ckpt_dir)
-                    torch.save(model.state_dict(), '{}.pkl'.format(ckpt_dir + "/epoch_" + str(epoch)))
-
-                    files = glob.glob(ckpt_dir + '/*.pkl')
-                    for file in files:
-                        epoch_nb = file.split('_')[-1]
-                        epoch_nb = int(epoch_nb.split('.')[0])
-                        if epoch_nb < epoch-1:
-                            os.remove(file)
-
-                    scheduler.step(epoch_val_loss)
-
-                    if optimizer.param_groups[0]['lr'] < params['min_lr']:
-                        print("\n!! LR EQUAL TO MIN LR SET.")
-                        break
-
-                    # Stop training after params['max_time'] hours
-                    if time.time()-t0_split > params['max_time']*3600/10:       # Dividing max_time by 10, since there are 10 runs in TUs
-                        print('-' * 89)
-                        print("Max_time for one train-val-test split experiment elapsed {:.3f} hours, so stopping".format(params['max_time']/10))
-                        break
-
-            _, test_acc = evaluate_network(model, device, test_loader, epoch)
-            _, train_acc = evaluate_network(model, device, train_loader, epoch)
-            avg_test_acc.append(test_acc)
-            avg_train_acc.append(train_acc)
-            avg_convergence_epochs.append(epoch)
-
-            print("Test Accuracy [LAST EPOCH]: {:.4f}".format(test_acc))
-            print("Train Accuracy [LAST EPOCH]: {:.4f}".format(train_acc))
-            print("Convergence Time (Epochs): {:.4f}".format(epoch))
+                    epoch_val_loss = None
+                    if split_number in evaluated:
+                        epoch_val_loss, epoch_val_acc = last_val[split_number]
+                        writer.add_scalar('val/_loss', epoch_val_loss, epoch)
+                        writer.add_scalar('val/_acc', epoch_val_acc, epoch)
+                        eval_schedules[split_number].update(models[split_number], epoch, epoch_val_loss)
+                        schedulers[split_number].step(epoch_val_loss)
+                    if split_number in tested:
+                        writer.add_scalar('test/_acc', last_test[split_number][1], epoch)
+
+                    # Saving checkpoint (written in the background)
+                    checkpoints[split_number].save(epoch, training_state(epoch, split_number, models[split_number], optimizer,
+                                                                         schedulers[split_number],
+                                                                         eval_schedule=eval_schedules[split_number].state_dict()),
+                                                   epoch_val_loss)
+                    convergence_epochs[split_number] = epoch
+
+                    if split_number in evaluated and optimizer.param_groups[0]['lr'] < params['min_lr']:
+                        print("\n!! LR EQUAL TO MIN LR SET FOR RUN {}.".format(split_number))
+                        active.remove(split_number)
+
+                t.set_postfix(time=time.time()-start, folds=len(active),
+                              train_acc=np.mean([acc for _, acc in train_results.values()]),
+                              val_acc=np.mean([acc for _, acc in last_val.values()]) if last_val else float('nan'),
+                              test_acc=np.mean([acc for _, acc in last_test.values()]) if last_test else float('nan'))
+
+                per_epoch_time.append(time.time()-start)
+
+                if not active:
+                    break
+
+                # Stop training after params['max_time'] hours, the budget of all 10 runs together
+                if time.time()-t0 > params['max_time']*3600:
+                    print('-' * 89)
+                    print("Max_time for all train-val-test split experiments elapsed {:.3f} hours, so stopping".format(params['max_time']))
+                    break
 
     except KeyboardInterrupt:
         print('-' * 89)
         print('Exiting from training early because of KeyboardInterrupt')
 
+    # Final test on the weights of each fold's best val epoch ('best' policy), else on the last ones
+    for split_number in folds:
+        eval_schedules[split_number].restore_best(models[split_number])
+    test_results = evaluate_network_ensemble(ensemble, device, test_loaders, epoch)
+    train_results = evaluate_network_ensemble(ensemble, device, train_loaders, epoch)
+    avg_test_acc = [test_results[f][1] for f in folds]
+    avg_train_acc = [train_results[f][1] for f in folds]
+    avg_convergence_epochs = [convergence_epochs.get(f, 0) for f in folds]
+    for writer in writers:
+        writer.close()
+    for manager in checkpoints:
+        manager.close()
 
     print("TOTAL TIME TAKEN: {:.4f}hrs".format((time.time()-t0)/3600))
-    print("AVG TIME PER EPOCH: {:.4f}s".format(np.mean(per_epoch_time)))
+    print("AVG TIME PER EPOCH (all folds): {:.4f}s".format(np.mean(per_epoch_time)))
     print("AVG CONVERGENCE Time (Epochs): {:.4f}".format(np.mean(np.array(avg_convergence_epochs))))
     # Final test accuracy value averaged over 10-fold
     print("""\n\n\nFINAL RESULTS\n\nTEST ACCURACY averaged: {:.4f} with s.d. {:.4f}"""          .format(np.mean(np.array(avg_test_acc))*100, np.std(avg_test_acc)*100))
@@ -188,8 +463,6 @@ def train_val_pipeline(MODEL_NAME, DATASET_NAME, params, net_params, dirs):
     print("""\n\n\nFINAL RESULTS\n\nTRAIN ACCURACY averaged: {:.4f} with s.d. {:.4f}"""          .format(np.mean(np.array(avg_train_acc))*100, np.std(avg_train_acc)*100))
     print("\nAll splits Train Accuracies:\n", avg_train_acc)
 
-    writer.close()
-
     """
         Write the results in out/results folder
     """
@@ -197,7 +470,7 @@ def train_val_pipeline(MODEL_NAME, DATASET_NAME, params, net_params, dirs):
         f.write("""Dataset: {},\nModel: {}\n\nparams={}\n\nnet_params={}\n\n{}\n\nTotal Parameters: {}\n\n
     FINAL RESULTS\nTEST ACCURACY averaged: {:.4f} with s.d. {:.4f}\nTRAIN ACCURACY averaged: {:.4f} with s.d. {:.4f}\n\n
     Average Convergence Time (Epochs): {:.4f} with s.d. {:.4f}\nTotal Time Taken: {:.4f} hrs\nAverage Time Per Epoch: {:.4f} s\n\n\nAll Splits Test Accuracies: {}""" \
-                .format(DATASET_NAME, MODEL_NAME, params, net_params, model, net_params['total_param'],
+                .format(DATASET_NAME, MODEL_NAME, params, net_params, models[0], net_params['total_param'],
                         np.mean(np.array(avg_test_acc))*100, np.std(avg_test_acc)*100,
                         np.mean(np.array(avg_train_acc))*100, np.std(avg_train_acc)*100,
                         np.mean(avg_convergence_epochs), np.std(avg_convergence_epochs),
@@ -246,8 +519,29 @@ def main():
     parser.add_argument('--cat', help="Please give a value for cat")
     parser.add_argument('--self_loop', help="Please give a value for self_loop")
     parser.add_argument('--max_time', help="Please give a value for max_time")
+    parser.add_argument('--compile', help="Please give a value for compile (torch.compile the training step)")
+    parser.add_argument('--precision', help="Please give a value for precision (fp32 or bf16)")
     parser.add_argument('--optimizer', help="Please choose an optimizer", default='Adam')
     parser.add_argument('--preprocess', default='original')
+    parser.add_argument('--backend', help="Please give a value for backend (dgl or scatter)")
+    parser.add_argument('--exec_mode', help="Please give a value for exec_mode (sparse, dense or auto)")
+    parser.add_argument('--softmax_scope', help="Please give a value for softmax_scope (batch, graph or dst)")
+    parser.add_argument('--fused_readout', help="Please give a value for fused_readout")
+    parser.add_argument('--checkpoint_layers', help="Please give a value for checkpoint_layers")
+    parser.add_argument('--fold_ensemble', help="Please give a value for fold_ensemble (train the 10 splits together)")
+    parser.add_argument('--fold_workers', help="Please give a value for fold_workers (processes running the splits)")
+    parser.add_argument('--eval_policy', help="Please give a value for eval_policy (every, plateau or best)")
+    parser.add_argument('--eval_every', help="Please give a value for eval_every (epochs between evaluations)")
+    parser.add_argument('--keep_checkpoints', help="Please give a value for keep_checkpoints (best checkpoints kept per run)")
+    parser.add_argument('--resume', help="Please give the checkpoint directory of the run to resume")
+    parser.add_argument('--timing', help="Please give a value for timing (time per phase of the train and eval loops)")
+    parser.add_argument('--profile', help="Please give a value for profile (torch.profiler traces of the training loop)")
+    parser.add_argument('--profile_epochs', help="Please give the epochs to profile (comma separated)")
+    parser.add_argument('--profile_folds', help="Please give the splits to profile (comma separated)")
+    parser.add_argument('--profile_schedule', help="Please give the profiler schedule as wait,warmup,active batches")
+    parser.add_argument('--memory', help="Please give a value for memory (peak memory per dataset stage and epoch)")
+    parser.add_argument('--memory_trace', help="Please give a value for memory_trace (tracemalloc snapshots per stage)")
+    parser.add_argument('--memory_budget', help="Please give a memory budget in MB (abort when the peak RSS exceeds it)")
     args = parser.parse_args()
     with open(args.config) as f:
         config = json.load(f)
@@ -266,7 +560,16 @@ def main():
         DATASET_NAME = args.dataset
     else:
         DATASET_NAME = config['dataset']
-    dataset = LoadData(DATASET_NAME, preprocess=args.preprocess)
+    # memory telemetry starts with the dataset, so these come before the other params
+    if args.memory is not None:
+        config['params']['memory'] = True if args.memory=='True' else False
+    if args.memory_trace is not None:
+        config['params']['memory_trace'] = True if args.memory_trace=='True' else False
+    if args.memory_budget is not None:
+        config['params']['memory_budget'] = float(args.memory_budget)
+    memory = MemoryTracker(device, config['params'].get('memory', False), config['params'].get('memory_budget'),
+                           config['params'].get('memory_trace', False))
+    dataset = LoadData(DATASET_NAME, preprocess=args.preprocess, memory=memory)
     if args.out_dir is not None:
         out_dir = args.out_dir
     else:
@@ -293,6 +596,32 @@ def main():
         params['print_epoch_interval'] = int(args.print_epoch_interval)
     if args.max_time is not None:
         params['max_time'] = float(args.max_time)
+    if args.compile is not None:
+        params['compile'] = True if args.compile=='True' else False
+    if args.precision is not None:
+        params['precision'] = args.precision
+    if args.fold_ensemble is not None:
+        params['fold_ensemble'] = True if args.fold_ensemble=='True' else False
+    if args.fold_workers is not None:
+        params['fold_workers'] = int(args.fold_workers)
+    if args.eval_policy is not None:
+        params['eval_policy'] = args.eval_policy
+    if args.eval_every is not None:
+        params['eval_every'] = int(args.eval_every)
+    if args.keep_checkpoints is not None:
+        params['keep_checkpoints'] = int(args.keep_checkpoints)
+    if args.resume is not None:
+        params['resume'] = args.resume
+    if args.timing is not None:
+        params['timing'] = True if args.timing=='True' else False
+    if args.profile is not None:
+        params['profile'] = True if args.profile=='True' else False
+    if args.profile_epochs is not None:
+        params['profile_epochs'] = [int(epoch) for epoch in args.profile_epochs.split(',')]
+    if args.profile_folds is not None:
+        params['profile_folds'] = [int(fold) for fold in args.profile_folds.split(',')]
+    if args.profile_schedule is not None:
+        params['profile_schedule'] = [int(steps) for steps in args.profile_schedule.split(',')]
     # network parameters
     net_params = config['net_params']
     if 'node_num' in dir(dataset):
@@ -348,6 +677,16 @@ def main():
         net_params['optimizer'] = args.optimizer
     if args.preprocess is not None:
         net_params['preprocess'] = args.preprocess
+    if args.backend is not None:
+        net_params['backend'] = args.backend
+    if args.exec_mode is not None:
+        net_params['exec_mode'] = args.exec_mode
+    if args.softmax_scope is not None:
+        net_params['softmax_scope'] = args.softmax_scope
+    if args.fused_readout is not None:
+        net_params['fused_readout'] = True if args.fused_readout=='True' else False
+    if args.checkpoint_layers is not None:
+        net_params['checkpoint_layers'] = True if args.checkpoint_layers=='True' else False
 
     # TUs
     net_params['in_dim'] = dataset.all.graph_lists[0].ndata['feat'][0].shape[0]
@@ -361,6 +700,8 @@ def main():
     root_ckpt_dir = out_dir + 'checkpoints/' + MODEL_NAME + "_" + DATASET_NAME + "_GPU" + str(config['gpu']['id']) + "_" + time.strftime('%Hh%Mm%Ss_on_%b_%d_%Y')
     write_file_name = out_dir + 'results/result_' + MODEL_NAME + "_" + DATASET_NAME + "_GPU" + str(config['gpu']['id']) + "_" + time.strftime('%Hh%Mm%Ss_on_%b_%d_%Y')
     write_config_file = out_dir + 'configs/config_' + MODEL_NAME + "_" + DATASET_NAME + "_GPU" + str(config['gpu']['id']) + "_" + time.strftime('%Hh%Mm%Ss_on_%b_%d_%Y')
+    if 'resume' in params:
+        root_ckpt_dir = params['resume'].rstrip('/')   # continue in the checkpoints of that run
     dirs = root_log_dir, root_ckpt_dir, write_file_name, write_config_file
 
     if not os.path.exists(out_dir + 'results'):
@@ -371,7 +712,7 @@ def main():
 
     # net_params['preprocess'] = 'original' #'shortest_path' #'line_graph' 'original'  # 'curvature'
     net_params['total_param'] = view_model_param(MODEL_NAME, net_params)
-    train_val_pipeline(MODEL_NAME, DATASET_NAME, params, net_params, dirs)
+    train_val_pipeline(MODEL_NAME, dataset, params, net_params, dirs)
 
 
 main()
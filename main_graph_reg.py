@@ -33,6 +33,15 @@ class DotDict(dict):
 """
 from nets.graph_reg.load_net import gnn_model # import all GNNS
 from data.data import LoadData # import dataset
+from utils.compiled import CompiledStep
+from utils.checkpointing import checkpoint_report
+from utils.evaluation import EvalSchedule
+from utils.timing import PhaseTimer, timing_summary
+from utils.profiling import Profiler
+from utils.memory import MemoryTracker
+from utils.checkpoint_manager import CheckpointManager, training_state, latest_checkpoint, set_rng_state
+from utils.distributed import (init_distributed, close_distributed, distributed_device, rank_and_world_size,
+                               is_main_process, main_process_first, distributed_model, shard, mean_over_ranks, any_rank)
 
 
 
@@ -87,14 +96,26 @@ def train_val_pipeline(MODEL_NAME, dataset, params, net_params, dirs):
 
     root_log_dir, root_ckpt_dir, write_file_name, write_config_file = dirs
     device = net_params['device']
-
-    # Write the network and optimization hyper-parameters in folder config/
-    with open(write_config_file + '.txt', 'w') as f:
-        f.write("""Dataset: {},\nModel: {}\n\nparams={}\n\nnet_params={}\n\n\nTotal Parameters: {}\n\n"""                .format
-            (DATASET_NAME, MODEL_NAME, params, net_params, net_params['total_param']))
-
-    log_dir = os.path.join(root_log_dir, "RUN_" + str(0))
-    writer = SummaryWriter(log_dir=log_dir)
+    # data-parallel over torchrun processes: only rank 0 logs and writes files
+    rank, world_size = rank_and_world_size()
+    main_process = is_main_process()
+
+    if main_process:
+        # Write the network and optimization hyper-parameters in folder config/
+        with open(write_config_file + '.txt', 'w') as f:
+            f.write("""Dataset: {},\nModel: {}\n\nparams={}\n\nnet_params={}\n\n\nTotal Parameters: {}\n\n"""                .format
+                (DATASET_NAME, MODEL_NAME, params, net_params, net_params['total_param']))
+
+        # Model definition next to the checkpoints, so that export.py can rebuild the net
+        if not os.path.exists(root_ckpt_dir):
+            os.makedirs(root_ckpt_dir)
+        with open(os.path.join(root_ckpt_dir, 'net_params.json'), 'w') as f:
+            json.dump({'model': MODEL_NAME, 'dataset': DATASET_NAME, 'task': 'graph_reg',
+                       'net_params': {k: v for k, v in net_params.items() if k != 'device'}},
+                      f, indent=2, default=lambda v: v.item())
+
+        log_dir = os.path.join(root_log_dir, "RUN_" + str(0))
+        writer = SummaryWriter(log_dir=log_dir)
 
     # setting seeds
     random.seed(params['seed'])
@@ -109,6 +130,13 @@ def train_val_pipeline(MODEL_NAME, dataset, params, net_params, dirs):
 
     model = gnn_model(MODEL_NAME, net_params)
     model = model.to(device)
+    net = model  # the model itself, for evaluation and checkpoints
+    if world_size > 1:
+        sync_batch_norm = params.get('sync_batch_norm', False)
+        if sync_batch_norm and device.type != 'cuda':
+            print("[!] SyncBatchNorm needs the GPU, normalising with the statistics of each rank's batches.")
+            sync_batch_norm = False
+        model = distributed_model(net, sync_batch_norm)
 
     optimizer = optim.Adam(model.parameters(), lr=params['init_lr'], weight_decay=params['weight_decay'])
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min',
@@ -124,35 +152,109 @@ def train_val_pipeline(MODEL_NAME, dataset, params, net_params, dirs):
 
     from train_molecules_graph_regression import train_epoch_sparse as train_epoch, evaluate_network_sparse as evaluate_network
 
-    train_loader = DataLoader(trainset, batch_size=params['batch_size'], shuffle=True, drop_last=drop_last, collate_fn=dataset.collate)
-    val_loader = DataLoader(valset, batch_size=params['batch_size'], shuffle=False, drop_last=drop_last, collate_fn=dataset.collate)
-    test_loader = DataLoader(testset, batch_size=params['batch_size'], shuffle=False, drop_last=drop_last, collate_fn=dataset.collate)
+    memory = dataset.memory
+    collate = memory.wrap('collate', dataset.collate)
+    if world_size > 1:
+        # every rank takes batch_size / world_size graphs of each step, so that one optimizer step
+        # still sees batch_size graphs; evaluation runs on disjoint shards, aggregated over the ranks
+        train_sampler = torch.utils.data.DistributedSampler(trainset, shuffle=True, seed=params['seed'], drop_last=drop_last)
+        train_loader = DataLoader(trainset, batch_size=max(params['batch_size'] // world_size, 1), sampler=train_sampler,
+                                  drop_last=drop_last, collate_fn=collate)
+        valset, testset = shard(valset, rank, world_size), shard(testset, rank, world_size)
+    else:
+        train_sampler = None
+        train_loader = DataLoader(trainset, batch_size=params['batch_size'], shuffle=True, drop_last=drop_last, collate_fn=collate)
+    val_loader = DataLoader(valset, batch_size=params['batch_size'], shuffle=False, drop_last=drop_last, collate_fn=collate)
+    test_loader = DataLoader(testset, batch_size=params['batch_size'], shuffle=False, drop_last=drop_last, collate_fn=collate)
+    memory.check('dataset construction')   # on all ranks together
+    if main_process:
+        memory.write_stages(writer)
+    if params.get('compile', False) and world_size > 1:
+        print("[!] The compiled training step bypasses DistributedDataParallel, training eagerly.")
+    compiled_step = CompiledStep(model, precision=params.get('precision', 'fp32')) \
+        if params.get('compile', False) and world_size == 1 else None
+    if net_params.get('checkpoint_layers', False) and main_process:
+        batch_graphs, batch_targets = next(iter(val_loader))
+        print(checkpoint_report(net, batch_graphs.to(device), batch_targets.to(device), device))
+
+    eval_schedule = EvalSchedule(params.get('eval_policy', 'every'), params.get('eval_every', 1))
+    epoch_val_loss, epoch_val_mae, epoch_test_mae = float('nan'), float('nan'), float('nan')
+
+    # time per phase of the train and eval loops, to the writer and the results file
+    train_timer = PhaseTimer(device, params.get('timing', False))
+    eval_timer = PhaseTimer(device, params.get('timing', False))
+    profiler = None
+    if params.get('profile', False) and main_process:
+        wait, warmup, active = params.get('profile_schedule', [1, 1, 3])
+        profiler = Profiler(os.path.join(log_dir, 'profile'), params.get('profile_epochs', [1]), None,
+                            wait, warmup, active, device)
+
+    ckpt_dir = os.path.join(root_ckpt_dir, "RUN_")
+    checkpoints = CheckpointManager(ckpt_dir, params.get('keep_checkpoints', 3)) if main_process else None
+    start_epoch = 0
+    state = latest_checkpoint(ckpt_dir) if params.get('resume') else None
+    if state is not None:   # on every rank
+        net.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        eval_schedule.load_state_dict(state['eval_schedule'])
+        set_rng_state(state['rng'])
+        per_epoch_time = state['per_epoch_time']
+        train_timer.total, eval_timer.total = state['timing']['train'], state['timing']['eval']
+        t0 -= state['elapsed']
+        epoch = state['epoch']
+        start_epoch = epoch + 1
+        print("Resuming after epoch {}".format(epoch))
 
     # At any point you can hit Ctrl + C to break out of training early.
     try:
-        with tqdm(range(params['epochs'])) as t:
+        with tqdm(range(start_epoch, params['epochs']), disable=not main_process) as t:
             for epoch in t:
 
                 t.set_description('Epoch %d' % epoch)
 
                 start = time.time()
 
-                epoch_train_loss, epoch_train_mae, optimizer = train_epoch(model, optimizer, device, train_loader, epoch)
-
-                epoch_val_loss, epoch_val_mae = evaluate_network(model, device, val_loader, epoch)
-                _, epoch_test_mae = evaluate_network(model, device, test_loader, epoch)
-
+                if train_sampler is not None:
+                    train_sampler.set_epoch(epoch)
+                if profiler is not None:
+                    with profiler.epoch(model, None, epoch):
+                        epoch_train_loss, epoch_train_mae, optimizer = train_epoch(model, optimizer, device, profiler.wrap(train_loader),
+                                                                                   epoch, compiled_step, params.get('precision', 'fp32'),
+                                                                                   train_timer)
+                else:
+                    epoch_train_loss, epoch_train_mae, optimizer = train_epoch(model, optimizer, device, train_loader, epoch,
+                                                                               compiled_step, params.get('precision', 'fp32'), train_timer)
+
+                # same values on every rank (no-ops when not distributed)
+                epoch_train_loss, epoch_train_mae = mean_over_ranks([epoch_train_loss, epoch_train_mae], len(train_loader))
                 epoch_train_losses.append(epoch_train_loss)
-                epoch_val_losses.append(epoch_val_loss)
                 epoch_train_MAEs.append(epoch_train_mae)
-                epoch_val_MAEs.append(epoch_val_mae)
-
-                writer.add_scalar('train/_loss', epoch_train_loss, epoch)
-                writer.add_scalar('val/_loss', epoch_val_loss, epoch)
-                writer.add_scalar('train/_mae', epoch_train_mae, epoch)
-                writer.add_scalar('val/_mae', epoch_val_mae, epoch)
-                writer.add_scalar('test/_mae', epoch_test_mae, epoch)
-                writer.add_scalar('learning_rate', optimizer.param_groups[0]['lr'], epoch)
+                if main_process:
+                    writer.add_scalar('train/_loss', epoch_train_loss, epoch)
+                    writer.add_scalar('train/_mae', epoch_train_mae, epoch)
+                    writer.add_scalar('learning_rate', optimizer.param_groups[0]['lr'], epoch)
+
+                evaluated = eval_schedule.evaluate_val(epoch, epoch_train_loss)
+                if evaluated:
+                    epoch_val_loss, epoch_val_mae = evaluate_network(net, device, val_loader, epoch, eval_timer)
+                    epoch_val_loss, epoch_val_mae = mean_over_ranks([epoch_val_loss, epoch_val_mae], len(val_loader))
+                    eval_schedule.update(net, epoch, epoch_val_loss)
+                    epoch_val_losses.append(epoch_val_loss)
+                    epoch_val_MAEs.append(epoch_val_mae)
+                    if main_process:
+                        writer.add_scalar('val/_loss', epoch_val_loss, epoch)
+                        writer.add_scalar('val/_mae', epoch_val_mae, epoch)
+                    if eval_schedule.evaluate_test():
+                        _, epoch_test_mae = evaluate_network(net, device, test_loader, epoch, eval_timer)
+                        epoch_test_mae, = mean_over_ranks([epoch_test_mae], len(test_loader))
+                        if main_process:
+                            writer.add_scalar('test/_mae', epoch_test_mae, epoch)
+                if main_process:   # rank 0's own times and throughput
+                    train_timer.end_epoch(writer, 'timing_train', epoch)
+                    eval_timer.end_epoch(writer, 'timing_eval', epoch)
+                # every rank checks its memory (the budget together), rank 0 writes its own
+                memory.end_epoch(writer if main_process else None, epoch)
 
 
                 t.set_postfix(time=time.time( ) -start, lr=optimizer.param_groups[0]['lr'],
@@ -163,27 +265,23 @@ def train_val_pipeline(MODEL_NAME, dataset, params, net_params, dirs):
 
                 per_epoch_time.append(time.time( ) -start)
 
-                # Saving checkpoint
-                ckpt_dir = os.path.join(root_ckpt_dir, "RUN_")
-                if not os.path.exists(ckpt_dir):
-                    os.makedirs(ckpt_dir)
-                torch.save(model.state_dict(), '{}.pkl'.format(ckpt_dir + "/epoch_" + str(epoch)))
+                if evaluated:
+                    scheduler.step(epoch_val_loss)
 
-                files = glob.glob(ckpt_dir + '/*.pkl')
-                for file in files:
-                    epoch_nb = file.split('_')[-1]
-                    epoch_nb = int(epoch_nb.split('.')[0])
-                    if epoch_nb < epoch -1:
-                        os.remove(file)
+                # Saving checkpoint (written in the background)
+                if main_process:
+                    checkpoints.save(epoch, training_state(epoch, None, net, optimizer, scheduler,
+                                                           eval_schedule=eval_schedule.state_dict(),
+                                                           timing={'train': train_timer.total, 'eval': eval_timer.total},
+                                                           per_epoch_time=per_epoch_time, elapsed=time.time( ) -t0),
+                                     epoch_val_loss if evaluated else None)
 
-                scheduler.step(epoch_val_loss)
-
-                if optimizer.param_groups[0]['lr'] < params['min_lr']:
+                if evaluated and optimizer.param_groups[0]['lr'] < params['min_lr']:
                     print("\n!! LR EQUAL TO MIN LR SET.")
                     break
 
                 # Stop training after params['max_time'] hours
-                if time.time( ) -t0 > params['max_time' ] *3600:
+                if any_rank(time.time( ) -t0 > params['max_time' ] *3600):
                     print('-' * 89)
                     print("Max_time for training elapsed {:.2f} hours, so stopping".format(params['max_time']))
                     break
@@ -192,11 +290,21 @@ def train_val_pipeline(MODEL_NAME, dataset, params, net_params, dirs):
         print('-' * 89)
         print('Exiting from training early because of KeyboardInterrupt')
 
-    _, test_mae = evaluate_network(model, device, test_loader, epoch)
-    _, train_mae = evaluate_network(model, device, train_loader, epoch)
+    best_epoch = eval_schedule.restore_best(net)
+    _, test_mae = evaluate_network(net, device, test_loader, epoch)
+    _, train_mae = evaluate_network(net, device, train_loader, epoch)
+    test_mae, = mean_over_ranks([test_mae], len(test_loader))
+    train_mae, = mean_over_ranks([train_mae], len(train_loader))
+    if not main_process:
+        return
+    checkpoints.close()
+    if best_epoch is not None:
+        print("Weights of the best val epoch {}".format(best_epoch))
     print("Test MAE: {:.4f}".format(test_mae))
     print("Train MAE: {:.4f}".format(train_mae))
     print("Convergence Time (Epochs): {:.4f}".format(epoch))
+    if compiled_step is not None:
+        print(compiled_step.report())
     print("TOTAL TIME TAKEN: {:.4f}s".format(time.time( ) -t0))
     print("AVG TIME PER EPOCH: {:.4f}s".format(np.mean(per_epoch_time)))
 
@@ -209,8 +317,17 @@ def train_val_pipeline(MODEL_NAME, dataset, params, net_params, dirs):
         f.write("""Dataset: {},\nModel: {}\n\nparams={}\n\nnet_params={}\n\n{}\n\nTotal Parameters: {}\n\n
     FINAL RESULTS\nTEST MAE: {:.4f}\nTRAIN MAE: {:.4f}\n\n
     Convergence Time (Epochs): {:.4f}\nTotal Time Taken: {:.4f} hrs\nAverage Time Per Epoch: {:.4f} s\n\n\n""" \
-                .format(DATASET_NAME, MODEL_NAME, params, net_params, model, net_params['total_param'],
+                .format(DATASET_NAME, MODEL_NAME, params, net_params, net, net_params['total_param'],
                         test_mae, train_mae, epoch, (time.time( ) -t0 ) /3600, np.mean(per_epoch_time)))
+        if params.get('timing', False):
+            f.write("TIME PER PHASE\n\nTraining:\n{}\n\nEvaluation:\n{}\n".format(
+                timing_summary(train_timer.total), timing_summary(eval_timer.total)))
+        if memory.enabled:
+            f.write("\n\nMEMORY\n\n{}\n".format(memory.summary()))
+
+    if params.get('timing', False):
+        print("\nTraining time per phase:\n{}\n\nEvaluation time per phase:\n{}".format(
+            timing_summary(train_timer.total), timing_summary(eval_timer.total)))
 
 
 
@@ -222,6 +339,9 @@ def main():
     """
 
 
+    # one process per rank when launched with torchrun, see utils/distributed.py
+    init_distributed()
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', help="Please give a config.json file with training/model/data/param details")
     parser.add_argument('--gpu_id', help="Please give a value for gpu id")
@@ -260,9 +380,28 @@ def main():
     parser.add_argument('--cat', help="Please give a value for cat")
     parser.add_argument('--self_loop', help="Please give a value for self_loop")
     parser.add_argument('--max_time', help="Please give a value for max_time")
+    parser.add_argument('--compile', help="Please give a value for compile (torch.compile the training step)")
+    parser.add_argument('--precision', help="Please give a value for precision (fp32 or bf16)")
     parser.add_argument('--pos_enc_dim', help="Please give a value for pos_enc_dim")
     parser.add_argument('--pos_enc', help="Please give a value for pos_enc")
     parser.add_argument('--preprocess', default='original')
+    parser.add_argument('--backend', help="Please give a value for backend (dgl or scatter)")
+    parser.add_argument('--exec_mode', help="Please give a value for exec_mode (sparse, dense or auto)")
+    parser.add_argument('--softmax_scope', help="Please give a value for softmax_scope (batch, graph or dst)")
+    parser.add_argument('--fused_readout', help="Please give a value for fused_readout")
+    parser.add_argument('--checkpoint_layers', help="Please give a value for checkpoint_layers")
+    parser.add_argument('--eval_policy', help="Please give a value for eval_policy (every, plateau or best)")
+    parser.add_argument('--eval_every', help="Please give a value for eval_every (epochs between evaluations)")
+    parser.add_argument('--keep_checkpoints', help="Please give a value for keep_checkpoints (best checkpoints kept)")
+    parser.add_argument('--resume', help="Please give the checkpoint directory of the run to resume")
+    parser.add_argument('--sync_batch_norm', help="Please give a value for sync_batch_norm (BatchNorm over the batches of all ranks)")
+    parser.add_argument('--timing', help="Please give a value for timing (time per phase of the train and eval loops)")
+    parser.add_argument('--profile', help="Please give a value for profile (torch.profiler traces of the training loop)")
+    parser.add_argument('--profile_epochs', help="Please give the epochs to profile (comma separated)")
+    parser.add_argument('--profile_schedule', help="Please give the profiler schedule as wait,warmup,active batches")
+    parser.add_argument('--memory', help="Please give a value for memory (peak memory per dataset stage and epoch)")
+    parser.add_argument('--memory_trace', help="Please give a value for memory_trace (tracemalloc snapshots per stage)")
+    parser.add_argument('--memory_budget', help="Please give a memory budget in MB (abort when the peak RSS exceeds it)")
     args = parser.parse_args()
     with open(args.config) as f:
         config = json.load(f)
@@ -271,7 +410,10 @@ def main():
     if args.gpu_id is not None:
         config['gpu']['id'] = int(args.gpu_id)
         config['gpu']['use'] = True
-    device = gpu_setup(config['gpu']['use'], config['gpu']['id'])
+    if rank_and_world_size()[1] > 1:
+        device = distributed_device(config['gpu']['use'])   # the GPU of the local rank, not gpu id
+    else:
+        device = gpu_setup(config['gpu']['use'], config['gpu']['id'])
     # model, dataset, out_dir
     if args.model is not None:
         MODEL_NAME = args.model
@@ -281,7 +423,18 @@ def main():
         DATASET_NAME = args.dataset
     else:
         DATASET_NAME = config['dataset']
-    dataset = LoadData(DATASET_NAME, preprocess=args.preprocess, graphsnn=(MODEL_NAME == 'GraphSNN'))
+    # memory telemetry starts with the dataset, so these come before the other params
+    if args.memory is not None:
+        config['params']['memory'] = True if args.memory=='True' else False
+    if args.memory_trace is not None:
+        config['params']['memory_trace'] = True if args.memory_trace=='True' else False
+    if args.memory_budget is not None:
+        config['params']['memory_budget'] = float(args.memory_budget)
+    memory = MemoryTracker(device, config['params'].get('memory', False), config['params'].get('memory_budget'),
+                           config['params'].get('memory_trace', False),
+                           any_rank=any_rank if rank_and_world_size()[1] > 1 else None)
+    with main_process_first():   # rank 0 preprocesses into the transform cache, the other ranks load it
+        dataset = LoadData(DATASET_NAME, preprocess=args.preprocess, graphsnn=(MODEL_NAME == 'GraphSNN'), memory=memory)
     if args.out_dir is not None:
         out_dir = args.out_dir
     else:
@@ -308,6 +461,28 @@ def main():
         params['print_epoch_interval'] = int(args.print_epoch_interval)
     if args.max_time is not None:
         params['max_time'] = float(args.max_time)
+    if args.compile is not None:
+        params['compile'] = True if args.compile=='True' else False
+    if args.precision is not None:
+        params['precision'] = args.precision
+    if args.eval_policy is not None:
+        params['eval_policy'] = args.eval_policy
+    if args.eval_every is not None:
+        params['eval_every'] = int(args.eval_every)
+    if args.keep_checkpoints is not None:
+        params['keep_checkpoints'] = int(args.keep_checkpoints)
+    if args.resume is not None:
+        params['resume'] = args.resume
+    if args.sync_batch_norm is not None:
+        params['sync_batch_norm'] = True if args.sync_batch_norm=='True' else False
+    if args.timing is not None:
+        params['timing'] = True if args.timing=='True' else False
+    if args.profile is not None:
+        params['profile'] = True if args.profile=='True' else False
+    if args.profile_epochs is not None:
+        params['profile_epochs'] = [int(epoch) for epoch in args.profile_epochs.split(',')]
+    if args.profile_schedule is not None:
+        params['profile_schedule'] = [int(steps) for steps in args.profile_schedule.split(',')]
     # network parameters
     net_params = config['net_params']
     net_params['device'] = device
@@ -363,6 +538,16 @@ def main():
         net_params['pos_enc_dim'] = int(args.pos_enc_dim)
     if args.preprocess is not None:
         net_params['preprocess'] = args.preprocess
+    if args.backend is not None:
+        net_params['backend'] = args.backend
+    if args.exec_mode is not None:
+        net_params['exec_mode'] = args.exec_mode
+    if args.softmax_scope is not None:
+        net_params['softmax_scope'] = args.softmax_scope
+    if args.fused_readout is not None:
+        net_params['fused_readout'] = True if args.fused_readout=='True' else False
+    if args.checkpoint_layers is not None:
+        net_params['checkpoint_layers'] = True if args.checkpoint_layers=='True' else False
 
 
     # ZINC
@@ -379,16 +564,22 @@ def main():
         (config['gpu']['id']) + "_" + time.strftime('%Hh%Mm%Ss_on_%b_%d_%Y')
     write_config_file = out_dir + 'configs/config_' + MODEL_NAME + "_" + DATASET_NAME + "_GPU" + str \
         (config['gpu']['id']) + "_" + time.strftime('%Hh%Mm%Ss_on_%b_%d_%Y')
+    if 'resume' in params:
+        root_ckpt_dir = params['resume'].rstrip('/')   # continue in the checkpoints of that run
     dirs = root_log_dir, root_ckpt_dir, write_file_name, write_config_file
 
-    if not os.path.exists(out_dir + 'results'):
-        os.makedirs(out_dir + 'results')
+    if is_main_process():
+        if not os.path.exists(out_dir + 'results'):
+            os.makedirs(out_dir + 'results')
 
-    if not os.path.exists(out_dir + 'configs'):
-        os.makedirs(out_dir + 'configs')
+        if not os.path.exists(out_dir + 'configs'):
+            os.makedirs(out_dir + 'configs')
 
     net_params['total_param'] = view_model_param(MODEL_NAME, net_params)
-    train_val_pipeline(MODEL_NAME, dataset, params, net_params, dirs)
+    try:
+        train_val_pipeline(MODEL_NAME, dataset, params, net_params, dirs)
+    finally:
+        close_distributed()
 
 
 main()
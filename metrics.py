@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from sklearn.metrics import confusion_matrix
 from sklearn.metrics import f1_score
 import numpy as np
 
@@ -32,33 +31,19 @@ def accuracy_CITATION_GRAPH(scores, targets):
 
 
 def accuracy_SBM(scores, targets):
-    S = targets.cpu().numpy()
-    C = np.argmax( torch.nn.Softmax(dim=1)(scores).cpu().detach().numpy() , axis=1 )
-    CM = confusion_matrix(S,C).astype(np.float32)
-    nb_classes = CM.shape[0]
-    targets = targets.cpu().detach().numpy()
-    nb_non_empty_classes = 0
-    pr_classes = np.zeros(nb_classes)
-    for r in range(nb_classes):
-        cluster = np.where(targets==r)[0]
-        if cluster.shape[0] != 0:
-            pr_classes[r] = CM[r,r]/ float(cluster.shape[0])
-            if CM[r,r]>0:
-                nb_non_empty_classes += 1
-        else:
-            pr_classes[r] = 0.0
-    acc = 100.* np.sum(pr_classes)/ float(nb_classes)
-    return acc
+    cm = ConfusionMatrix(scores.size(1), scores.device)
+    cm.update(scores, targets)
+    return cm.balanced_accuracy()
 
 
 def binary_f1_score(scores, targets):
-    """Computes the F1 score using scikit-learn for binary class labels. 
+    """Computes the F1 score for binary class labels.
     
     Returns the F1 score for the positive class, i.e. labelled '1'.
     """
-    y_true = targets.cpu().numpy()
-    y_pred = scores.argmax(dim=1).cpu().numpy()
-    return f1_score(y_true, y_pred, average='binary')
+    cm = ConfusionMatrix(2, scores.device)
+    cm.update(scores, targets)
+    return cm.f1()
 
   
 def accuracy_VOC(scores, targets):
@@ -66,3 +51,84 @@ def accuracy_VOC(scores, targets):
     targets = targets.cpu().detach().numpy()
     acc = f1_score(scores, targets, average='weighted')
     return acc
+
+
+"""
+    Streaming metrics for the training and evaluation loops: the running sums stay tensors on
+    the device of the model, so updating them per batch does not wait for the device; the
+    value is read (one synchronisation) by compute() at the end of the epoch.
+"""
+class MeanMetric:
+    # mean of per-batch values, e.g. the loss
+    def __init__(self, device):
+        self.total = torch.zeros((), device=device, dtype=torch.float64)
+        self.count = 0
+
+    def update(self, value, weight=1):
+        self.total += value.detach().double() * weight
+        self.count += weight
+
+    def compute(self):
+        return self.total.item() / max(self.count, 1)
+
+
+class MeanAbsoluteError(MeanMetric):
+    # MAE averaged over the batches, as MAE() per batch
+    def update(self, scores, targets):
+        super().update(F.l1_loss(scores.detach(), targets))
+
+
+class Accuracy:
+    # fraction of correctly classified samples, as the sum of accuracy_TU() over the number of samples
+    def __init__(self, device):
+        self.correct = torch.zeros((), device=device, dtype=torch.long)
+        self.count = 0
+
+    def update(self, scores, targets):
+        self.correct += (scores.detach().argmax(dim=1) == targets).sum()
+        self.count += targets.size(0)
+
+    def compute(self):
+        return self.correct.item() / max(self.count, 1)
+
+
+class ConfusionMatrix:
+    """
+        Streaming [num_classes, num_classes] confusion matrix, rows the targets and
+        columns the predictions
+    """
+    def __init__(self, num_classes, device):
+        self.num_classes = num_classes
+        self.matrix = torch.zeros(num_classes, num_classes, device=device, dtype=torch.long)
+
+    def update(self, scores, targets):
+        pred = scores.detach().argmax(dim=1)
+        self.matrix += torch.bincount(targets.long() * self.num_classes + pred,
+                                      minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+
+    def compute(self):
+        return self.matrix.cpu()
+
+    def balanced_accuracy(self):
+        # mean recall (in %) over the classes that occur among the targets or the predictions (accuracy_SBM)
+        cm = self.compute().double()
+        present = (cm.sum(0) + cm.sum(1)) > 0
+        recall = cm.diag() / cm.sum(1).clamp(min=1)
+        return 100. * recall[present].sum().item() / max(present.sum().item(), 1)
+
+    def f1(self, average='binary'):
+        """
+            F1 score of the positive class 1 ('binary'), the mean over the classes ('macro')
+            or the mean weighted by the class support ('weighted')
+        """
+        cm = self.compute().double()
+        tp = cm.diag()
+        f1 = 2 * tp / (cm.sum(0) + cm.sum(1)).clamp(min=1)  # 2tp / (2tp + fp + fn)
+        if average == 'binary':
+            return f1[1].item()
+        if average == 'macro':
+            return f1.mean().item()
+        if average == 'weighted':
+            support = cm.sum(1)
+            return (f1 * support).sum().item() / max(support.sum().item(), 1)
+        raise ValueError('Average {} not recognized.'.format(average))
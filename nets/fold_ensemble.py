@@ -0,0 +1,200 @@
+import torch
+import torch.nn.functional as F
+
+from layers.scatter_ops import SCATTER, aggregate, graph_tensors, scatter_mean, scatter_sum, segment_softmax
+
+"""
+    Fold ensemble: the models of all cross-validation folds trained as one
+
+    The batches of the active folds are concatenated into one disjoint graph, every node, edge
+    and graph carrying the index of its fold. Message passing, softmax and pooling work on that
+    graph as they are, since the folds never share a node; the per-fold weights are applied as
+    grouped (batched) matmuls on the rows of each fold, and BatchNorm takes its statistics per
+    fold. One step therefore costs about as many kernel launches as one fold on its own.
+
+    The fold models keep their own parameters, optimizer and LR schedule: their parameters are
+    stacked in every forward, so the gradients land in each fold model. Their BatchNorm buffers
+    are views into stacked tensors, so each fold model can still be evaluated or saved alone.
+    Supported are the TUs UnionSNNNet and GINNet (same computation as their forward_tensors).
+"""
+
+
+class Grouping:
+    """
+        Rows of a tensor grouped by fold; rows of a fold are contiguous and the folds in order
+    """
+    def __init__(self, fold, num_folds):
+        self.fold = fold
+        self.num_folds = num_folds
+        self.counts = torch.bincount(fold, minlength=num_folds)
+        starts = torch.cumsum(self.counts, 0) - self.counts
+        self.pos = torch.arange(fold.size(0), device=fold.device) - starts[fold]
+        self.max_rows = int(self.counts.max())
+
+    def linear(self, x, weight, bias=None):
+        # x [rows, in] @ weight[fold]^T + bias[fold] as one bmm over the padded [F, max_rows, in] rows
+        padded = x.new_zeros(self.num_folds, self.max_rows, x.size(1))
+        padded[self.fold, self.pos] = x
+        if bias is None:
+            out = torch.bmm(padded, weight.transpose(1, 2))
+        else:
+            out = torch.baddbmm(bias.unsqueeze(1), padded, weight.transpose(1, 2))
+        return out[self.fold, self.pos]
+
+
+class FoldEnsemble:
+    def __init__(self, models):
+        self.models = models
+        self.template = models[0]
+        if self.template.name not in ['UnionSNN', 'GIN']:
+            raise NotImplementedError('Fold ensemble training supports UnionSNN and GIN, not {}'.format(self.template.name))
+
+        # stacked buffers (BatchNorm statistics, fixed eps), the fold models' buffers become views into them
+        self.buffers = {}
+        for name, _ in self.template.named_buffers():
+            stacked = torch.stack([dict(model.named_buffers())[name] for model in models])
+            self.buffers[name] = stacked
+            module_name, _, attr = name.rpartition('.')
+            for f, model in enumerate(models):
+                setattr(model.get_submodule(module_name), attr, stacked[f])
+        self.training = True
+
+    def train(self):
+        self.training = True
+        for model in self.models:
+            model.train()
+
+    def eval(self):
+        self.training = False
+        for model in self.models:
+            model.eval()
+
+    def _stacked_params(self, active):
+        params = [dict(self.models[f].named_parameters()) for f in active]
+        return {name: torch.stack([p[name] for p in params]) for name in params[0]}
+
+    def _tensor(self, name, params, active):
+        return params[name] if name in params else self.buffers[name][active]
+
+    def __call__(self, graphs, active):
+        """
+            Scores of the batched DGLGraphs graphs[k] of the folds active[k] under their fold's
+            model, as one [B_total, n_classes] tensor, and the fold (index into active) of every graph
+        """
+        device = graphs[0].device
+        k = len(active)
+        h, edge_index, edge_weight, batch = [], [], [], []
+        num_nodes, num_graphs = [], []
+        nodes_before, graphs_before = 0, 0
+        for g in graphs:
+            g_edge_index, g_batch, g_num_graphs = graph_tensors(g)
+            h.append(g.ndata['feat'])
+            edge_index.append(g_edge_index + nodes_before)
+            edge_weight.append(g.edata['weight'] if 'weight' in g.edata else torch.ones(g.num_edges(), 1, device=device))
+            batch.append(g_batch + graphs_before)
+            num_nodes.append(g.num_nodes())
+            num_graphs.append(g_num_graphs)
+            nodes_before += g.num_nodes()
+            graphs_before += g_num_graphs
+        h, edge_index, edge_weight, batch = torch.cat(h), torch.cat(edge_index, 1), torch.cat(edge_weight), torch.cat(batch)
+
+        folds = torch.arange(k, device=device)
+        nodes = Grouping(torch.repeat_interleave(folds, torch.tensor(num_nodes, device=device)), k)
+        edges = Grouping(nodes.fold[edge_index[1]], k)
+        pooled = Grouping(torch.repeat_interleave(folds, torch.tensor(num_graphs, device=device)), k)
+
+        active = torch.tensor(active, device=device)
+        params = self._stacked_params(active.tolist())
+        pool = SCATTER[self.template.readout]
+
+        h = nodes.linear(h, params['embedding_h.weight'], params['embedding_h.bias'])
+        hidden_pooled = [pool(h, batch, graphs_before)]
+        for i, layer in enumerate(self.template.ginlayers):
+            h = self._layer('ginlayers.{}.'.format(i), layer, params, active, h, edge_index, edge_weight,
+                            batch, nodes, edges)
+            hidden_pooled.append(pool(h, batch, graphs_before))
+
+        score_over_layer = 0
+        for i, pooled_h in enumerate(hidden_pooled):
+            score_over_layer += pooled.linear(pooled_h, params['linears_prediction.{}.weight'.format(i)],
+                                              params['linears_prediction.{}.bias'.format(i)])
+        return score_over_layer, pooled.fold
+
+    def _layer(self, prefix, layer, params, active, h, edge_index, edge_weight, batch, nodes, edges):
+        h_in = h  # for residual connection
+
+        w = None
+        if self.template.name == 'UnionSNN':
+            h = nodes.linear(h, params[prefix + 'lin.weight'], params[prefix + 'lin.bias'])
+            if layer.e_feat:
+                out_weight = edges.linear(edge_weight, params[prefix + 'w_mlp_out.0.weight'])
+                out_weight = F.leaky_relu(out_weight, 0.2)
+                out_weight = edges.linear(out_weight, params[prefix + 'w_mlp_out.2.weight'],
+                                          params[prefix + 'w_mlp_out.2.bias'])
+                segment, num_segments = {'batch': (edges.fold, nodes.num_folds),
+                                         'graph': (batch[edge_index[1]], h.size(0)),
+                                         'dst': (edge_index[1], h.size(0))}[layer.softmax_scope]
+                w = 1 + segment_softmax(out_weight, segment, num_segments)
+        elif layer.e_feat:
+            w = edge_weight
+        neigh = aggregate(h, edge_index, w, layer.aggr_type)
+
+        eps = self._tensor(prefix + 'eps', params, active)
+        h = (1 + eps[nodes.fold]) * h + neigh
+
+        mlp = layer.apply_func.mlp
+        mlp_prefix = prefix + 'apply_func.mlp.'
+        if mlp.linear_or_not:
+            h = nodes.linear(h, params[mlp_prefix + 'linear.weight'], params[mlp_prefix + 'linear.bias'])
+        else:
+            for j in range(mlp.num_layers - 1):
+                h = nodes.linear(h, params[mlp_prefix + 'linears.{}.weight'.format(j)],
+                                 params[mlp_prefix + 'linears.{}.bias'.format(j)])
+                h = F.relu(self._batch_norm(mlp_prefix + 'batch_norms.{}.'.format(j), mlp.batch_norms[j],
+                                            params, active, h, nodes))
+            j = mlp.num_layers - 1
+            h = nodes.linear(h, params[mlp_prefix + 'linears.{}.weight'.format(j)],
+                             params[mlp_prefix + 'linears.{}.bias'.format(j)])
+
+        if layer.batch_norm:
+            h = self._batch_norm(prefix + 'bn_node_h.', layer.bn_node_h, params, active, h, nodes)
+
+        h = F.relu(h)
+
+        if layer.residual:
+            h = h_in + h
+
+        return F.dropout(h, layer.dropout, training=self.training)
+
+    def _batch_norm(self, prefix, bn, params, active, x, nodes):
+        # BatchNorm1d with statistics per fold; running statistics of the active folds updated in place
+        running_mean = self.buffers[prefix + 'running_mean']
+        running_var = self.buffers[prefix + 'running_var']
+        if self.training:
+            mean = scatter_mean(x, nodes.fold, nodes.num_folds)
+            diff = x - mean[nodes.fold]
+            var = scatter_mean(diff * diff, nodes.fold, nodes.num_folds)
+            with torch.no_grad():
+                n = nodes.counts.clamp(min=2).unsqueeze(1).to(x.dtype)
+                running_mean.index_copy_(0, active, (1 - bn.momentum) * running_mean[active] + bn.momentum * mean)
+                running_var.index_copy_(0, active, (1 - bn.momentum) * running_var[active]
+                                        + bn.momentum * var * n / (n - 1))
+                self.buffers[prefix + 'num_batches_tracked'].index_add_(0, active, torch.ones_like(active))
+            x = diff * torch.rsqrt(var + bn.eps)[nodes.fold]
+        else:
+            x = (x - running_mean[active][nodes.fold]) * torch.rsqrt(running_var[active] + bn.eps)[nodes.fold]
+        if bn.affine:
+            x = x * params[prefix + 'weight'][nodes.fold] + params[prefix + 'bias'][nodes.fold]
+        return x
+
+    def loss(self, scores, labels, graph_fold, num_folds):
+        """
+            Sum over the folds of each fold's mean cross entropy, so that every fold model gets
+            the gradient of its own loss; also returns the per-fold losses
+        """
+        per_fold = scatter_mean(F.cross_entropy(scores, labels, reduction='none'), graph_fold, num_folds)
+        return per_fold.sum(), per_fold.detach()
+
+    def correct(self, scores, labels, graph_fold, num_folds):
+        # number of correctly classified graphs per fold
+        return scatter_sum((scores.detach().argmax(dim=1) == labels).float(), graph_fold, num_folds)
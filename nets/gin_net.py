@@ -1,3 +1,5 @@
+import copy
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -12,6 +14,9 @@ from dgl.nn.pytorch.glob import SumPooling, AvgPooling, MaxPooling
 """
 
 from layers.gin_layer import GINLayer, ApplyNodeFunc, MLP
+from layers.scatter_ops import SCATTER, graph_tensors
+from layers.dense_ops import select_dense_batch
+from utils.checkpointing import checkpoint_layer
 
 class GINNet(nn.Module):
     
@@ -56,8 +61,28 @@ class GINNet(nn.Module):
             self.pool = MaxPooling()
         else:
             raise NotImplementedError
+        self.readout = readout
+        # recompute every layer in backward instead of storing its activations (training only);
+        # hidden_rep then only holds the layer outputs the checkpoints keep anyway
+        self.checkpoint_layers = net_params.get('checkpoint_layers', False)
+
+        # 'dgl' runs message passing on the DGLGraph, 'scatter' on plain tensors (forward_tensors)
+        self.backend = net_params.get('backend', 'dgl')
+
+        # 'sparse' keeps message passing on the edges, 'dense' pads every batch into [B, Nmax, Nmax]
+        # adjacency blocks and aggregates with bmm, 'auto' picks one of the two per batch
+        self.exec_mode = net_params.get('exec_mode', 'sparse')
+        self.dense_max_nodes = net_params.get('dense_max_nodes', 128)
+        self.dense_min_nodes = net_params.get('dense_min_nodes', 16)
+        self.dense_min_degree = net_params.get('dense_min_degree', 2.)
         
     def forward(self, g, h, e):
+        if self.backend == 'scatter' or self.exec_mode != 'sparse':
+            edge_index, batch, num_graphs = graph_tensors(g)
+            dense = self.dense_batch(edge_index, batch, num_graphs)
+            if self.backend == 'scatter' or dense is not None:
+                edge_weight = g.edata['weight'] if 'weight' in g.edata else None
+                return self.forward_tensors(h, edge_index, edge_weight, batch, num_graphs, dense)
         
         h = self.embedding_h(h)
         
@@ -65,7 +90,10 @@ class GINNet(nn.Module):
         hidden_rep = [h]
 
         for i in range(self.n_layers):
-            h = self.ginlayers[i](g, h)
+            if self.checkpoint_layers and self.training:
+                h = checkpoint_layer(self.ginlayers[i], self.ginlayers[i], g, h)
+            else:
+                h = self.ginlayers[i](g, h)
             hidden_rep.append(h)
 
         score_over_layer = 0
@@ -76,6 +104,45 @@ class GINNet(nn.Module):
             score_over_layer += self.linears_prediction[i](pooled_h)
 
         return score_over_layer
+
+    def forward_tensors(self, h, edge_index, edge_weight, batch, num_graphs, dense=None):
+        """
+            DGL-free forward: node features h, edge_index [2, E] (src, dst), edge weights
+            edge_weight [E, 1] and batch [N] mapping every node to one of num_graphs graphs.
+            dense is a DenseBatch from dense_batch() to aggregate on padded blocks, or None.
+        """
+        h = self.embedding_h(h)
+
+        hidden_rep = [h]
+
+        for i in range(self.n_layers):
+            if self.checkpoint_layers and self.training:
+                h = checkpoint_layer(self.ginlayers[i], self.ginlayers[i].forward_tensors, h, edge_index, edge_weight, dense)
+            else:
+                h = self.ginlayers[i].forward_tensors(h, edge_index, edge_weight, dense)
+            hidden_rep.append(h)
+
+        score_over_layer = 0
+
+        for i, h in enumerate(hidden_rep):
+            pooled_h = SCATTER[self.readout](h, batch, num_graphs)
+            score_over_layer += self.linears_prediction[i](pooled_h)
+
+        return score_over_layer
+
+    def fuse_for_inference(self):
+        """
+            Eval-only copy of the net with every BatchNorm folded into the preceding linear
+            layer and dropout removed; same scores as self.eval() with fewer ops
+        """
+        fused = copy.deepcopy(self).eval()
+        for layer in fused.ginlayers:
+            layer.fuse_for_inference()
+        return fused
+
+    def dense_batch(self, edge_index, batch, num_graphs):
+        return select_dense_batch(self.exec_mode, edge_index, batch, num_graphs,
+                                  self.dense_max_nodes, self.dense_min_nodes, self.dense_min_degree)
         
     def loss(self, pred, label):
         criterion = nn.CrossEntropyLoss()
@@ -1,3 +1,5 @@
+import copy
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -11,6 +13,8 @@ import dgl
 """
 from layers.gcn_layer import GCNLayer
 from layers.mlp_readout_layer import MLPReadout
+from layers.scatter_ops import SCATTER, graph_tensors
+from layers.dense_ops import select_dense_batch
 
 class GCNNet(nn.Module):
     def __init__(self, net_params):
@@ -38,7 +42,24 @@ class GCNNet(nn.Module):
                                     dropout, self.batch_norm, self.residual, self.e_feat))
         self.MLP_layer = MLPReadout(out_dim, 1)   # 1 out dim since regression problem        
 
+        # 'dgl' runs message passing on the DGLGraph, 'scatter' on plain tensors (forward_tensors)
+        self.backend = net_params.get('backend', 'dgl')
+
+        # 'sparse' keeps message passing on the edges, 'dense' pads every batch into [B, Nmax, Nmax]
+        # adjacency blocks and aggregates with bmm, 'auto' picks one of the two per batch
+        self.exec_mode = net_params.get('exec_mode', 'sparse')
+        self.dense_max_nodes = net_params.get('dense_max_nodes', 128)
+        self.dense_min_nodes = net_params.get('dense_min_nodes', 16)
+        self.dense_min_degree = net_params.get('dense_min_degree', 2.)
+
     def forward(self, g, h, e):
+        if self.backend == 'scatter' or self.exec_mode != 'sparse':
+            edge_index, batch, num_graphs = graph_tensors(g)
+            dense = self.dense_batch(edge_index, batch, num_graphs)
+            if self.backend == 'scatter' or dense is not None:
+                edge_weight = g.edata['weight'] if 'weight' in g.edata else None
+                return self.forward_tensors(h, edge_index, edge_weight, batch, num_graphs, dense)
+
         h = self.embedding_h(h)
         h = self.in_feat_dropout(h)
         
@@ -56,6 +77,36 @@ class GCNNet(nn.Module):
             hg = dgl.mean_nodes(g, 'h')  # default readout is mean nodes
             
         return self.MLP_layer(hg)
+
+    def forward_tensors(self, h, edge_index, edge_weight, batch, num_graphs, dense=None):
+        """
+            DGL-free forward: node features h, edge_index [2, E] (src, dst), edge weights
+            edge_weight [E, 1] and batch [N] mapping every node to one of num_graphs graphs.
+            dense is a DenseBatch from dense_batch() to aggregate on padded blocks, or None.
+        """
+        h = self.embedding_h(h)
+        h = self.in_feat_dropout(h)
+        for conv in self.layers:
+            h = conv.forward_tensors(h, edge_index, edge_weight, dense)
+
+        hg = SCATTER.get(self.readout, SCATTER['mean'])(h, batch, num_graphs)  # default readout is mean nodes
+
+        return self.MLP_layer(hg)
+
+    def fuse_for_inference(self):
+        """
+            Eval-only copy of the net with every BatchNorm folded into the preceding linear
+            layer and dropout removed; same scores as self.eval() with fewer ops
+        """
+        fused = copy.deepcopy(self).eval()
+        fused.in_feat_dropout = nn.Identity()
+        for layer in fused.layers:
+            layer.fuse_for_inference()
+        return fused
+
+    def dense_batch(self, edge_index, batch, num_graphs):
+        return select_dense_batch(self.exec_mode, edge_index, batch, num_graphs,
+                                  self.dense_max_nodes, self.dense_min_nodes, self.dense_min_degree)
     
     def loss(self, scores, targets):
         # loss = nn.MSELoss()(scores,targets)
@@ -1,9 +1,13 @@
+import copy
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-import dgl
-from dgl.nn.pytorch.glob import SumPooling, AvgPooling, MaxPooling
+import importlib.util
+
+if importlib.util.find_spec("dgl") is not None:
+    from dgl.nn.pytorch.glob import SumPooling, AvgPooling, MaxPooling
 
 """
     GIN: Graph Isomorphism Networks
@@ -12,6 +16,9 @@ from dgl.nn.pytorch.glob import SumPooling, AvgPooling, MaxPooling
 """
 
 from layers.unionsnn_layer import UnionSNNLayer, ApplyNodeFunc, MLP
+from layers.scatter_ops import SCATTER, graph_tensors
+from layers.dense_ops import select_dense_batch
+from utils.checkpointing import checkpoint_layer
 
 class UnionSNNNet(nn.Module):
     
@@ -28,6 +35,7 @@ class UnionSNNNet(nn.Module):
         readout = net_params['readout']
         batch_norm = net_params['batch_norm']
         residual = net_params['residual']
+        softmax_scope = net_params.get('softmax_scope', 'batch')  # batch, graph or dst
         self.e_feat = True if net_params['preprocess'] in ['shortest_path_graph'] else False
 
         # List of MLPs
@@ -39,7 +47,9 @@ class UnionSNNNet(nn.Module):
             mlp = MLP(n_mlp_layers, hidden_dim, hidden_dim, hidden_dim)
             
             self.ginlayers.append(UnionSNNLayer(ApplyNodeFunc(mlp), neighbor_aggr_type,
-                                           dropout, batch_norm, residual, 0, learn_eps, self.e_feat))
+                                           dropout, batch_norm, residual, 0, learn_eps, self.e_feat,
+                                           softmax_scope=softmax_scope))
+            self.ginlayers[-1].cache_key = 'uw{}'.format(layer)
 
         # Linear function for graph poolings (readout) of output of each layer
         # which maps the output of different layers into a prediction score
@@ -48,18 +58,45 @@ class UnionSNNNet(nn.Module):
         for layer in range(self.n_layers+1):
             self.linears_prediction.append(nn.Linear(hidden_dim, n_classes))
         
-        if readout == 'sum':
-            self.pool = SumPooling()
-        elif readout == 'mean':
-            self.pool = AvgPooling()
-        elif readout == 'max':
-            self.pool = MaxPooling()
-        else:
+        if readout not in SCATTER:
             raise NotImplementedError
+        self.readout = readout
+        # pool all layers at once and project with one [out, (L+1)*hidden] block matrix,
+        # same scores (up to float summation order) as the per-layer readout
+        self.fused_readout = net_params.get('fused_readout', True)
+        # recompute every layer in backward instead of storing its activations (training only)
+        self.checkpoint_layers = net_params.get('checkpoint_layers', False)
+
+        # 'dgl' runs message passing on the DGLGraph, 'scatter' on plain tensors (forward_tensors)
+        self.backend = net_params.get('backend', 'dgl')
+        if self.backend == 'dgl':
+            self.pool = {'sum': SumPooling, 'mean': AvgPooling, 'max': MaxPooling}[readout]()
+
+        # 'sparse' keeps message passing on the edges, 'dense' pads every batch into [B, Nmax, Nmax]
+        # adjacency blocks and aggregates with bmm, 'auto' picks one of the two per batch
+        self.exec_mode = net_params.get('exec_mode', 'sparse')
+        self.dense_max_nodes = net_params.get('dense_max_nodes', 128)
+        self.dense_min_nodes = net_params.get('dense_min_nodes', 16)
+        self.dense_min_degree = net_params.get('dense_min_degree', 2.)
         
     def forward(self, g, h, e):
+        if self.backend == 'scatter' or self.exec_mode != 'sparse':
+            edge_index, batch, num_graphs = graph_tensors(g)
+            dense = self.dense_batch(edge_index, batch, num_graphs)
+            if self.backend == 'scatter' or dense is not None:
+                edge_weight = g.edata['weight'] if 'weight' in g.edata else None
+                edge_cache = [layer.cached_weights(g.edata) for layer in self.ginlayers]
+                return self.forward_tensors(h, edge_index, edge_weight, batch, num_graphs, dense, edge_cache)
         
         h = self.embedding_h(h)
+
+        if self.checkpoint_layers and self.training:
+            # keep only the pooled readout of every layer
+            pooled_rep = [self.pool(g, h)]
+            for layer in self.ginlayers:
+                h = checkpoint_layer(layer, layer, g, h)
+                pooled_rep.append(self.pool(g, h))
+            return self.project_pooled(pooled_rep)
         
         # list of hidden representation at each layer (including input)
         hidden_rep = [h]
@@ -68,15 +105,117 @@ class UnionSNNNet(nn.Module):
             h = self.ginlayers[i](g, h)
             hidden_rep.append(h)
 
-        score_over_layer = 0
-
         # perform pooling over all nodes in each graph in every layer
-        for i, h in enumerate(hidden_rep):
-            pooled_h = self.pool(g, h)
-            score_over_layer += self.linears_prediction[i](pooled_h)
+        return self.readout_scores(hidden_rep, lambda h: self.pool(g, h))
+
+    def forward_tensors(self, h, edge_index, edge_weight, batch, num_graphs, dense=None, edge_cache=None):
+        """
+            DGL-free forward: node features h, edge_index [2, E] (src, dst), union weights
+            edge_weight [E, 1] and batch [N] mapping every node to one of num_graphs graphs.
+            dense is a DenseBatch from dense_batch() to aggregate on padded blocks, or None;
+            edge_cache optionally holds every layer's precomputed edge weights.
+        """
+        h = self.embedding_h(h)
+        pool = lambda h: SCATTER[self.readout](h, batch, num_graphs)
+
+        if self.checkpoint_layers and self.training:
+            pooled_rep = [pool(h)]
+            for i, layer in enumerate(self.ginlayers):
+                h = checkpoint_layer(layer, layer.forward_tensors, h, edge_index, edge_weight, dense, batch,
+                                     None if edge_cache is None else edge_cache[i])
+                pooled_rep.append(pool(h))
+            return self.project_pooled(pooled_rep)
+
+        hidden_rep = [h]
+
+        for i in range(self.n_layers):
+            h = self.ginlayers[i].forward_tensors(h, edge_index, edge_weight, dense, batch,
+                                                 None if edge_cache is None else edge_cache[i])
+            hidden_rep.append(h)
+
+        return self.readout_scores(hidden_rep, pool)
+
+    def readout_scores(self, hidden_rep, pool):
+        """
+            Sum over layers of linears_prediction[i](pool(hidden_rep[i])); fused, that is
+            one pooling of the concatenated [N, (L+1)*hidden] representations and one
+            projection with the prediction weights laid side by side and the biases summed
+        """
+        if not self.fused_readout:
+            return self.project_pooled([pool(h) for h in hidden_rep])
+        return F.linear(pool(torch.cat(hidden_rep, dim=1)), *self.fused_prediction())
+
+    def project_pooled(self, pooled_rep):
+        # sum over layers of linears_prediction[i](pooled_rep[i])
+        if not self.fused_readout:
+            score_over_layer = 0
+            for i, pooled_h in enumerate(pooled_rep):
+                score_over_layer += self.linears_prediction[i](pooled_h)
+            return score_over_layer
+        return F.linear(torch.cat(pooled_rep, dim=1), *self.fused_prediction())
+
+    def fused_prediction(self):
+        # (weight, bias) of all linears_prediction as one [out, (L+1)*hidden] projection
+        weight = torch.cat([linear.weight for linear in self.linears_prediction], dim=1)
+        bias = torch.stack([linear.bias for linear in self.linears_prediction]).sum(0)
+        return weight, bias
+
+    @torch.no_grad()
+    def precompute_edge_weights(self, graphs, chunk_size=None):
+        """
+            Eval-time cache of every layer's edge weight transform for a fixed list of graphs.
+            Runs the w_mlp_out of all layers over all edges in one vectorised pass (per chunk of
+            chunk_size graphs) and stores the result per graph in edata['uw<layer>'];
+            forward() then skips that work in eval mode until the parameters change.
+            Every graph that goes into the same batch must carry the cache (or none of them,
+            see clear_edge_weight_cache) since dgl.batch needs matching edata fields.
+        """
+        device = next(self.parameters()).device
+        chunk_size = chunk_size or len(graphs)
+        for start in range(0, len(graphs), chunk_size):
+            chunk = graphs[start:start + chunk_size]
+            num_edges = [g.num_edges() for g in chunk]
+            num_nodes = [g.num_nodes() for g in chunk]
+            weight = torch.cat([g.edata['weight'] for g in chunk]).to(device)
+
+            graph_of_edge = torch.repeat_interleave(torch.arange(len(chunk), device=device),
+                                                    torch.tensor(num_edges, device=device))
+            first_node = torch.cumsum(torch.tensor([0] + num_nodes[:-1], device=device), 0)
+            dst = torch.cat([g.edges()[1].long() for g in chunk]).to(device) + first_node[graph_of_edge]
+
+            for layer in self.ginlayers:
+                segment, num_segments = {'batch': (None, None),
+                                         'graph': (graph_of_edge, len(chunk)),
+                                         'dst': (dst, sum(num_nodes))}[layer.softmax_scope]
+                w = layer.cacheable_edge_weights(weight, segment, num_segments).cpu()
+                for g, w_g in zip(chunk, torch.split(w, num_edges)):
+                    g.edata[layer.cache_key] = w_g
+
+        for layer in self.ginlayers:
+            layer._cache_version = layer.param_version()
+
+    def clear_edge_weight_cache(self, graphs):
+        for g in graphs:
+            for layer in self.ginlayers:
+                if layer.cache_key in g.edata:
+                    del g.edata[layer.cache_key]
+        for layer in self.ginlayers:
+            layer._cache_version = None
+
+    def fuse_for_inference(self):
+        """
+            Eval-only copy of the net with every BatchNorm folded into the preceding linear
+            layer and dropout removed; same scores as self.eval() with fewer ops
+        """
+        fused = copy.deepcopy(self).eval()
+        for layer in fused.ginlayers:
+            layer.fuse_for_inference()
+        return fused
+
+    def dense_batch(self, edge_index, batch, num_graphs):
+        return select_dense_batch(self.exec_mode, edge_index, batch, num_graphs,
+                                  self.dense_max_nodes, self.dense_min_nodes, self.dense_min_degree, self.e_feat)
 
-        return score_over_layer
-        
     def loss(self, pred, label):
         criterion = nn.CrossEntropyLoss()
         loss = criterion(pred, label)
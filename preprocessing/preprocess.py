@@ -75,3 +75,40 @@ def compute_shortest_path(A_array, nx_g, graph_type='union_graph'):
         weight[v][u] = sum_w
 
     return weight
+
+
+def compute_union_weights(A_array, preprocess='shortest_path_graph'):
+    """
+    Union subgraph weights of every edge, row-normalised and added on top of the adjacency matrix.
+    Returns a dense [N, N] tensor; the edge weight of (u, v) is entry [u][v].
+    """
+    nx_g = nx.from_numpy_array(A_array)
+
+    if preprocess == 'shortest_path_graph':
+        weight = compute_shortest_path(A_array, nx_g, graph_type='union_graph')
+    else:
+        raise NotImplementedError
+
+    w = weight / weight.sum(1, keepdim=True)
+    w = torch.nan_to_num(w, nan=0)
+    w = w + torch.FloatTensor(A_array)
+
+    return w
+
+
+def adj_from_union_weights(new_adj):
+    """
+    Dense structural coefficients used by GraphSNN-style models, derived from compute_union_weights().
+    """
+    weight = new_adj - (new_adj > 0).float()
+    weight = weight * (weight > 0).float().sum(1, keepdim=True)
+
+    coeff = new_adj.sum(1, keepdim=True)
+    coeff = torch.diag((coeff.T)[0])
+
+    w = new_adj + coeff
+
+    w = w.detach().numpy()
+    w = np.nan_to_num(w, nan=0)
+
+    return weight, torch.tensor(w)
@@ -0,0 +1,139 @@
+"""
+    Dynamic int8 quantized CPU inference for trained checkpoints
+
+    The BatchNorms are folded first (fuse_for_inference()), so that nearly all the remaining work
+    is in nn.Linear layers: the node MLPs, embedding_h (TUs), linears_prediction / MLPReadout and
+    the edge weight MLPs of UnionSNN. These are quantized to int8 weights with per-batch dynamic
+    activation scales (torch.ao.quantization.quantize_dynamic).
+
+    Calibration: on a sample of the training split every Linear is quantized alone and kept in
+    fp32 if that moves the scores by more than --tolerance (relative L1 error). The quantized
+    model is then scored against the fp32 one on the test split: accuracy (TUs) or MAE (molecules)
+    and the CPU inference time, one row per checkpoint:
+
+        python quantize.py --ckpt_dir out/TUs_graph_classification/checkpoints/UnionSNN_MUTAG_GPU0_... \
+            out/TUs_graph_classification/checkpoints/GIN_MUTAG_GPU0_... --out_dir quantized/
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import quantize_dynamic
+
+from export import TensorInterface, load_config, checkpoint_file, build_model, graph_inputs, load_split, export
+
+
+def make_batches(dataset, samples, batch_size, num_graphs=None):
+    # [(tensor interface inputs, labels)] of the first num_graphs samples
+    num_graphs = len(samples) if num_graphs is None else min(num_graphs, len(samples))
+    batches = []
+    for start in range(0, num_graphs, batch_size):
+        g, labels = dataset.collate([samples[i] for i in range(start, min(start + batch_size, num_graphs))])
+        batches.append((graph_inputs(g), labels))
+    return batches
+
+
+def quantize(model, names):
+    return quantize_dynamic(model, set(names), dtype=torch.qint8)
+
+
+@torch.no_grad()
+def relative_error(reference, model, batches):
+    diff = sum((model(*inputs) - reference(*inputs)).abs().sum().item() for inputs, _ in batches)
+    norm = sum(reference(*inputs).abs().sum().item() for inputs, _ in batches)
+    return diff / max(norm, 1e-12)
+
+
+def calibrate(model, batches, tolerance):
+    """
+        Names of the Linear layers that can be quantized on their own within tolerance,
+        with the relative error of each of them
+    """
+    errors = {}
+    for name, module in model.named_modules():
+        if isinstance(module, nn.Linear):
+            errors[name] = relative_error(model, quantize(model, [name]), batches)
+    return [name for name, err in errors.items() if err <= tolerance], errors
+
+
+@torch.no_grad()
+def evaluate(model, batches, task):
+    # accuracy for TUs classification, MAE for molecule regression
+    scores = torch.cat([model(*inputs) for inputs, _ in batches])
+    labels = torch.cat([labels for _, labels in batches])
+    if task == 'graph_reg':
+        return F.l1_loss(scores, labels.to(scores.dtype)).item()
+    return (scores.argmax(dim=1) == labels).float().mean().item()
+
+
+@torch.no_grad()
+def inference_time(model, batches, repeats=5):
+    # best of repeats over the whole split, after one warm-up pass
+    for inputs, _ in batches:
+        model(*inputs)
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        for inputs, _ in batches:
+            model(*inputs)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt_dir', nargs='+', help="Please give the checkpoint directories to quantize")
+    parser.add_argument('--run', default=0, help="Please give the RUN_ folder (split) of the TUs checkpoints")
+    parser.add_argument('--calib_graphs', type=int, default=256, help="Number of training graphs used for calibration")
+    parser.add_argument('--tolerance', type=float, default=1e-2, help="Max relative score error of a quantized layer")
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--num_threads', type=int, help="Please give a value for num_threads (default: torch default)")
+    parser.add_argument('--out_dir', help="Save the quantized models as TorchScript artifacts in this folder")
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    rows = []
+    for ckpt_dir in args.ckpt_dir:
+        config = load_config(ckpt_dir)
+        run = '' if config['task'] == 'graph_reg' else int(args.run)
+        checkpoint = checkpoint_file(ckpt_dir, run)
+        # per-layer readout, since the fused one reads linears_prediction[i].weight directly
+        fp32 = build_model(config, checkpoint, fused_readout=False).fuse_for_inference()
+        fp32 = TensorInterface(fp32).eval()
+
+        dataset, trainset = load_split(config, 'train', run)
+        _, testset = load_split(config, 'test', run, dataset)
+        calib = make_batches(dataset, trainset, args.batch_size, args.calib_graphs)
+        test = make_batches(dataset, testset, args.batch_size)
+
+        names, errors = calibrate(fp32, calib, args.tolerance)
+        for name, err in sorted(errors.items(), key=lambda item: -item[1]):
+            print('[I] {:<45} rel. error {:.2e}{}'.format(name, err, '' if name in names else '  -> kept fp32'))
+        int8 = quantize(fp32, names)
+
+        metric = 'MAE' if config['task'] == 'graph_reg' else 'ACC'
+        fp32_metric, int8_metric = evaluate(fp32, test, config['task']), evaluate(int8, test, config['task'])
+        fp32_time, int8_time = inference_time(fp32, test), inference_time(int8, test)
+        rows.append([config['model'], config['dataset'], metric, fp32_metric, int8_metric, int8_metric - fp32_metric,
+                     fp32_time * 1000, int8_time * 1000, fp32_time / int8_time, len(names), len(errors)])
+
+        if args.out_dir is not None:
+            if not os.path.exists(args.out_dir):
+                os.makedirs(args.out_dir)
+            export(int8.net, config, os.path.join(args.out_dir, '{}_{}_int8.pt'.format(config['model'], config['dataset'])))
+
+    print('\n{:<10} {:<10} {:<6} {:>9} {:>9} {:>9} {:>10} {:>10} {:>8} {:>10}'.format(
+        'Model', 'Dataset', 'Metric', 'fp32', 'int8', 'delta', 'fp32 (ms)', 'int8 (ms)', 'speedup', 'quantized'))
+    for row in rows:
+        print('{:<10} {:<10} {:<6} {:>9.4f} {:>9.4f} {:>+9.4f} {:>10.1f} {:>10.1f} {:>7.2f}x {:>6}/{:<3}'.format(*row))
+    print('Speedup averaged over checkpoints: {:.2f}x'.format(np.mean([row[8] for row in rows])))
+
+
+if __name__ == '__main__':
+    main()
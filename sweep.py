@@ -0,0 +1,248 @@
+"""
+    Hyperparameter sweep with successive halving
+
+    Every combination of the values in a search space is trained as one trial, several trials
+    at a time in a pool of forked, core-pinned worker processes (utils/fold_scheduler.py).
+    Each dataset is loaded and preprocessed once, before the fork, and shared by all workers.
+
+    Trials are pruned while they run (asynchronous successive halving): at the rung epochs
+    min_epochs * eta^k every trial reports its validation loss, and it only goes on if that is
+    within the best 1/eta of the losses reported at that rung so far. The results of all trials
+    go into one CSV table, sorted by validation loss.
+
+    The search space is a JSON file mapping 'params.<name>' or 'net_params.<name>' to the list
+    of values to try; anything not in it comes from the config:
+
+        {"params.init_lr": [1e-3, 5e-4], "net_params.hidden_dim": [64, 128], "net_params.L": [2, 4]}
+
+        python sweep.py --config configs/MUTAG/TUs_graph_classification_UnionSNN_MUTAG_100k.json \
+            --space space.json --preprocess shortest_path_graph --workers 8
+
+    TUs trials train and validate on one train-val-test split (--split).
+"""
+import argparse
+import copy
+import csv
+import functools
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import torch.optim as optim
+from torch.utils.data import DataLoader
+
+from nets.load_net import gnn_model as tu_gnn_model
+from nets.graph_reg.load_net import gnn_model as graph_reg_gnn_model
+from data.data import LoadData
+from utils.fold_scheduler import run_folds
+
+MOLECULES = ['ZINC', 'ZINC-full', 'AQSOL']
+TRAIN_MODULES = {'TUs': 'train_TUs_graph_classification', 'graph_reg': 'train_molecules_graph_regression'}
+
+
+def grid(space):
+    # every combination of the values of the search space, as [{key: value}]
+    keys = sorted(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*[space[key] for key in keys])]
+
+
+def trial_config(config, assignment):
+    config = copy.deepcopy(config)
+    for key, value in assignment.items():
+        group, _, name = key.partition('.')
+        if group not in ['params', 'net_params']:
+            raise KeyError('Search space key {} should start with params. or net_params.'.format(key))
+        config[group][name] = value
+    return config
+
+
+def dataset_key(config):
+    return config['dataset'], config['net_params']['preprocess'], \
+        config['model'] in ['GCN', 'GAT'] and config['net_params'].get('self_loop', False)
+
+
+def load_dataset(config):
+    # the dataset of a trial, prepared as main.py / main_graph_reg.py do
+    name, preprocess, self_loop = dataset_key(config)
+    dataset = LoadData(name, preprocess=preprocess, graphsnn=(config['model'] == 'GraphSNN'))
+    if self_loop:
+        dataset._add_self_loops()
+    return dataset
+
+
+def add_dataset_params(net_params, dataset, task):
+    # the net_params main.py / main_graph_reg.py take from the dataset
+    if task == 'graph_reg':
+        net_params['num_atom_type'] = dataset.num_atom_type
+        net_params['num_bond_type'] = dataset.num_bond_type
+        net_params['max_num_node'] = dataset.max_node_num
+        return
+    if 'node_num' in dir(dataset):
+        net_params['node_num'] = dataset.node_num
+    net_params['in_dim'] = dataset.all.graph_lists[0].ndata['feat'][0].shape[0]
+    net_params['edge_dim'] = dataset.all.graph_lists[0].edata['feat'][0].shape[0] \
+        if 'feat' in dataset.all.graph_lists[0].edata else None
+    net_params['max_num_node'] = dataset.max_node_num
+    net_params['n_classes'] = len(np.unique(dataset.all.graph_labels))
+
+
+class SuccessiveHalving:
+    """
+        Asynchronous successive halving: decides, at the rung epochs, whether a trial goes on.
+        The losses reported at every rung are shared between the worker processes.
+    """
+    def __init__(self, manager, min_epochs, eta):
+        self.min_epochs = min_epochs
+        self.eta = eta
+        self.lock = manager.Lock()
+        self.reported = manager.dict()
+
+    def is_rung(self, epochs):
+        rung = self.min_epochs
+        while rung < epochs:
+            rung *= self.eta
+        return rung == epochs
+
+    def keep(self, epochs, val_loss):
+        # after epochs epochs of training: False if the trial should be stopped
+        if not self.is_rung(epochs):
+            return True
+        with self.lock:
+            losses = self.reported.get(epochs, []) + [val_loss]
+            self.reported[epochs] = losses
+        return val_loss <= np.percentile(losses, 100. / self.eta)
+
+
+def run_trial(trials, datasets, pruner, device, split, trial_id):
+    config = trials[trial_id]
+    params, net_params = config['params'], copy.deepcopy(config['net_params'])
+    task = 'graph_reg' if config['dataset'] in MOLECULES else 'TUs'
+    dataset = datasets[dataset_key(config)]
+    train_module = importlib.import_module(TRAIN_MODULES[task])
+
+    net_params['device'] = device
+    net_params['batch_size'] = params['batch_size']
+    add_dataset_params(net_params, dataset, task)
+
+    random.seed(params['seed'])
+    np.random.seed(params['seed'])
+    torch.manual_seed(params['seed'])
+    if device.type == 'cuda':
+        torch.cuda.manual_seed(params['seed'])
+
+    gnn_model = graph_reg_gnn_model if task == 'graph_reg' else tu_gnn_model
+    model = gnn_model(config['model'], net_params).to(device)
+    optimizer = optim.Adam(model.parameters(), lr=params['init_lr'], weight_decay=params['weight_decay'])
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min',
+                                                     factor=params['lr_reduce_factor'],
+                                                     patience=params['lr_schedule_patience'])
+
+    if task == 'graph_reg':
+        trainset, valset, testset = dataset.train, dataset.val, dataset.test
+    else:
+        trainset, valset, testset = dataset.train[split], dataset.val[split], dataset.test[split]
+    train_loader = DataLoader(trainset, batch_size=params['batch_size'], shuffle=True, collate_fn=dataset.collate)
+    val_loader = DataLoader(valset, batch_size=params['batch_size'], shuffle=False, collate_fn=dataset.collate)
+    test_loader = DataLoader(testset, batch_size=params['batch_size'], shuffle=False, collate_fn=dataset.collate)
+
+    t0 = time.time()
+    best_val_loss, best_val_metric, pruned = float('inf'), float('nan'), False
+    for epoch in range(params['epochs']):
+        train_module.train_epoch_sparse(model, optimizer, device, train_loader, epoch)
+        val_loss, val_metric = train_module.evaluate_network_sparse(model, device, val_loader, epoch)
+        if val_loss < best_val_loss:
+            best_val_loss, best_val_metric = val_loss, val_metric
+
+        scheduler.step(val_loss)
+        if optimizer.param_groups[0]['lr'] < params['min_lr']:
+            break
+        if time.time() - t0 > params['max_time'] * 3600:
+            break
+        if not pruner.keep(epoch + 1, val_loss):
+            pruned = True
+            break
+
+    _, test_metric = train_module.evaluate_network_sparse(model, device, test_loader, epoch)
+    return {'epochs': epoch + 1, 'pruned': pruned, 'best_val_loss': best_val_loss, 'best_val_metric': best_val_metric,
+            'last_val_loss': val_loss, 'test_metric': test_metric, 'time': time.time() - t0}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', help="Please give a config.json file with training/model/data/param details")
+    parser.add_argument('--space', help="Please give a search space .json file ({'params.<name>': [values]})")
+    parser.add_argument('--preprocess', default='original')
+    parser.add_argument('--workers', type=int, default=4, help="Number of trials trained at the same time")
+    parser.add_argument('--device', default='cpu', help="Please give a value for device (cpu or cuda)")
+    parser.add_argument('--split', type=int, default=0, help="Train-val-test split of the TUs datasets to tune on")
+    parser.add_argument('--min_epochs', type=int, default=10, help="Epochs of the first successive halving rung")
+    parser.add_argument('--eta', type=int, default=3, help="Only the best 1/eta of the trials pass a rung")
+    parser.add_argument('--epochs', help="Please give a value for epochs (max per trial)")
+    parser.add_argument('--out', help="Results table (.csv), by default in the out_dir of the config")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    with open(args.space) as f:
+        space = json.load(f)
+    config['net_params']['preprocess'] = args.preprocess
+    if args.epochs is not None:
+        config['params']['epochs'] = int(args.epochs)
+
+    assignments = grid(space)
+    trials = [trial_config(config, assignment) for assignment in assignments]
+    print("{} trials over {}".format(len(trials), ', '.join(sorted(space))))
+
+    # every dataset loaded and preprocessed once, then shared with the forked workers
+    datasets = {}
+    for trial in trials:
+        if dataset_key(trial) not in datasets:
+            datasets[dataset_key(trial)] = load_dataset(trial)
+
+    manager = multiprocessing.get_context('fork').Manager()
+    pruner = SuccessiveHalving(manager, args.min_epochs, args.eta)
+    fn = functools.partial(run_trial, trials, datasets, pruner, torch.device(args.device), args.split)
+
+    rows = []
+    t0 = time.time()
+    try:
+        for trial_id, result in run_folds(fn, list(range(len(trials))), args.workers):
+            print("Trial {} {} after {} epochs: val loss {:.4f}".format(
+                trial_id, 'pruned' if result['pruned'] else 'done', result['epochs'], result['best_val_loss']))
+            rows.append(dict({'trial': trial_id}, **assignments[trial_id], **result))
+    except KeyboardInterrupt:
+        print('-' * 89)
+        print('Exiting from the sweep early because of KeyboardInterrupt')
+    print("TOTAL TIME TAKEN: {:.4f}hrs".format((time.time() - t0) / 3600))
+    if not rows:
+        return
+
+    rows.sort(key=lambda row: row['best_val_loss'])
+    out = args.out or os.path.join(config['out_dir'], 'sweeps', 'sweep_{}_{}_{}.csv'.format(
+        config['model'], config['dataset'], time.strftime('%Hh%Mm%Ss_on_%b_%d_%Y')))
+    if os.path.dirname(out) and not os.path.exists(os.path.dirname(out)):
+        os.makedirs(os.path.dirname(out))
+    with open(out, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    metric = 'MAE' if config['dataset'] in MOLECULES else 'ACC'
+    print('\n{:>5}  {:<60} {:>6} {:>10} {:>10} {:>10}'.format('Trial', 'Assignment', 'Epochs', 'Val loss',
+                                                            'Val ' + metric, 'Test ' + metric))
+    for row in rows:
+        assignment = ', '.join('{}={}'.format(key.partition('.')[2], row[key]) for key in sorted(space))
+        print('{:>5}  {:<60} {:>5}{} {:>10.4f} {:>10.4f} {:>10.4f}'.format(
+            row['trial'], assignment, row['epochs'], '*' if row['pruned'] else ' ', row['best_val_loss'],
+            row['best_val_metric'], row['test_metric']))
+    print('(* pruned)  Results written to {}'.format(out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+    fuse_for_inference() against the eval-mode nets it is folded from: the TUs nets (nets/) and
+    the graph regression nets (nets/graph_reg/), GCN, GIN and UnionSNN, on the dgl and scatter
+    backends, sparse and dense, with random BatchNorm statistics and affine parameters (a fresh
+    BatchNorm is the identity in eval mode and would hide a wrong fold).
+
+        python -m pytest tests/test_fusion.py
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+dgl = pytest.importorskip('dgl')
+
+import torch.nn as nn
+import torch.nn.functional as F
+
+from nets.load_net import gnn_model
+from nets.graph_reg.load_net import gnn_model as graph_reg_model
+from layers.gcn_layer import GCNLayer
+from layers.scatter_ops import graph_tensors
+
+HIDDEN_DIM = 16
+IN_DIM = 7
+NUM_ATOM_TYPE = 9
+
+
+def random_batch(task, num_graphs=4, seed=0):
+    # batched DGLGraph of random symmetric graphs with union weights, and its node features
+    rng = torch.Generator().manual_seed(seed)
+    graphs = []
+    for _ in range(num_graphs):
+        n = int(torch.randint(5, 12, (1,), generator=rng))
+        upper = torch.triu(torch.rand(n, n, generator=rng) < 0.4, 1)
+        src, dst = torch.nonzero(upper | upper.T, as_tuple=True)
+        g = dgl.graph((src, dst), num_nodes=n)
+        g.edata['weight'] = torch.rand(len(src), 1, generator=rng, dtype=torch.float64) + 0.5
+        graphs.append(g)
+    g = dgl.batch(graphs)
+    if task == 'TUs':
+        h = torch.randn(g.num_nodes(), IN_DIM, generator=rng, dtype=torch.float64)
+    else:
+        h = torch.randint(NUM_ATOM_TYPE, (g.num_nodes(),), generator=rng)
+    return g, h
+
+
+def net_params(task, preprocess, backend, exec_mode):
+    params = {'L': 3, 'hidden_dim': HIDDEN_DIM, 'out_dim': HIDDEN_DIM, 'residual': True, 'readout': 'sum',
+              'n_mlp_GIN': 2, 'learn_eps_GIN': True, 'neighbor_aggr_GIN': 'sum', 'in_feat_dropout': 0.1,
+              'dropout': 0.1, 'batch_norm': True, 'preprocess': preprocess, 'device': torch.device('cpu'),
+              'backend': backend, 'exec_mode': exec_mode}
+    if task == 'TUs':
+        params.update({'in_dim': IN_DIM, 'n_classes': 3})
+    else:
+        params.update({'num_atom_type': NUM_ATOM_TYPE, 'num_bond_type': 4})
+    return params
+
+
+@torch.no_grad()
+def randomize_batch_norms(module, seed=0):
+    rng = torch.Generator().manual_seed(seed)
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    assert bns, 'no BatchNorm to fold'
+    for bn in bns:
+        bn.running_mean.copy_(torch.randn(bn.num_features, generator=rng))
+        bn.running_var.copy_(torch.rand(bn.num_features, generator=rng) + 0.5)
+        if bn.affine:
+            bn.weight.copy_(torch.randn(bn.num_features, generator=rng))
+            bn.bias.copy_(torch.randn(bn.num_features, generator=rng))
+
+
+def assert_close(expected, output):
+    assert torch.allclose(output, expected, rtol=1e-6, atol=1e-8), \
+        'fused output differs by up to {:.3e}'.format((output - expected).abs().max().item())
+
+
+# shortest_path_graph gives the GCN nets GraphConv layers (dgl_builtin), no preprocessing the
+# aggregate-then-linear ones; the UnionSNN nets use the union weights with shortest_path_graph only
+@pytest.mark.parametrize('task', ['TUs', 'graph_reg'])
+@pytest.mark.parametrize('model_name', ['GCN', 'GIN', 'UnionSNN'])
+@pytest.mark.parametrize('preprocess', ['shortest_path_graph', None])
+@pytest.mark.parametrize('backend, exec_mode', [('dgl', 'sparse'), ('dgl', 'dense'), ('scatter', 'sparse'),
+                                                ('scatter', 'dense')])
+def test_fused_net_matches_eval(task, model_name, preprocess, backend, exec_mode):
+    torch.manual_seed(0)
+    build = gnn_model if task == 'TUs' else graph_reg_model
+    net = build(model_name, net_params(task, preprocess, backend, exec_mode)).double()
+    randomize_batch_norms(net)
+    g, h = random_batch(task)
+
+    net.eval()
+    with torch.no_grad():
+        expected = net(g, h, None)
+        fused = net.fuse_for_inference()
+        output = fused(g, h, None)
+
+    assert not any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in fused.modules())
+    assert not any(isinstance(m, nn.Dropout) for m in fused.modules())
+    assert_close(expected, output)
+
+
+@pytest.mark.parametrize('bias', [True, False])
+@pytest.mark.parametrize('backend', ['dgl', 'scatter'])
+def test_fold_batch_norm_graph_conv(bias, backend):
+    # GCNLayer on GraphConv (dgl_builtin), with and without a conv bias to fold the BatchNorm shift into
+    torch.manual_seed(0)
+    layer = GCNLayer(HIDDEN_DIM, HIDDEN_DIM, F.relu, 0.0, True, residual=True, dgl_builtin=True).double()
+    if not bias:
+        layer.conv.register_parameter('bias', None)
+    randomize_batch_norms(layer)
+    g, _ = random_batch('TUs')
+    h = torch.randn(g.num_nodes(), HIDDEN_DIM, dtype=torch.float64)
+    edge_index, _, _ = graph_tensors(g)
+    run = (lambda layer: layer(g.local_var(), h)) if backend == 'dgl' else \
+        (lambda layer: layer.forward_tensors(h, edge_index, None))
+
+    layer.eval()
+    with torch.no_grad():
+        expected = run(layer)
+        layer.fuse_for_inference()
+        output = run(layer)
+
+    assert layer.conv.bias is not None
+    assert_close(expected, output)
@@ -6,75 +6,138 @@ import torch
 import torch.nn as nn
 import math
 
-from metrics import accuracy_TU as accuracy
+from metrics import MeanMetric, Accuracy
+from utils.precision import autocast
+from utils.timing import PhaseTimer
 
 """
     For GCNs
 """
-def train_epoch_sparse(model, optimizer, device, data_loader, epoch):
+def train_epoch_sparse(model, optimizer, device, data_loader, epoch, compiled_step=None, precision='fp32', timer=None):
     model.train()
-    epoch_loss = 0
-    epoch_train_acc = 0
-    nb_data = 0
+    timer = timer or PhaseTimer(device, enabled=False)
+    epoch_loss = MeanMetric(device)
+    epoch_train_acc = Accuracy(device)
     gpu_mem = 0
-    for iter, batch_data in enumerate(data_loader):
-        if model.name in ['GraphSNN']:
-            batch_graphs, batch_labels, batch_adjs, batch_feats = batch_data
-        else:
-            batch_graphs, batch_labels = batch_data
-        batch_graphs = batch_graphs.to(device)
-        batch_x = batch_graphs.ndata['feat'].to(device)  # num x feat
-        batch_e = batch_graphs.edata['feat'].to(device)
-        batch_labels = batch_labels.to(device)
-        optimizer.zero_grad()
-
-        if model.name in ['GraphSNN']:
-            batch_scores = model.forward(batch_graphs, batch_x, batch_e, batch_adjs, batch_feats)
-            loss = model.loss(batch_scores, batch_labels)
-        else:
-            batch_scores = model.forward(batch_graphs, batch_x, batch_e)
-            loss = model.loss(batch_scores, batch_labels)
-        loss.backward()
-        optimizer.step()
-        epoch_loss += loss.detach().item()
-        epoch_train_acc += accuracy(batch_scores, batch_labels)
-        nb_data += batch_labels.size(0)
-    epoch_loss /= (iter + 1)
-    epoch_train_acc /= nb_data
+    with timer.layers(model):
+        for iter, batch_data in enumerate(timer.fetch(data_loader)):
+            if model.name in ['GraphSNN']:
+                batch_graphs, batch_labels, batch_adjs, batch_feats = batch_data
+            else:
+                batch_graphs, batch_labels = batch_data
+            with timer.phase('transfer'):
+                batch_graphs = batch_graphs.to(device)
+                batch_x = batch_graphs.ndata['feat'].to(device)  # num x feat
+                batch_e = batch_graphs.edata['feat'].to(device)
+                batch_labels = batch_labels.to(device)
+            optimizer.zero_grad()
+
+            if compiled_step is not None:
+                with timer.phase('forward_backward'):
+                    batch_scores, loss = compiled_step(batch_graphs, batch_x, batch_labels)  # includes backward
+            else:
+                with timer.phase('forward'), autocast(device, precision):
+                    if model.name in ['GraphSNN']:
+                        batch_scores = model.forward(batch_graphs, batch_x, batch_e, batch_adjs, batch_feats)
+                    else:
+                        batch_scores = model.forward(batch_graphs, batch_x, batch_e)
+                with timer.phase('loss'):
+                    batch_scores = batch_scores.float()  # loss in fp32
+                    loss = model.loss(batch_scores, batch_labels)
+                with timer.phase('backward'):
+                    loss.backward()
+            with timer.phase('optimizer'):
+                optimizer.step()
+            epoch_loss.update(loss)
+            epoch_train_acc.update(batch_scores, batch_labels)
+            timer.count(batch_graphs)
     
-    return epoch_loss, epoch_train_acc, optimizer
+    return epoch_loss.compute(), epoch_train_acc.compute(), optimizer
 
-def evaluate_network_sparse(model, device, data_loader, epoch):
+def evaluate_network_sparse(model, device, data_loader, epoch, timer=None):
     model.eval()
-    epoch_test_loss = 0
-    epoch_test_acc = 0
-    nb_data = 0
-    with torch.no_grad():
-        for iter, batch_data in enumerate(data_loader):
+    timer = timer or PhaseTimer(device, enabled=False)
+    epoch_test_loss = MeanMetric(device)
+    epoch_test_acc = Accuracy(device)
+    with torch.no_grad(), timer.layers(model):
+        for iter, batch_data in enumerate(timer.fetch(data_loader)):
             if model.name in ['GraphSNN']:
                 batch_graphs, batch_labels, batch_adjs, batch_feats = batch_data
             else:
                 batch_graphs, batch_labels = batch_data
-            batch_graphs = batch_graphs.to(device)
-            batch_x = batch_graphs.ndata['feat'].to(device)
-            batch_e = batch_graphs.edata['feat'].to(device)
-            batch_labels = batch_labels.to(device)
+            with timer.phase('transfer'):
+                batch_graphs = batch_graphs.to(device)
+                batch_x = batch_graphs.ndata['feat'].to(device)
+                batch_e = batch_graphs.edata['feat'].to(device)
+                batch_labels = batch_labels.to(device)
 
-            if model.name in ['GraphSNN']:
-                batch_scores = model.forward(batch_graphs, batch_x, batch_e, batch_adjs, batch_feats)
+            with timer.phase('forward'):
+                if model.name in ['GraphSNN']:
+                    batch_scores = model.forward(batch_graphs, batch_x, batch_e, batch_adjs, batch_feats)
+                else:
+                    batch_scores = model.forward(batch_graphs, batch_x, batch_e)
+            with timer.phase('loss'):
                 loss = model.loss(batch_scores, batch_labels)
-            else:
-                batch_scores = model.forward(batch_graphs, batch_x, batch_e)
-                loss = model.loss(batch_scores, batch_labels)
-            epoch_test_loss += loss.detach().item()
-            epoch_test_acc += accuracy(batch_scores, batch_labels)
-            nb_data += batch_labels.size(0)
-        epoch_test_loss /= (iter + 1)
-        epoch_test_acc /= nb_data
+            epoch_test_loss.update(loss)
+            epoch_test_acc.update(batch_scores, batch_labels)
+            timer.count(batch_graphs)
         
-    return epoch_test_loss, epoch_test_acc
+    return epoch_test_loss.compute(), epoch_test_acc.compute()
+
 
+"""
+    For the fold ensemble (nets/fold_ensemble.py): data_loaders maps every active fold to its
+    own loader; each step takes the next batch of every fold that has one left.
+    Losses and accuracies are returned per fold, computed as in the functions above.
+"""
+def _ensemble_epoch(ensemble, device, data_loaders, optimizers=None):
+    iterators = {fold: iter(loader) for fold, loader in data_loaders.items()}
+    num_folds = max(data_loaders) + 1
+    # per fold: summed batch losses and correct graphs on the device, graphs and batches on the host
+    loss_sums = torch.zeros(num_folds, device=device, dtype=torch.float64)
+    correct_sums = torch.zeros(num_folds, device=device, dtype=torch.float64)
+    num_graphs, num_batches = [0] * num_folds, [0] * num_folds
+    while True:
+        batches = {}
+        for fold in list(iterators):
+            try:
+                batches[fold] = next(iterators[fold])
+            except StopIteration:
+                del iterators[fold]
+        if not batches:
+            break
+        active = sorted(batches)
+        batch_graphs = [batches[fold][0].to(device) for fold in active]
+        batch_labels = torch.cat([batches[fold][1] for fold in active]).to(device)
+        if optimizers is not None:
+            for fold in active:
+                optimizers[fold].zero_grad()
 
+        batch_scores, graph_fold = ensemble(batch_graphs, active)
+        loss, fold_losses = ensemble.loss(batch_scores, batch_labels, graph_fold, len(active))
+        if optimizers is not None:
+            loss.backward()
+            for fold in active:
+                optimizers[fold].step()
+
+        active_index = torch.tensor(active, device=device)
+        loss_sums.index_add_(0, active_index, fold_losses.double())
+        correct_sums.index_add_(0, active_index, ensemble.correct(batch_scores, batch_labels, graph_fold, len(active)).double())
+        for fold in active:
+            num_graphs[fold] += batches[fold][1].size(0)
+            num_batches[fold] += 1
+    loss_sums, correct_sums = loss_sums.tolist(), correct_sums.tolist()
+    return {fold: (loss_sums[fold] / max(num_batches[fold], 1), correct_sums[fold] / max(num_graphs[fold], 1))
+            for fold in data_loaders}
+
+def train_epoch_ensemble(ensemble, optimizers, device, data_loaders, epoch):
+    ensemble.train()
+    return _ensemble_epoch(ensemble, device, data_loaders, optimizers)
+
+def evaluate_network_ensemble(ensemble, device, data_loaders, epoch):
+    ensemble.eval()
+    with torch.no_grad():
+        return _ensemble_epoch(ensemble, device, data_loaders)
 
 
 """
@@ -82,9 +145,8 @@ def evaluate_network_sparse(model, device, data_loader, epoch):
 """
 def train_epoch_dense(model, optimizer, device, data_loader, epoch, batch_size):
     model.train()
-    epoch_loss = 0
-    epoch_train_acc = 0
-    nb_data = 0
+    epoch_loss = MeanMetric(device)
+    epoch_train_acc = Accuracy(device)
     gpu_mem = 0
     optimizer.zero_grad()
     for iter, (x_with_node_feat, labels) in enumerate(data_loader):
@@ -99,19 +161,15 @@ def train_epoch_dense(model, optimizer, device, data_loader, epoch, batch_size):
             optimizer.step()
             optimizer.zero_grad()
             
-        epoch_loss += loss.detach().item()
-        epoch_train_acc += accuracy(scores, labels)
-        nb_data += labels.size(0)
-    epoch_loss /= (iter + 1)
-    epoch_train_acc /= nb_data
+        epoch_loss.update(loss)
+        epoch_train_acc.update(scores, labels)
     
-    return epoch_loss, epoch_train_acc, optimizer
+    return epoch_loss.compute(), epoch_train_acc.compute(), optimizer
 
 def evaluate_network_dense(model, device, data_loader, epoch):
     model.eval()
-    epoch_test_loss = 0
-    epoch_test_acc = 0
-    nb_data = 0
+    epoch_test_loss = MeanMetric(device)
+    epoch_test_acc = Accuracy(device)
     with torch.no_grad():
         for iter, (x_with_node_feat, labels) in enumerate(data_loader):
             x_with_node_feat = x_with_node_feat.to(device)
@@ -119,13 +177,10 @@ def evaluate_network_dense(model, device, data_loader, epoch):
             
             scores = model.forward(x_with_node_feat)
             loss = model.loss(scores, labels) 
-            epoch_test_loss += loss.detach().item()
-            epoch_test_acc += accuracy(scores, labels)
-            nb_data += labels.size(0)
-        epoch_test_loss /= (iter + 1)
-        epoch_test_acc /= nb_data
+            epoch_test_loss.update(loss)
+            epoch_test_acc.update(scores, labels)
         
-    return epoch_test_loss, epoch_test_acc
+    return epoch_test_loss.compute(), epoch_test_acc.compute()
 
 
 def check_patience(all_losses, best_loss, best_epoch, curr_loss, curr_epoch, counter):
@@ -5,67 +5,79 @@
 import torch
 import torch.nn as nn
 import math
-from metrics import MAE
+from metrics import MeanMetric, MeanAbsoluteError
+from utils.precision import autocast
+from utils.timing import PhaseTimer
 
 
 
-def train_epoch_sparse(model, optimizer, device, data_loader, epoch):
+def train_epoch_sparse(model, optimizer, device, data_loader, epoch, compiled_step=None, precision='fp32', timer=None):
     model.train()
-    epoch_loss = 0
-    epoch_train_mae = 0
-    nb_data = 0
+    timer = timer or PhaseTimer(device, enabled=False)
+    epoch_loss = MeanMetric(device)
+    epoch_train_mae = MeanAbsoluteError(device)
     gpu_mem = 0
-    for iter, batch_data in enumerate(data_loader):
-        batch_graphs, batch_targets = batch_data
+    with timer.layers(model):
+        for iter, batch_data in enumerate(timer.fetch(data_loader)):
+            batch_graphs, batch_targets = batch_data
 
-        batch_graphs = batch_graphs.to(device)
-        batch_x = batch_graphs.ndata['feat'].to(device)  # num x feat
-        batch_e = batch_graphs.edata['feat'].to(device)
-        batch_targets = batch_targets.to(device)
-        optimizer.zero_grad()
-        try:
-            batch_pos_enc = batch_graphs.ndata['pos_enc'].to(device)
-            sign_flip = torch.rand(batch_pos_enc.size(1)).to(device)
-            sign_flip[sign_flip >= 0.5] = 1.0
-            sign_flip[sign_flip < 0.5] = -1.0
-            batch_pos_enc = batch_pos_enc * sign_flip.unsqueeze(0)
-            batch_scores = model.forward(batch_graphs, batch_x, batch_e, batch_pos_enc)
-        except:
-            batch_scores = model.forward(batch_graphs, batch_x, batch_e)
-        loss = model.loss(batch_scores, batch_targets)
-        loss.backward()
-        optimizer.step()
-        epoch_loss += loss.detach().item()
-        epoch_train_mae += MAE(batch_scores, batch_targets)
-        nb_data += batch_targets.size(0)
-    epoch_loss /= (iter + 1)
-    epoch_train_mae /= (iter + 1)
+            with timer.phase('transfer'):
+                batch_graphs = batch_graphs.to(device)
+                batch_x = batch_graphs.ndata['feat'].to(device)  # num x feat
+                batch_e = batch_graphs.edata['feat'].to(device)
+                batch_targets = batch_targets.to(device)
+            optimizer.zero_grad()
+            if compiled_step is not None:
+                with timer.phase('forward_backward'):
+                    batch_scores, loss = compiled_step(batch_graphs, batch_x, batch_targets)  # includes backward
+            else:
+                with timer.phase('forward'), autocast(device, precision):
+                    try:
+                        batch_pos_enc = batch_graphs.ndata['pos_enc'].to(device)
+                        sign_flip = torch.rand(batch_pos_enc.size(1)).to(device)
+                        sign_flip[sign_flip >= 0.5] = 1.0
+                        sign_flip[sign_flip < 0.5] = -1.0
+                        batch_pos_enc = batch_pos_enc * sign_flip.unsqueeze(0)
+                        batch_scores = model.forward(batch_graphs, batch_x, batch_e, batch_pos_enc)
+                    except:
+                        batch_scores = model.forward(batch_graphs, batch_x, batch_e)
+                with timer.phase('loss'):
+                    batch_scores = batch_scores.float()  # loss in fp32
+                    loss = model.loss(batch_scores, batch_targets)
+                with timer.phase('backward'):
+                    loss.backward()
+            with timer.phase('optimizer'):
+                optimizer.step()
+            epoch_loss.update(loss)
+            epoch_train_mae.update(batch_scores, batch_targets)
+            timer.count(batch_graphs)
 
-    return epoch_loss, epoch_train_mae, optimizer
+    return epoch_loss.compute(), epoch_train_mae.compute(), optimizer
 
 
-def evaluate_network_sparse(model, device, data_loader, epoch):
+def evaluate_network_sparse(model, device, data_loader, epoch, timer=None):
     model.eval()
-    epoch_test_loss = 0
-    epoch_test_mae = 0
-    nb_data = 0
-    with torch.no_grad():
-        for iter, batch_data in enumerate(data_loader):
+    timer = timer or PhaseTimer(device, enabled=False)
+    epoch_test_loss = MeanMetric(device)
+    epoch_test_mae = MeanAbsoluteError(device)
+    with torch.no_grad(), timer.layers(model):
+        for iter, batch_data in enumerate(timer.fetch(data_loader)):
             batch_graphs, batch_targets = batch_data
-            batch_graphs = batch_graphs.to(device)
-            batch_x = batch_graphs.ndata['feat'].to(device)
-            batch_e = batch_graphs.edata['feat'].to(device)
-            batch_targets = batch_targets.to(device)
-            try:
-                batch_pos_enc = batch_graphs.ndata['pos_enc'].to(device)
-                batch_scores = model.forward(batch_graphs, batch_x, batch_e, batch_pos_enc)
-            except:
-                batch_scores = model.forward(batch_graphs, batch_x, batch_e)
-            loss = model.loss(batch_scores, batch_targets)
-            epoch_test_loss += loss.detach().item()
-            epoch_test_mae += MAE(batch_scores, batch_targets)
-            nb_data += batch_targets.size(0)
-        epoch_test_loss /= (iter + 1)
-        epoch_test_mae /= (iter + 1)
+            with timer.phase('transfer'):
+                batch_graphs = batch_graphs.to(device)
+                batch_x = batch_graphs.ndata['feat'].to(device)
+                batch_e = batch_graphs.edata['feat'].to(device)
+                batch_targets = batch_targets.to(device)
+            with timer.phase('forward'):
+                try:
+                    batch_pos_enc = batch_graphs.ndata['pos_enc'].to(device)
+                    batch_scores = model.forward(batch_graphs, batch_x, batch_e, batch_pos_enc)
+                except:
+                    batch_scores = model.forward(batch_graphs, batch_x, batch_e)
+            with timer.phase('loss'):
+                loss = model.loss(batch_scores, batch_targets)
+            epoch_test_loss.update(loss)
+            epoch_test_mae.update(batch_scores, batch_targets)
+            timer.count(batch_graphs)
 
-    return epoch_test_loss, epoch_test_mae
+    return epoch_test_loss.compute(), epoch_test_mae.compute()
@@ -0,0 +1,131 @@
+import copy
+import json
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+"""
+    Checkpoints of one training run (one RUN_ folder), written on a background thread
+
+    Every checkpoint RUN_<run>/epoch_<n>.pkl holds everything needed to continue training:
+    the model, optimizer and LR scheduler state, the RNG states, the epoch and the fold (split)
+    index, plus whatever the pipeline adds. Only the best keep_best checkpoints by their metric
+    (the val loss) and the latest one are kept; checkpoints.json lists them.
+
+    save() copies the tensors to the CPU before it returns, so training goes on while the
+    file is written; files are written to a temporary name first and then renamed, so a job
+    killed in the middle of a write leaves the previous checkpoints intact.
+"""
+
+INDEX = 'checkpoints.json'
+
+
+def _snapshot(obj):
+    # copy of a (nested) state with every tensor cloned to the CPU
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def training_state(epoch, fold, model, optimizer, scheduler, **extra):
+    return dict({'epoch': epoch, 'fold': fold, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                 'scheduler': scheduler.state_dict(), 'rng': rng_state()}, **extra)
+
+
+def latest_checkpoint(ckpt_dir):
+    # the state of the most recent checkpoint in ckpt_dir, or None
+    index_file = os.path.join(ckpt_dir, INDEX)
+    if not os.path.exists(index_file):
+        return None
+    with open(index_file) as f:
+        latest = json.load(f)['latest']
+    return torch.load(os.path.join(ckpt_dir, 'epoch_{}.pkl'.format(latest)), map_location='cpu', weights_only=False)
+
+
+class CheckpointManager:
+    def __init__(self, ckpt_dir, keep_best=3):
+        self.ckpt_dir = ckpt_dir
+        self.keep_best = keep_best
+        self.metrics = {}     # epoch -> metric (None if not evaluated) of the checkpoints on disk
+        self.latest = None
+        index_file = os.path.join(ckpt_dir, INDEX)
+        if os.path.exists(index_file):   # resuming
+            with open(index_file) as f:
+                index = json.load(f)
+            self.metrics = {int(epoch): metric for epoch, metric in index['metrics'].items()}
+            self.latest = index['latest']
+        self.executor = ThreadPoolExecutor(max_workers=1)   # one writer, so the writes keep their order
+        self.pending = []
+
+    def path(self, epoch):
+        return os.path.join(self.ckpt_dir, 'epoch_{}.pkl'.format(epoch))
+
+    def save(self, epoch, state, metric=None):
+        """
+            Checkpoint of epoch with its metric (lower is better, None if not evaluated);
+            returns once the state is copied, the file is written in the background
+        """
+        self._raise_errors()
+        snapshot = _snapshot(state)
+        self.metrics[epoch] = metric
+        self.latest = epoch
+        scored = sorted((m, e) for e, m in self.metrics.items() if m is not None)
+        keep = {e for _, e in scored[:self.keep_best]} | {epoch}
+        removed = [e for e in self.metrics if e not in keep]
+        for e in removed:
+            del self.metrics[e]
+        index = {'latest': epoch, 'metrics': dict(self.metrics)}
+        self.pending.append(self.executor.submit(self._write, epoch, snapshot, index, removed))
+
+    def _write(self, epoch, snapshot, index, removed):
+        if not os.path.exists(self.ckpt_dir):
+            os.makedirs(self.ckpt_dir)
+        torch.save(snapshot, self.path(epoch) + '.tmp')
+        os.replace(self.path(epoch) + '.tmp', self.path(epoch))
+        with open(os.path.join(self.ckpt_dir, INDEX + '.tmp'), 'w') as f:
+            json.dump(index, f)
+        os.replace(os.path.join(self.ckpt_dir, INDEX + '.tmp'), os.path.join(self.ckpt_dir, INDEX))
+        for e in removed:
+            if os.path.exists(self.path(e)):
+                os.remove(self.path(e))
+
+    def best_epoch(self):
+        scored = [(m, e) for e, m in self.metrics.items() if m is not None]
+        return min(scored)[1] if scored else None
+
+    def _raise_errors(self):
+        done = [future for future in self.pending if future.done()]
+        self.pending = [future for future in self.pending if not future.done()]
+        for future in done:
+            future.result()
+
+    def wait(self):
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -0,0 +1,117 @@
+import contextlib
+import copy
+import time
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+"""
+    Activation checkpointing of the message passing layers (net_params['checkpoint_layers'])
+
+    Each checkpointed layer only keeps its input for backward and runs again during backward
+    to rebuild its activations. With the reentrant implementation the first pass runs under
+    no_grad and the recomputation with grad enabled, which is how the BatchNorm running
+    statistics are kept from being updated twice.
+"""
+
+
+_recomputing = 0   # depth of the checkpointed layers being recomputed in backward
+
+
+def is_recomputing():
+    # True while a checkpointed layer runs again in backward (see PhaseTimer.layers)
+    return _recomputing > 0
+
+
+@contextlib.contextmanager
+def frozen_batch_norm_stats(module):
+    # BatchNorm layers normalise with the batch statistics as usual but leave the running ones alone
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.
+    try:
+        yield
+    finally:
+        for bn, (momentum, num_batches_tracked) in zip(bns, saved):
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def checkpoint_layer(layer, fn, *args):
+    """
+        fn(*args) (a forward of layer) without storing its activations
+    """
+    def run(*inputs):
+        global _recomputing
+        if torch.is_grad_enabled():   # recomputation in backward
+            _recomputing += 1
+            try:
+                with frozen_batch_norm_stats(layer):
+                    return fn(*inputs)
+            finally:
+                _recomputing -= 1
+        return fn(*inputs)
+    return checkpoint(run, *args, use_reentrant=True)
+
+
+def _saved_tensor_bytes(step):
+    # bytes of the tensors autograd keeps for backward during step(), each storage counted once
+    storages = {}
+
+    def pack(t):
+        storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        loss = step()
+    return loss, sum(storages.values())
+
+
+def checkpoint_report(model, batch_graphs, batch_labels, device, repeats=3):
+    """
+        One training step (forward, loss, backward) on a copy of the model with and without
+        checkpoint_layers: activation memory kept for backward (and peak memory on GPU)
+        against the step time
+    """
+    with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):   # leave the training RNG alone
+        return _checkpoint_report(copy.deepcopy(model).train(), batch_graphs, batch_labels, device, repeats)
+
+
+def _checkpoint_report(model, batch_graphs, batch_labels, device, repeats):
+    h = batch_graphs.ndata['feat'].to(device)
+    e = batch_graphs.edata['feat'].to(device)
+    results = {}
+    for enabled in [False, True]:
+        model.checkpoint_layers = enabled
+
+        def step():
+            return model.loss(model(batch_graphs, h, e), batch_labels)
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+        loss, saved = _saved_tensor_bytes(step)
+        loss.backward()
+        peak = torch.cuda.max_memory_allocated() - base if device.type == 'cuda' else None
+
+        times = []
+        for _ in range(repeats):
+            model.zero_grad()
+            start = time.time()
+            step().backward()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            times.append(time.time() - start)
+        results[enabled] = saved, peak, min(times)
+
+    (saved_off, peak_off, time_off), (saved_on, peak_on, time_on) = results[False], results[True]
+    report = 'Layer checkpointing: {:.1f} MB -> {:.1f} MB kept for backward ({:.0f}% less)'.format(
+        saved_off / 2**20, saved_on / 2**20, 100 * (1 - saved_on / max(saved_off, 1)))
+    if peak_off is not None:
+        report += ', peak {:.1f} MB -> {:.1f} MB'.format(peak_off / 2**20, peak_on / 2**20)
+    report += ', step {:.1f} ms -> {:.1f} ms ({:+.0f}% compute)'.format(
+        time_off * 1000, time_on * 1000, 100 * (time_on / time_off - 1))
+    return report
@@ -0,0 +1,107 @@
+import time
+
+import numpy as np
+import torch
+
+from layers.scatter_ops import graph_tensors
+from utils.precision import autocast
+
+"""
+    Opt-in torch.compile mode for the training step (forward, loss and backward)
+
+    The compiled function runs the nets' DGL-free forward_tensors() on (features, edge_index,
+    edge_weight, batch), converted from the DGLGraph outside the compiled region, together with
+    the DenseBatch of the net's exec_mode (dense_batch(), None when sparse), so that compiled
+    and eager steps run the same path as the net's own forward(). Node, edge and
+    graph counts are marked dynamic, so one graph serves every batch size; padding batches into
+    shape buckets is not an option here since padded nodes and edges would enter the BatchNorm
+    statistics and the batch-wide edge softmax of UnionSNN.
+
+    The forward runs under the same autocast as the eager training loops (params['precision']),
+    inside the compiled region, and the loss in fp32; the eager steps and the eager fallback go
+    through the same function.
+
+    The first eager_steps steps run eager and give the baseline the compiled steps are compared to;
+    report() puts the compile time next to the steady-state step time and the resulting break-even.
+"""
+
+
+def _sync(t):
+    if t.is_cuda:
+        torch.cuda.synchronize(t.device)
+
+
+def _unique_graphs():
+    # number of graphs dynamo compiled so far, to tell compiling calls from cached ones
+    from torch._dynamo.utils import counters
+    return counters['stats']['unique_graphs']
+
+
+class CompiledStep:
+    def __init__(self, model, eager_steps=10, mode=None, precision='fp32'):
+        self.model = model
+        self.precision = precision
+        self.eager_steps = eager_steps
+        self.compiled = torch.compile(self._forward_loss, dynamic=True, mode=mode)
+        self.eager_times, self.compile_times, self.steady_times = [], [], []
+        self.num_compiles = 0
+
+    def _forward_loss(self, h, edge_index, edge_weight, batch, num_graphs, dense, labels):
+        with autocast(h.device, self.precision):
+            scores = self.model.forward_tensors(h, edge_index, edge_weight, batch, num_graphs, dense)
+        scores = scores.float()  # loss in fp32
+        return scores, self.model.loss(scores, labels)
+
+    def __call__(self, g, h, labels):
+        """
+            One training step without the optimizer: returns (scores, loss) with the gradients accumulated
+        """
+        edge_index, batch, num_graphs = graph_tensors(g)
+        edge_weight = g.edata['weight'] if 'weight' in g.edata else None
+        dense = self.model.dense_batch(edge_index, batch, num_graphs)   # dense and sparse compile apart
+        inputs = (h, edge_index, edge_weight, batch, num_graphs, dense, labels)
+
+        _sync(h)
+        start = time.time()
+        if len(self.eager_times) < self.eager_steps or self.compiled is None:
+            scores, loss = self._forward_loss(*inputs)
+            loss.backward()
+            _sync(h)
+            self.eager_times.append(time.time() - start)
+            return scores, loss
+
+        for t, dim in [(h, 0), (edge_index, 1), (batch, 0), (labels, 0)] + \
+                      ([(edge_weight, 0)] if edge_weight is not None else []):
+            torch._dynamo.maybe_mark_dynamic(t, dim)
+        compiles = _unique_graphs()
+        try:
+            scores, loss = self.compiled(*inputs)
+        except Exception as e:
+            print('[!] torch.compile failed ({}: {}), continuing in eager mode'.format(type(e).__name__, e))
+            self.compiled = None
+            return self(g, h, labels)
+        loss.backward()
+        _sync(h)
+        elapsed = time.time() - start
+        if _unique_graphs() > compiles:
+            self.num_compiles += _unique_graphs() - compiles
+            self.compile_times.append(elapsed)
+        else:
+            self.steady_times.append(elapsed)
+        return scores, loss
+
+    def report(self):
+        if self.compiled is None:
+            return 'torch.compile: fell back to eager'
+        if not self.eager_times or not self.steady_times:
+            return 'torch.compile: not enough steps to compare ({} eager, {} compiled)'.format(
+                len(self.eager_times), len(self.steady_times))
+        eager = np.median(self.eager_times)
+        steady = np.median(self.steady_times)
+        # time spent compiling, on top of what these steps would have cost in steady state
+        overhead = sum(self.compile_times) - steady * len(self.compile_times)
+        gain = eager - steady
+        break_even = 'after {:.0f} steps'.format(overhead / gain) if gain > 0 else 'never'
+        return 'torch.compile: {} graph(s) compiled in {:.2f}s, step {:.2f}ms eager vs {:.2f}ms compiled ' \
+               '({:.2f}x), pays off {}'.format(self.num_compiles, overhead, eager * 1000, steady * 1000,
+                                              eager / steady, break_even)
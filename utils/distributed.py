@@ -0,0 +1,145 @@
+import contextlib
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+from utils.fold_scheduler import core_slices
+
+"""
+    Data-parallel training over processes (torch.distributed, gloo backend)
+
+    Launched with torchrun, one process per group of cores, e.g. on one machine:
+
+        torchrun --standalone --nproc_per_node=8 main_graph_reg.py --config configs/...json
+
+    Every process trains the same model on its own shard of the training batches (a
+    DistributedSampler over the train split) and DistributedDataParallel all-reduces the
+    gradients in backward, so that the optimizer steps stay identical on all ranks.
+    The cores of the machine are split between the local processes (affinity and
+    torch.set_num_threads), since torchrun would otherwise leave every process one thread.
+    With the GPU, every local rank takes the GPU of its LOCAL_RANK (gloo on CUDA tensors).
+
+    BatchNorm: by default every rank normalises with the statistics of its own batch_size /
+    world_size graphs, and the running statistics are rank 0's (DDP broadcasts the buffers
+    in every forward), so results drift from a single process as the per-rank batches shrink.
+    sync_batch_norm (SyncBatchNorm) normalises over the whole batch as one process would, at
+    the cost of an all-gather per BatchNorm layer in forward and backward; torch only
+    implements it on the GPU.
+
+    The dataset is built by rank 0 first (its transform cache written), then read from the
+    cache by the other ranks, see main_process_first().
+"""
+
+
+def init_distributed():
+    """
+        (rank, world_size) of this process; sets up the gloo process group when launched
+        by torchrun with more than one process, (0, 1) otherwise
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size == 1:
+        return 0, 1
+    dist.init_process_group('gloo')
+
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    cores = core_slices(local_world_size)[local_rank]
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    return dist.get_rank(), world_size
+
+
+def close_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def distributed_device(use_gpu):
+    # the GPU of this local rank (all GPUs of the machine visible), or the CPU
+    if not (use_gpu and torch.cuda.is_available()):
+        print('cuda not available')
+        return torch.device('cpu')
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if local_rank >= torch.cuda.device_count():
+        raise RuntimeError('Local rank {} has no GPU of its own ({} visible); start at most one process per GPU '
+                           'with --nproc_per_node'.format(local_rank, torch.cuda.device_count()))
+    torch.cuda.set_device(local_rank)
+    print('cuda available with GPU:', torch.cuda.get_device_name(local_rank))
+    return torch.device('cuda', local_rank)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank_and_world_size():
+    if not is_distributed():
+        return 0, 1
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_main_process():
+    return rank_and_world_size()[0] == 0
+
+
+class DistributedModel(DistributedDataParallel):
+    """
+        DistributedDataParallel that still exposes the loss() of the wrapped net,
+        as the training loops call model.loss
+    """
+    def loss(self, *args):
+        return self.module.loss(*args)
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextlib.contextmanager
+def main_process_first():
+    # rank 0 runs the block first (e.g. writes a cache), the other ranks once it is done
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def distributed_model(model, sync_batch_norm=False):
+    # some parameters are not used in every configuration (e.g. the edge weight MLPs of UnionSNN
+    # without edge features), which DDP has to be told about. SyncBatchNorm replaces the BatchNorm
+    # layers in place, so model itself (for evaluation and checkpoints) uses them as well
+    if sync_batch_norm:
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    return DistributedModel(model, find_unused_parameters=True)
+
+
+def shard(dataset, rank, world_size):
+    # every world_size-th sample from rank on, without the padding of DistributedSampler (for evaluation)
+    return torch.utils.data.Subset(dataset, list(range(rank, len(dataset), world_size)))
+
+
+def mean_over_ranks(values, count):
+    """
+        Averages over all ranks of per-rank averages values over count items each (e.g. the
+        batch-averaged loss and MAE of an evaluation shard), weighted by count
+    """
+    if not is_distributed():
+        return values
+    totals = torch.tensor([float(v) * count for v in values] + [float(count)], dtype=torch.float64)
+    dist.all_reduce(totals)
+    return [total / max(totals[-1].item(), 1) for total in totals[:-1].tolist()]
+
+
+def any_rank(flag):
+    # True on every rank if flag is True on any of them, to take a stopping decision together
+    if not is_distributed():
+        return flag
+    flag = torch.tensor([int(flag)])
+    dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+    return bool(flag.item())
@@ -0,0 +1,64 @@
+"""
+    When the training pipelines evaluate (params['eval_policy'], params['eval_every'])
+
+    'every'    val and test every eval_every epochs (eval_every=1: every epoch)
+    'plateau'  val and test every eval_every epochs, and in between whenever the training loss
+               has not improved for eval_patience epochs
+    'best'     val only, every eval_every epochs; test once at the end, on the weights of the
+               epoch with the best validation loss
+
+    The LR scheduler and the stopping criteria are stepped on the evaluated epochs only, so with
+    eval_every > 1 lr_schedule_patience counts evaluations rather than epochs.
+"""
+
+POLICIES = ['every', 'plateau', 'best']
+
+
+class EvalSchedule:
+    def __init__(self, policy='every', every=1, patience=5, threshold=1e-3):
+        if policy not in POLICIES:
+            raise KeyError('Evaluation policy {} not recognized.'.format(policy))
+        self.policy = policy
+        self.every = max(every, 1)
+        self.patience = patience
+        self.threshold = threshold
+        self.best_train_loss = float('inf')
+        self.stale_epochs = 0
+        self.best_val_loss = float('inf')
+        self.best_epoch = None
+        self.best_state = None
+
+    def evaluate_val(self, epoch, train_loss):
+        # True if the val set should be evaluated after epoch
+        if train_loss < self.best_train_loss * (1 - self.threshold):
+            self.best_train_loss, self.stale_epochs = train_loss, 0
+        else:
+            self.stale_epochs += 1
+        if (epoch + 1) % self.every == 0:
+            return True
+        if self.policy == 'plateau' and self.stale_epochs >= self.patience:
+            self.stale_epochs = 0
+            return True
+        return False
+
+    def evaluate_test(self):
+        # the test set goes along with every val pass, except when deferred to the best checkpoint
+        return self.policy != 'best'
+
+    def update(self, model, epoch, val_loss):
+        if self.policy == 'best' and val_loss < self.best_val_loss:
+            self.best_val_loss, self.best_epoch = val_loss, epoch
+            self.best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+
+    def restore_best(self, model):
+        # loads the weights of the best val epoch ('best' policy); returns that epoch
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
+        return self.best_epoch
+
+    def state_dict(self):
+        return {k: v for k, v in self.__dict__.items()
+                if k in ['best_train_loss', 'stale_epochs', 'best_val_loss', 'best_epoch', 'best_state']}
+
+    def load_state_dict(self, state):
+        self.__dict__.update(state)
@@ -0,0 +1,61 @@
+import os
+import multiprocessing
+
+import torch
+
+"""
+    Process-parallel cross-validation folds (params['fold_workers'])
+
+    The folds run in a pool of forked worker processes. Forking after the dataset is loaded
+    shares it with every worker: the graph tensors stay in the parent's pages (copy-on-write,
+    and their storage is never written to), so the preprocessed dataset is held in memory once.
+    Each worker is pinned to its own slice of the available cores and sets torch's intra-op
+    threads to the size of that slice, so that the workers do not oversubscribe the machine.
+
+    Workers are forked, so this is for CPU training: CUDA does not survive a fork.
+"""
+
+_worker = {}
+
+
+def core_slices(num_workers, cores=None):
+    # split the cores this process may run on into num_workers disjoint, contiguous slices
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    if num_workers > len(cores):   # more workers than cores: one core each, shared round robin
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    per_worker = len(cores) // num_workers
+    return [cores[i * per_worker:(i + 1) * per_worker] for i in range(num_workers)]
+
+
+def _init_worker(fn, slots):
+    cores = slots.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    _worker['fn'] = fn
+
+
+def _run(fold):
+    return fold, _worker['fn'](fold)
+
+
+def run_folds(fn, folds, num_workers):
+    """
+        Yields (fold, fn(fold)) for every fold as the num_workers pinned worker processes finish
+        them; fn and everything it refers to (the dataset) are inherited by the workers, not pickled
+    """
+    num_workers = min(num_workers, len(folds))
+    context = multiprocessing.get_context('fork')
+    slots = context.Queue()
+    for cores in core_slices(num_workers):
+        slots.put(cores)
+
+    pool = context.Pool(num_workers, initializer=_init_worker, initargs=(fn, slots))
+    try:
+        for fold, result in pool.imap_unordered(_run, folds):
+            yield fold, result
+        pool.close()
+    finally:
+        pool.terminate()   # no-op once closed and done; stops the workers on Ctrl + C
+        pool.join()
@@ -0,0 +1,176 @@
+import contextlib
+import os
+import resource
+import tracemalloc
+
+import torch
+
+"""
+    Memory telemetry of dataset construction and training (params['memory'], params['memory_trace'],
+    params['memory_budget'])
+
+    A MemoryTracker records, per stage (load, split_idx, preprocess, splits, collate), the
+    resident memory after it and its peak RSS, and per training epoch the peak RSS (and the peak
+    CUDA allocation on GPU), to TensorBoard (memory/...) and the results file. The peak is
+    Linux's VmHWM, reset at the start of every stage and epoch through /proc/self/clear_refs;
+    where that is not available a peak is that of the process so far. With memory_trace,
+    tracemalloc also gives the peak of the Python/numpy allocations of every stage and its top
+    allocation sites (tracing slows everything down, the rest is cheap).
+
+    With memory_budget (MB), every stage and epoch checks the peak RSS against the budget and
+    raises MemoryBudgetExceeded, naming the stage, before the OOM killer gets to the job.
+    Data-parallel ranks pass any_rank (utils.distributed): a stage then only notes that the
+    budget was exceeded, as the ranks do not run their stages (e.g. collate of their own batches)
+    in step, and check() and end_epoch(), which every rank reaches together, raise on all ranks
+    as soon as one of them is over budget.
+
+    A disabled tracker (neither memory nor memory_budget) does nothing.
+"""
+
+_NULL = contextlib.nullcontext()
+
+
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+
+def rss_mb():
+    # current resident set size
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    # peak resident set size since the last reset_peak_rss() (or the start of the process)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024   # KB on Linux
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class MemoryTracker:
+    def __init__(self, device=None, enabled=True, budget_mb=None, trace=False, top=10, any_rank=None):
+        self.device = device
+        self.enabled = enabled or budget_mb is not None
+        self.budget_mb = budget_mb
+        self.trace = trace and self.enabled
+        self.top = top
+        self.stages = {}
+        self.epochs = []
+        self._peak = 0.   # peak RSS since the last end_epoch(), across the resets of the stages
+        self.any_rank = any_rank
+        self._exceeded = None   # where this rank went over budget, until the next check() (with any_rank)
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _fold_peak(self):
+        self._peak = max(self._peak, peak_rss_mb())
+        return self._peak
+
+    def _over_budget(self, where):
+        if self.budget_mb is not None and self._fold_peak() > self.budget_mb and self._exceeded is None:
+            self._exceeded = where
+        return self._exceeded is not None
+
+    def check(self, where):
+        # with any_rank a collective: to be called by all ranks at the same point
+        over = self._over_budget(where)
+        if self.any_rank is not None and self.budget_mb is not None:
+            over = self.any_rank(over)
+        if over:
+            raise MemoryBudgetExceeded(
+                'Peak RSS of {:.0f} MB in {} exceeds the memory budget of {:.0f} MB (--memory_budget); '
+                'memory per stage so far:\n{}'.format(self._peak, self._exceeded or '{} (on another rank)'.format(where),
+                                                       self.budget_mb, self.summary()))
+
+    @contextlib.contextmanager
+    def _stage(self, name, snapshot):
+        self._fold_peak()
+        reset_peak_rss()
+        if self.trace:
+            tracemalloc.reset_peak()
+        yield
+        stage = self.stages.setdefault(name, {'calls': 0, 'peak_rss_mb': 0.})
+        stage['calls'] += 1
+        stage['rss_mb'] = rss_mb()
+        stage['peak_rss_mb'] = max(stage['peak_rss_mb'], peak_rss_mb())
+        if self.trace:
+            stage['traced_peak_mb'] = max(stage.get('traced_peak_mb', 0.), tracemalloc.get_traced_memory()[1] / 2**20)
+            if snapshot:
+                stage['top'] = [str(stat) for stat in tracemalloc.take_snapshot().statistics('lineno')[:self.top]]
+        if self.any_rank is None:
+            self.check('stage {}'.format(name))
+        else:   # raised by the next check() or end_epoch() of all ranks
+            self._over_budget('stage {}'.format(name))
+
+    def stage(self, name, snapshot=True):
+        # records the memory of the code in the context as stage name
+        return self._stage(name, snapshot) if self.enabled else _NULL
+
+    def wrap(self, name, fn):
+        # fn, recorded as stage name on every call (without snapshots), e.g. a collate_fn
+        if not self.enabled:
+            return fn
+
+        def wrapped(*args, **kwargs):
+            with self._stage(name, snapshot=False):
+                return fn(*args, **kwargs)
+        return wrapped
+
+    def end_epoch(self, writer, epoch):
+        """
+            Writes the peak memory of the epoch as memory/ scalars (unless writer is None, e.g.
+            on the ranks other than 0), checks the budget and starts the next epoch; returns the
+            peak RSS of the epoch (MB)
+        """
+        if not self.enabled:
+            return None
+        peak = self._fold_peak()
+        if writer is not None:
+            writer.add_scalar('memory/peak_rss_mb', peak, epoch)
+            writer.add_scalar('memory/rss_mb', rss_mb(), epoch)
+        if self.device is not None and self.device.type == 'cuda':
+            if writer is not None:
+                writer.add_scalar('memory/cuda_peak_mb', torch.cuda.max_memory_allocated(self.device) / 2**20, epoch)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.epochs.append(peak)
+        self.check('epoch {}'.format(epoch))
+        self._peak = 0.
+        reset_peak_rss()
+        return peak
+
+    def write_stages(self, writer):
+        for name, stage in self.stages.items():
+            writer.add_scalar('memory/stage_{}_peak_rss_mb'.format(name), stage['peak_rss_mb'], 0)
+
+    def summary(self):
+        """
+            Text table of the memory of every stage (with its top allocation sites when traced)
+            and of the training epochs
+        """
+        lines = ['{:<12} {:>6} {:>14} {:>10} {:>14}'.format('Stage', 'Calls', 'Peak RSS MB', 'RSS MB', 'Traced peak MB')]
+        for name, stage in self.stages.items():
+            lines.append('{:<12} {:>6} {:>14.1f} {:>10.1f} {:>14}'.format(
+                name, stage['calls'], stage['peak_rss_mb'], stage['rss_mb'],
+                '{:.1f}'.format(stage['traced_peak_mb']) if 'traced_peak_mb' in stage else '-'))
+        if self.epochs:
+            lines.append('{:<12} {:>6} {:>14.1f}'.format('epochs', len(self.epochs), max(self.epochs)))
+        for name, stage in self.stages.items():
+            if stage.get('top'):
+                lines.append('\nTop allocations of {}:\n{}'.format(name, '\n'.join(stage['top'])))
+        return '\n'.join(lines)
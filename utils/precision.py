@@ -0,0 +1,28 @@
+import contextlib
+
+import torch
+
+"""
+    Mixed-precision training
+
+    'bf16' runs the forward pass under torch.autocast with bfloat16, on CPU as well as on GPU:
+    the linear layers and matmuls take bf16 inputs, which halves the activations they read and
+    write. The ops that need the precision stay in fp32 in the model code (the edge softmax of
+    UnionSNNLayer, the BatchNorms) and in the training loops (the loss).
+
+    bf16 has the 8-bit exponent of fp32, so small gradients do not underflow the way they do in
+    fp16, and no loss scaling (GradScaler) is needed.
+"""
+
+PRECISIONS = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+}
+
+
+def autocast(device, precision='fp32'):
+    if precision not in PRECISIONS:
+        raise KeyError('Precision {} not recognized.'.format(precision))
+    if PRECISIONS[precision] is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=PRECISIONS[precision])
@@ -0,0 +1,157 @@
+import contextlib
+import os
+
+from torch.profiler import profile, record_function, schedule, ProfilerActivity
+
+"""
+    torch.profiler traces of selected training epochs (params['profile'])
+
+    The training batches of the selected epochs of the selected folds (splits) go through a
+    wait / warmup / active profiler schedule. Every window writes a Chrome trace (open in
+    chrome://tracing or https://ui.perfetto.dev) and a text report next to the TensorBoard logs
+    of the run: the top operators by self CPU time, and the top operators inside each kind of
+    module (UnionSNNLayer, MLP, pooling, DGL update_all), with CPU (and GPU) memory.
+"""
+
+# module class name -> group of the report
+MODULE_GROUPS = {
+    'UnionSNNLayer': 'UnionSNNLayer',
+    'GINLayer': 'GINLayer',
+    'GCNLayer': 'GCNLayer',
+    'MLP': 'MLP',
+    'MLPReadout': 'MLPReadout',
+    'SumPooling': 'pooling',
+    'AvgPooling': 'pooling',
+    'MaxPooling': 'pooling',
+}
+UPDATE_ALL = 'dgl.update_all'
+
+
+class Profiler:
+    def __init__(self, out_dir, epochs, folds=None, wait=1, warmup=1, active=3, device=None, row_limit=15):
+        self.out_dir = out_dir
+        self.epochs = set(epochs)
+        self.folds = None if folds is None else set(folds)
+        self.wait, self.warmup, self.active = wait, warmup, active
+        self.device = device
+        self.row_limit = row_limit
+        self.prof = None
+
+    def selected(self, fold, epoch):
+        return epoch in self.epochs and (self.folds is None or fold in self.folds)
+
+    @contextlib.contextmanager
+    def epoch(self, model, fold, epoch):
+        """
+            Profiles the training batches iterated through self.wrap() within the context,
+            if fold and epoch are selected
+        """
+        if not self.selected(fold, epoch):
+            yield
+            return
+        name = 'profile_epoch{}'.format(epoch) if fold is None else 'profile_fold{}_epoch{}'.format(fold, epoch)
+        activities = [ProfilerActivity.CPU]
+        if self.device is not None and self.device.type == 'cuda':
+            activities.append(ProfilerActivity.CUDA)
+        with profile(activities=activities,
+                     schedule=schedule(wait=self.wait, warmup=self.warmup, active=self.active, repeat=1),
+                     on_trace_ready=lambda prof: self._trace_ready(prof, name),
+                     profile_memory=True, record_shapes=True) as prof, _module_ranges(model), _update_all_range():
+            self.prof = prof
+            try:
+                yield
+            finally:
+                self.prof = None
+
+    def wrap(self, data_loader):
+        # iterates over data_loader, one profiler step per batch
+        for batch in data_loader:
+            yield batch
+            if self.prof is not None:
+                self.prof.step()
+
+    def _trace_ready(self, prof, name):
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        prof.export_chrome_trace(os.path.join(self.out_dir, name + '.json'))
+        sort_by = 'self_cuda_time_total' if self.device is not None and self.device.type == 'cuda' else 'self_cpu_time_total'
+        report = 'Top operators\n{}\n\nTop operators per module\n{}\n'.format(
+            prof.key_averages().table(sort_by=sort_by, row_limit=self.row_limit),
+            module_table(prof.events(), self.row_limit))
+        with open(os.path.join(self.out_dir, name + '.txt'), 'w') as f:
+            f.write(report)
+        print('Profile written to {}'.format(os.path.join(self.out_dir, name + '.{json,txt}')))
+
+
+@contextlib.contextmanager
+def _module_ranges(model):
+    # a profiler range around the forward of every module of MODULE_GROUPS, named after its group
+    handles = []
+    for module in model.modules():
+        group = MODULE_GROUPS.get(type(module).__name__)
+        if group is None:
+            continue
+        ranges = []
+
+        def pre_hook(module, inputs, group=group, ranges=ranges):
+            ranges.append(record_function(group))
+            ranges[-1].__enter__()
+
+        def hook(module, inputs, output, ranges=ranges):
+            ranges.pop().__exit__(None, None, None)
+        handles += [module.register_forward_pre_hook(pre_hook), module.register_forward_hook(hook)]
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+@contextlib.contextmanager
+def _update_all_range():
+    # a profiler range around DGLGraph.update_all, the message passing of the DGL backend
+    try:
+        import dgl
+    except ImportError:
+        yield
+        return
+    update_all = dgl.DGLGraph.update_all
+
+    def profiled_update_all(*args, **kwargs):
+        with record_function(UPDATE_ALL):
+            return update_all(*args, **kwargs)
+    dgl.DGLGraph.update_all = profiled_update_all
+    try:
+        yield
+    finally:
+        dgl.DGLGraph.update_all = update_all
+
+
+def module_table(events, row_limit=15):
+    """
+        Self CPU time, self CUDA time and self CPU memory of the operators, summed per innermost
+        enclosing module group (or update_all), the top row_limit operators of every group
+    """
+    groups = set(MODULE_GROUPS.values()) | {UPDATE_ALL}
+    totals = {}
+    for event in events:
+        if event.name in groups:
+            continue
+        parent = event.cpu_parent
+        while parent is not None and parent.name not in groups:
+            parent = parent.cpu_parent
+        if parent is None:
+            continue
+        key = (parent.name, event.name)
+        cpu, cuda, memory, count = totals.get(key, (0., 0., 0, 0))
+        totals[key] = (cpu + event.self_cpu_time_total, cuda + getattr(event, 'self_cuda_time_total', 0.),
+                       memory + event.self_cpu_memory_usage, count + 1)
+
+    lines = ['{:<16} {:<40} {:>14} {:>14} {:>14} {:>8}'.format(
+        'Module', 'Operator', 'Self CPU (ms)', 'Self CUDA (ms)', 'CPU Mem (MB)', 'Calls')]
+    for group in sorted({group for group, _ in totals}):
+        rows = sorted(((op, value) for (g, op), value in totals.items() if g == group), key=lambda row: -row[1][0])
+        for op, (cpu, cuda, memory, count) in rows[:row_limit]:
+            lines.append('{:<16} {:<40} {:>14.3f} {:>14.3f} {:>14.2f} {:>8}'.format(
+                group, op[:40], cpu / 1000, cuda / 1000, memory / 2**20, count))
+    return '\n'.join(lines)
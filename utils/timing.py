@@ -0,0 +1,133 @@
+import contextlib
+import time
+
+import torch
+
+from layers.unionsnn_layer import UnionSNNLayer
+from utils.checkpointing import is_recomputing
+
+"""
+    Per-phase timing of the training and evaluation loops (params['timing'])
+
+    A PhaseTimer adds up, per epoch, the wall time of each phase of the loops: fetching and
+    collating the batch (data), moving it to the device (transfer), forward (with every
+    UnionSNNLayer on its own, through forward hooks), loss, backward (with the recomputation of
+    every checkpointed UnionSNNLayer on its own, see checkpoint_layers) and the optimizer step,
+    and counts the graphs and edges seen for the throughput. On GPU the device is synchronised
+    at each phase boundary, so that the time of a phase is that of its kernels.
+
+    A disabled timer does nothing: its phases are one shared nullcontext.
+"""
+
+_NULL = contextlib.nullcontext()
+
+
+class PhaseTimer:
+    def __init__(self, device, enabled=True):
+        self.device = device
+        self.enabled = enabled
+        self.epoch = {}
+        self.total = {}
+        self.graphs, self.edges = 0, 0
+
+    def _now(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        return time.time()
+
+    def add(self, name, seconds):
+        self.epoch[name] = self.epoch.get(name, 0.) + seconds
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        start = self._now()
+        try:
+            yield
+        finally:
+            self.add(name, self._now() - start)
+
+    def phase(self, name):
+        return self._phase(name) if self.enabled else _NULL
+
+    def fetch(self, data_loader):
+        # iterates over data_loader, the time spent waiting for every batch going to 'data'
+        if not self.enabled:
+            yield from data_loader
+            return
+        iterator = iter(data_loader)
+        while True:
+            start = time.time()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.add('data', time.time() - start)
+            yield batch
+
+    def count(self, g):
+        if self.enabled:
+            self.graphs += g.batch_size
+            self.edges += g.num_edges()
+
+    @contextlib.contextmanager
+    def layers(self, model):
+        # times every UnionSNNLayer of model as 'forward/layer<i>' while in the context, and its
+        # recomputation in backward (checkpoint_layers) as 'backward/recompute_layer<i>'
+        if not self.enabled:
+            yield
+            return
+        handles, starts = [], {}
+        for i, layer in enumerate(m for m in model.modules() if isinstance(m, UnionSNNLayer)):
+            def pre_hook(module, inputs, i=i):
+                starts[i] = self._now()
+
+            def hook(module, inputs, output, i=i):
+                name = 'backward/recompute_layer{}' if is_recomputing() else 'forward/layer{}'
+                self.add(name.format(i), self._now() - starts[i])
+            handles += [layer.register_forward_pre_hook(pre_hook), layer.register_forward_hook(hook)]
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def end_epoch(self, writer, tag, epoch):
+        """
+            Writes the times of the epoch (and its throughput) as tag/time_<phase> scalars,
+            adds them to the totals of the run and starts the next epoch
+        """
+        if not self.enabled:
+            return
+        self.epoch['graphs'], self.epoch['edges'] = self.graphs, self.edges
+        elapsed = sum(seconds for name, seconds in self.epoch.items()
+                      if name not in ['graphs', 'edges'] and '/' not in name)
+        for name, seconds in self.epoch.items():
+            if name not in ['graphs', 'edges']:
+                writer.add_scalar('{}/time_{}'.format(tag, name), seconds, epoch)
+        if elapsed > 0:
+            writer.add_scalar('{}/graphs_per_sec'.format(tag), self.graphs / elapsed, epoch)
+            writer.add_scalar('{}/edges_per_sec'.format(tag), self.edges / elapsed, epoch)
+        for name, value in self.epoch.items():
+            self.total[name] = self.total.get(name, 0) + value
+        self.epoch, self.graphs, self.edges = {}, 0, 0
+
+
+def timing_summary(totals):
+    """
+        Text table of the summed phase times of one or more PhaseTimer.total
+    """
+    totals = dict(totals)
+    graphs, edges = totals.pop('graphs', 0), totals.pop('edges', 0)
+    elapsed = sum(seconds for name, seconds in totals.items() if '/' not in name)
+    lines = []
+    for name, seconds in totals.items():
+        lines.append('{:<20} {:>10.2f} s {:>6.1f}%'.format(name, seconds, 100. * seconds / max(elapsed, 1e-12)))
+    lines.append('{:<20} {:>10.0f} graphs/s {:>12.0f} edges/s'.format('throughput', graphs / max(elapsed, 1e-12),
+                                                                    edges / max(elapsed, 1e-12)))
+    return '\n'.join(lines)
+
+
+def add_totals(totals, other):
+    for name, value in other.items():
+        totals[name] = totals.get(name, 0) + value
+    return totals